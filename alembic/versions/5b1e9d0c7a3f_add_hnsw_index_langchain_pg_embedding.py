@@ -0,0 +1,79 @@
+"""add hnsw index on langchain_pg_embedding for RAG retrieval
+
+Revision ID: 5b1e9d0c7a3f
+Revises: 227c17acbe6d
+Create Date: 2026-10-16 10:04:52.731960
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b1e9d0c7a3f'
+down_revision: Union[str, None] = '227c17acbe6d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Dimensión de sentence-transformers/all-mpnet-base-v2 (settings.EMBEDDING_MODEL_NAME).
+EMBEDDING_DIM = 768
+EMBEDDING_TABLE = 'langchain_pg_embedding'
+INDEX_NAME = 'ix_langchain_pg_embedding_hnsw_cosine'
+
+
+def _embedding_table_exists() -> bool:
+    # La tabla la crea langchain_postgres al primer uso del vectorstore,
+    # así que puede no existir todavía en una base de datos recién creada.
+    return sa.inspect(op.get_bind()).has_table(EMBEDDING_TABLE)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    if not _embedding_table_exists():
+        return
+    # Los vectores ya guardados deben tener la dimensión del modelo configurado
+    stored_dims = [
+        row[0] for row in op.get_bind().execute(
+            sa.text(f"SELECT DISTINCT vector_dims(embedding) FROM {EMBEDDING_TABLE}")
+        )
+    ]
+    if any(dim != EMBEDDING_DIM for dim in stored_dims):
+        raise RuntimeError(
+            f"{EMBEDDING_TABLE} contiene vectores de dimensión {stored_dims}, no {EMBEDDING_DIM}. "
+            "Reingesta la colección con settings.EMBEDDING_MODEL_NAME antes de aplicar esta migración."
+        )
+    # HNSW exige una dimensión fija; langchain_postgres crea la columna como `vector` sin dimensión.
+    op.execute(
+        f"ALTER TABLE {EMBEDDING_TABLE} "
+        f"ALTER COLUMN embedding TYPE vector({EMBEDDING_DIM});"
+    )
+    # PGVector usa distancia coseno por defecto, por eso vector_cosine_ops.
+    # CONCURRENTLY no puede ejecutarse dentro de una transacción.
+    with op.get_context().autocommit_block():
+        op.create_index(
+            INDEX_NAME,
+            EMBEDDING_TABLE,
+            ['embedding'],
+            unique=False,
+            postgresql_using='hnsw',
+            postgresql_with={'m': 16, 'ef_construction': 64},
+            postgresql_ops={'embedding': 'vector_cosine_ops'},
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if not _embedding_table_exists():
+        return
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            INDEX_NAME,
+            table_name=EMBEDDING_TABLE,
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
+    op.execute(f"ALTER TABLE {EMBEDDING_TABLE} ALTER COLUMN embedding TYPE vector;")
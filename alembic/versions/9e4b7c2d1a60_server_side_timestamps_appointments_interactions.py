@@ -0,0 +1,58 @@
+"""server-side timestamps for appointments and interactions
+
+Revision ID: 9e4b7c2d1a60
+Revises: 5b1e9d0c7a3f
+Create Date: 2026-10-16 11:21:07.318842
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9e4b7c2d1a60'
+down_revision: Union[str, None] = '5b1e9d0c7a3f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+TABLES = ('appointments', 'interactions')
+TIMESTAMP_COLUMNS = ('created_at', 'updated_at')
+
+
+def _existing_tables() -> list:
+    # Estas tablas se crean desde los modelos, no desde una migración previa.
+    inspector = sa.inspect(op.get_bind())
+    return [table for table in TABLES if inspector.has_table(table)]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    for table in _existing_tables():
+        for column in TIMESTAMP_COLUMNS:
+            # Los valores existentes se guardaron con datetime.utcnow (naive en UTC).
+            op.alter_column(
+                table,
+                column,
+                type_=sa.DateTime(timezone=True),
+                existing_type=sa.DateTime(),
+                existing_nullable=False,
+                server_default=sa.func.now(),
+                postgresql_using=f"{column} AT TIME ZONE 'UTC'",
+            )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for table in _existing_tables():
+        for column in TIMESTAMP_COLUMNS:
+            op.alter_column(
+                table,
+                column,
+                type_=sa.DateTime(),
+                existing_type=sa.DateTime(timezone=True),
+                existing_nullable=False,
+                server_default=None,
+                postgresql_using=f"{column} AT TIME ZONE 'UTC'",
+            )
@@ -0,0 +1,67 @@
+"""add interaction, user_state and pending-reminder indexes
+
+Revision ID: b2f8e61d4c95
+Revises: 9e4b7c2d1a60
+Create Date: 2026-10-16 11:48:33.902154
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b2f8e61d4c95'
+down_revision: Union[str, None] = '9e4b7c2d1a60'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (nombre, tabla, columnas, kwargs adicionales)
+INDEXES = (
+    ('ix_interactions_user_platform', 'interactions', ['user_wa_id', 'platform'], {}),
+    ('ix_user_states_stage_brand', 'user_states', ['stage', 'current_brand_id'], {}),
+    (
+        'ix_appointments_pending_reminders',
+        'appointments',
+        ['start_time'],
+        {'postgresql_where': sa.text('reminder_sent = false')},
+    ),
+)
+
+
+def _table_exists(table: str) -> bool:
+    # interactions y appointments se crean desde los modelos, no desde una migración previa.
+    return sa.inspect(op.get_bind()).has_table(table)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # CONCURRENTLY no puede ejecutarse dentro de una transacción.
+    with op.get_context().autocommit_block():
+        for name, table, columns, extra in INDEXES:
+            if not _table_exists(table):
+                continue
+            op.create_index(
+                name,
+                table,
+                columns,
+                unique=False,
+                postgresql_concurrently=True,
+                if_not_exists=True,
+                **extra,
+            )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        for name, table, _columns, _extra in reversed(INDEXES):
+            if not _table_exists(table):
+                continue
+            op.drop_index(
+                name,
+                table_name=table,
+                postgresql_concurrently=True,
+                if_exists=True,
+            )
@@ -0,0 +1,73 @@
+"""interaction metadata as jsonb with gin index
+
+Revision ID: d7a3c91e5f28
+Revises: b2f8e61d4c95
+Create Date: 2026-10-16 12:14:52.640117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd7a3c91e5f28'
+down_revision: Union[str, None] = 'b2f8e61d4c95'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+TABLE = 'interactions'
+INDEX_NAME = 'ix_interaction_metadata_gin'
+
+
+def _table_exists() -> bool:
+    # interactions se crea desde los modelos, no desde una migración previa.
+    return sa.inspect(op.get_bind()).has_table(TABLE)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    if not _table_exists():
+        return
+    op.alter_column(
+        TABLE,
+        'metadata',
+        type_=postgresql.JSONB(),
+        existing_type=sa.JSON(),
+        existing_nullable=False,
+        postgresql_using='metadata::jsonb',
+    )
+    # CONCURRENTLY no puede ejecutarse dentro de una transacción.
+    with op.get_context().autocommit_block():
+        op.create_index(
+            INDEX_NAME,
+            TABLE,
+            ['metadata'],
+            unique=False,
+            postgresql_using='gin',
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if not _table_exists():
+        return
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            INDEX_NAME,
+            table_name=TABLE,
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
+    op.alter_column(
+        TABLE,
+        'metadata',
+        type_=sa.JSON(),
+        existing_type=postgresql.JSONB(),
+        existing_nullable=False,
+        postgresql_using='metadata::json',
+    )
@@ -5,6 +5,7 @@ import logging
 import asyncio
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse
 from datetime import datetime, timezone
 
 # Información de diagnóstico para despliegue en contenedor
@@ -37,7 +38,7 @@ logger: logging.Logger
 if CONFIG_LOADED_SUCCESSFULLY and settings:
     try:
         # REFACTOR: El logger ahora se auto-configura al importarlo
-        from app.utils.logger import logger as main_app_logger, set_request_id, get_request_id, clear_request_id
+        from app.utils.logger import logger as main_app_logger, set_request_id, get_request_id
         logger = main_app_logger 
         logger.info(f"Logger principal '{logger.name}' configurado automáticamente. Nivel efectivo: {logging.getLevelName(logger.getEffectiveLevel())}.")
     except Exception as e_logger_setup:
@@ -167,6 +168,11 @@ async def lifespan(app_instance: FastAPI):
         logger.error(f"LIFESPAN: Error al inicializar el cliente HTTP para Meta API: {e}", exc_info=True)
         app_instance.state.meta_http_client = None
 
+    # Pool de workers para procesar mensajes de WhatsApp fuera del webhook
+    if settings and getattr(settings, 'WEBHOOK_WORKERS', 0) > 0:
+        from app.main.webhook_workers import start_webhook_workers
+        start_webhook_workers(settings.WEBHOOK_WORKERS, settings.WEBHOOK_QUEUE_MAXSIZE)
+
     logger.info(f"{'='*10} LIFESPAN: Aplicación Lista para servir ({ready_msg}) {'='*10}")
     
     yield  # La aplicación está en ejecución
@@ -194,6 +200,17 @@ async def lifespan(app_instance: FastAPI):
         except Exception as e:
             logger.error(f"LIFESPAN: Error al cerrar el cliente HTTP para {client_name}: {e}", exc_info=True)
     
+    # Detener los workers antes de cerrar los clientes HTTP y la base de datos que usan
+    try:
+        from app.main.webhook_workers import stop_webhook_workers
+        drain_timeout = getattr(settings, 'WEBHOOK_DRAIN_TIMEOUT', None)
+        if drain_timeout is None:
+            # Margen de 5s dentro del graceful_timeout de gunicorn para terminar los lotes en curso y cerrar clientes
+            drain_timeout = max(1, getattr(settings, 'GRACEFUL_TIMEOUT', 30) - 5)
+        await stop_webhook_workers(drain_timeout)
+    except Exception as e:
+        logger.error(f"LIFESPAN: Error al detener los workers de webhook: {e}", exc_info=True)
+
     # Cerrar todos los clientes HTTP del LLM a través del factory si existe
     if hasattr(app_instance.state, 'llm_client_factory') and app_instance.state.llm_client_factory is not None:
         try:
@@ -214,6 +231,8 @@ async def lifespan(app_instance: FastAPI):
     if hasattr(app_instance.state, 'meta_http_client') and app_instance.state.meta_http_client is not None:
         client = app_instance.state.meta_http_client
         app_instance.state.meta_http_client = None  # Eliminar referencia primero
+        from app.api.meta import release_meta_client
+        release_meta_client()
         await close_http_client_safely(client, "Meta API")
     
     # Cerrar la conexión a la base de datos si está activa
@@ -247,7 +266,8 @@ else:
         title=str(getattr(settings, 'PROJECT_NAME', 'ChatAPI')),  # Asegurar que sea string
         version=str(getattr(settings, 'PROJECT_VERSION', '0.1.0')),  # Asegurar que sea string
         lifespan=lifespan,
-        openapi_version="3.1.0"
+        openapi_version="3.1.0",
+        default_response_class=ORJSONResponse  # serialización con orjson (extensión C)
     )
     from fastapi.middleware.cors import CORSMiddleware
     
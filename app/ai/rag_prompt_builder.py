@@ -1,9 +1,12 @@
 import re
 from typing import List, Dict, Any, Optional, Union
 from unidecode import unidecode
+from jinja2 import Environment, Template
 from app.utils.logger import logger
 from app.ai.rag_retriever import search_relevant_documents, load_rag_components  # Importo para conectar con RAG
 
+_NON_ALNUM_LOWER_RE = re.compile(r'[^a-z0-9]')
+
 # Función auxiliar para normalizar nombres de marca para búsqueda
 def normalize_brand_name_for_search(name: str) -> str:
     """Normaliza un nombre de marca para búsqueda, eliminando todos los caracteres especiales
@@ -18,6 +21,11 @@ def normalize_brand_name_for_search(name: str) -> str:
     if not name:
         return ""
     
+    # Camino rápido: con entrada ASCII (el caso habitual) ni los reemplazos de caracteres
+    # especiales ni unidecode cambian nada, basta con pasar a minúsculas en C.
+    if name.isascii():
+        return _NON_ALNUM_LOWER_RE.sub('', name.lower())
+    
     # Pre-procesamiento manual para caracteres problemáticos comunes
     # Reemplazar caracteres especiales conocidos que podrían no ser manejados correctamente por unidecode
     name = name.replace('’', "'").replace('‘', "'")  # Comillas inteligentes
@@ -51,7 +59,7 @@ def normalize_brand_name_for_search(name: str) -> str:
         normalized = ''.join(c.lower() for c in name if c.isalnum() or c.isspace())
     
     # Eliminar caracteres especiales y espacios extras
-    normalized = re.sub(r'[^a-z0-9]', '', normalized)
+    normalized = _NON_ALNUM_LOWER_RE.sub('', normalized)
     
     return normalized
 
@@ -472,22 +480,22 @@ PROMPT_TEMPLATE = """
 - Nunca excedas 3 líneas en total - corta cualquier contenido adicional.
 
 **1. Tu Personaje:**
-- Actúas como: {persona_description}
-- Tu tono refleja: {tone_keywords}
-{user_greeting_line}
+- Actúas como: {{ persona_description }}
+- Tu tono refleja: {{ tone_keywords }}
+{{ user_greeting_line }}
 
 **Reglas para Saludos:**
-- Si `{user_greeting_line}` es un saludo completo (primer turno), úsalo para iniciar.
+- Si `{{ user_greeting_line }}` es un saludo completo (primer turno), úsalo para iniciar.
 - Si es una transición (turnos posteriores), úsala y responde directamente.
 - Nunca te reintroduzcas ni repitas el nombre de la marca salvo que sea esencial.
 
 **2. Objetivo y Estilo:**
 - Resuelve la consulta del usuario con MÁXIMA BREVEDAD, claridad y empatía, usando el contexto RAG.
-- **Longitud:** {response_length_guidance} (ULTRA-CONCISO: MÁXIMO 3 LÍNEAS CORTAS, prioriza brevedad absoluta).
+- **Longitud:** {{ response_length_guidance }} (ULTRA-CONCISO: MÁXIMO 3 LÍNEAS CORTAS, prioriza brevedad absoluta).
 - **CRÍTICO: LIMITA RESPUESTAS A 3 LÍNEAS COMO MÁXIMO** - Sé directo y ve al punto central.
 
 **3. Contexto RAG y RESTRICCIÓN ABSOLUTA DE INFORMACIÓN:**
-- **CRÍTICO - SOLO USA LA INFORMACIÓN EN {context}**
+- **CRÍTICO - SOLO USA LA INFORMACIÓN EN {{ context }}**
 - **NUNCA, BAJO NINGUNA CIRCUNSTANCIA, INVENTES, FALSIFIQUES O ASUMAS INFORMACIÓN no proporcionada explícitamente en el contexto**
 - **Unificación de fragmentos:** Busca conexiones entre diferentes fragmentos del contexto para proporcionar una respuesta coherente.
 - **Respuesta incompleta sobre ninguna fabricada:** Si el contexto solo cubre parte de la pregunta, RESPONDE SOLO ESA PARTE y admite que no tienes el resto de la información.
@@ -498,7 +506,7 @@ PROMPT_TEMPLATE = """
 - **Prohibido inferir fechas, cantidades, locaciones o cualquier dato verificable** que no esté explícito.
 
 **4. Manejo del Historial y Coherencia:**
-- **Historial:** Revisa {conversation_history} para mantener coherencia y no contradecirte.
+- **Historial:** Revisa {{ conversation_history }} para mantener coherencia y no contradecirte.
 - **Consistencia:** Si mencionaste un límite de información antes, manténlo en respuestas posteriores.
 
 **5. Respuestas a Preguntas Difíciles o Inciertas:**
@@ -513,17 +521,24 @@ PROMPT_TEMPLATE = """
 - **Naturalidad Concisa:** Habla como humano pero con economía total de palabras.
 
 **Contexto RAG (ÚNICA FUENTE DE INFORMACIÓN PERMITIDA):**
-{context}
+{{ context }}
 
 **Historial (más reciente primero):**
-{conversation_history}
+{{ conversation_history }}
 
 **Consulta del Usuario:**
-{user_query}
+{{ user_query }}
 
-**Tu Respuesta como {role_for_signature} (natural, empática, precisa y BASADA ÚNICAMENTE EN EL CONTEXTO):**
+**Tu Respuesta como {{ role_for_signature }} (natural, empática, precisa y BASADA ÚNICAMENTE EN EL CONTEXTO):**
 """
 
+# Plantilla compilada una sola vez al importar el módulo; cada llamada solo la renderiza.
+_PROMPT_ENV = Environment(autoescape=False, keep_trailing_newline=True)
+_COMPILED_PROMPT_TEMPLATE: Template = _PROMPT_ENV.from_string(PROMPT_TEMPLATE)
+
+# Colapsa líneas en blanco consecutivas del prompt renderizado
+_BLANK_LINES_RE = re.compile(r'\n\s*\n+')
+
 # --- Función para Construir el Prompt ---
 
 def build_rag_prompt(
@@ -708,7 +723,7 @@ def build_llm_prompt(
         role_for_signature = role_for_signature[:47] + "..."
     role_for_signature = role_for_signature or "Asistente"
 
-    prompt = PROMPT_TEMPLATE.format(
+    prompt = _COMPILED_PROMPT_TEMPLATE.render(
         persona_description=profile["persona_description"],
         tone_keywords=tone_keywords,
         user_greeting_line=user_greeting_line,
@@ -720,7 +735,7 @@ def build_llm_prompt(
         role_for_signature=role_for_signature
     )
 
-    prompt = re.sub(r'\n\s*\n+', '\n\n', prompt.strip())
+    prompt = _BLANK_LINES_RE.sub('\n\n', prompt.strip())
 
     try:
         if logger:
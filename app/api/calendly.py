@@ -1,12 +1,13 @@
 # app/api/calendly.py
 import httpx
 import json 
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from app.core.config import settings 
 from app.utils.logger import logger
 from datetime import datetime, date, timedelta, timezone
 import app.utils.validation_utils as local_validators # Para is_valid_email
 import locale
+import time
 import urllib.parse
 from fastapi import APIRouter
 
@@ -147,6 +148,11 @@ async def get_available_slots(
         logger.error(f"Error inesperado slots Calendly: {e_g}", exc_info=True)
         return None
 
+# Caché TTL de scheduling_url base por URI de tipo de evento: evita repetir la llamada a la
+# API de Calendly cada vez que un usuario vuelve a pedir agendar (nombre/email solo son query params).
+_SCHEDULING_LINK_TTL_SECONDS = 15 * 60
+_scheduling_base_link_cache: Dict[str, Tuple[str, float]] = {}
+
 async def get_scheduling_link(
     event_type_uri_from_settings: str, 
     name: Optional[str] = None,
@@ -158,12 +164,20 @@ async def get_scheduling_link(
         logger.error("get_scheduling_link: event_type_uri_from_settings no fue proporcionada.")
         return f"https://calendly.com/{settings.CALENDLY_USER_SLUG if settings and settings.CALENDLY_USER_SLUG else 'tu-usuario'}/#error-no-event-uri"
 
-    event_details = await get_event_type_details(event_type_uri_from_settings)
-    
     base_link: Optional[str] = None
-    if event_details and event_details.get("scheduling_url"):
-        base_link = event_details["scheduling_url"]
+    cached = _scheduling_base_link_cache.get(event_type_uri_from_settings)
+    if cached and cached[1] > time.monotonic():
+        base_link = cached[0]
+        logger.debug(f"Enlace base de scheduling recuperado de caché para: {event_type_uri_from_settings}")
     else:
+        event_details = await get_event_type_details(event_type_uri_from_settings)
+        if event_details and event_details.get("scheduling_url"):
+            base_link = event_details["scheduling_url"]
+            _scheduling_base_link_cache[event_type_uri_from_settings] = (
+                base_link, time.monotonic() + _SCHEDULING_LINK_TTL_SECONDS
+            )
+
+    if not base_link:
         logger.error(f"No se pudo obtener scheduling_url base para: {event_type_uri_from_settings}")
         user_slug = "tu_usuario_calendly" 
         if settings and hasattr(settings, 'CALENDLY_USER_SLUG') and settings.CALENDLY_USER_SLUG:
@@ -52,7 +52,7 @@ async def health_check(request: Request, db: AsyncSession = Depends(get_db_sessi
     
     # Si algo falla, devolvemos un código de error
     if final_status == "error":
-        from fastapi.responses import JSONResponse
-        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content=response_payload)
+        from fastapi.responses import ORJSONResponse
+        return ORJSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content=response_payload)
         
     return response_payload
@@ -3,11 +3,11 @@ import json
 import inspect
 import asyncio
 import contextlib
-from typing import Optional, List, Dict, Any, AsyncGenerator, Callable
+from typing import Optional, List, Dict, Any, AsyncGenerator, AsyncIterator, Callable
 from urllib.parse import urlparse # Para validación de URL
 
 # Imports para circuit breaker y caché
-from app.utils.resilience import async_circuit
+from app.utils.resilience import async_circuit, async_circuit_stream
 from app.core.cache import llm_cache
 
 # Imports para trazabilidad y observabilidad
@@ -557,6 +557,60 @@ async def generate_chat_completion(
         # Ya no es necesario cerrar el cliente aquí, eso lo maneja el código que lo creó
         pass
 
+def _split_prompt_into_messages(prompt_from_builder: str) -> Optional[List[Dict[str, str]]]:
+    """Separa el prompt de rag_prompt_builder en mensajes system/user para la API de chat.
+    
+    Devuelve None si el contenido del usuario queda vacío tras el parseo.
+    """
+    # Preparar el payload de mensajes (system y user)
+    system_content: str = ""
+    user_content: str = prompt_from_builder.strip() # Por defecto, todo el prompt es del usuario
+
+    # Intento de separar el prompt en "system" y "user" si los delimitadores están presentes
+    # Esto es específico para cómo `rag_prompt_builder` estructura el prompt.
+    # Asumimos que la parte "system" es todo ANTES de "**Pregunta del Usuario:**"
+    # y la parte "user" es todo DESPUÉS de "**Pregunta del Usuario:**" y ANTES de "**Tu Respuesta como...**"
+    
+    system_marker_end = "**Pregunta del Usuario:**" # Lo que sigue es la pregunta del usuario
+    user_marker_end = "**Tu Respuesta como" # Lo que sigue es donde el LLM debe empezar a escribir
+
+    try:
+        if system_marker_end in prompt_from_builder:
+            parts = prompt_from_builder.split(system_marker_end, 1)
+            system_content = parts[0].strip()
+            
+            # La parte del usuario está en parts[1], pero necesitamos quitar lo que viene después de la pregunta real.
+            if len(parts) > 1 and parts[1]:
+                user_part_full = parts[1].strip()
+                if user_marker_end in user_part_full:
+                    user_content = user_part_full.split(user_marker_end, 1)[0].strip()
+                else:
+                    user_content = user_part_full # Tomar todo si el marcador de respuesta no está
+            else: # No debería pasar si system_marker_end está, pero por si acaso
+                user_content = "" 
+            
+            logger.debug(f"  Prompt dividido: System content (len {len(system_content)}): '{system_content[:100]}...', User content (len {len(user_content)}): '{user_content[:100]}...'")
+        else:
+            logger.debug("  Delimitador para system content ('**Pregunta del Usuario:**') no encontrado. Todo el prompt se usará como 'user_content'.")
+            # system_content ya es "" y user_content es prompt_from_builder.strip()
+    except Exception as e_parse_prompt:
+        logger.warning(f"  Advertencia: Ocurrió un error al intentar parsear el prompt para system/user: {e_parse_prompt}. Se usará el prompt completo como user_content.", exc_info=True)
+        system_content = "" # Resetear por si acaso
+        user_content = prompt_from_builder.strip()
+
+
+    messages: List[Dict[str, str]] = []
+    if system_content: # Solo añadir system message si tiene contenido
+        messages.append({"role": "system", "content": system_content})
+    
+    if not user_content: # user_content no debería estar vacío después de la lógica anterior
+        logger.error(f"  Error Crítico: El contenido del usuario (user_content) está vacío después del parseo. Prompt original (preview): '{prompt_from_builder[:100]}...'")
+        return None
+        
+    messages.append({"role": "user", "content": user_content})
+    return messages
+
+
 @async_circuit
 async def get_llm_response(
     prompt_from_builder: str,
@@ -637,52 +691,11 @@ async def get_llm_response(
     # El cliente HTTP fue creado con los headers correctos en create_llm_client() y es inyectado aquí
     # Esto evita duplicidad de headers que puede causar problemas
 
-    # Preparar el payload de mensajes (system y user)
-    system_content: str = ""
-    user_content: str = prompt_from_builder.strip() # Por defecto, todo el prompt es del usuario
-
-    # Intento de separar el prompt en "system" y "user" si los delimitadores están presentes
-    # Esto es específico para cómo `rag_prompt_builder` estructura el prompt.
-    # Asumimos que la parte "system" es todo ANTES de "**Pregunta del Usuario:**"
-    # y la parte "user" es todo DESPUÉS de "**Pregunta del Usuario:**" y ANTES de "**Tu Respuesta como...**"
-    
-    system_marker_end = "**Pregunta del Usuario:**" # Lo que sigue es la pregunta del usuario
-    user_marker_end = "**Tu Respuesta como" # Lo que sigue es donde el LLM debe empezar a escribir
-
-    try:
-        if system_marker_end in prompt_from_builder:
-            parts = prompt_from_builder.split(system_marker_end, 1)
-            system_content = parts[0].strip()
-            
-            # La parte del usuario está en parts[1], pero necesitamos quitar lo que viene después de la pregunta real.
-            if len(parts) > 1 and parts[1]:
-                user_part_full = parts[1].strip()
-                if user_marker_end in user_part_full:
-                    user_content = user_part_full.split(user_marker_end, 1)[0].strip()
-                else:
-                    user_content = user_part_full # Tomar todo si el marcador de respuesta no está
-            else: # No debería pasar si system_marker_end está, pero por si acaso
-                user_content = "" 
-            
-            logger.debug(f"  Prompt dividido: System content (len {len(system_content)}): '{system_content[:100]}...', User content (len {len(user_content)}): '{user_content[:100]}...'")
-        else:
-            logger.debug("  Delimitador para system content ('**Pregunta del Usuario:**') no encontrado. Todo el prompt se usará como 'user_content'.")
-            # system_content ya es "" y user_content es prompt_from_builder.strip()
-    except Exception as e_parse_prompt:
-        logger.warning(f"  Advertencia: Ocurrió un error al intentar parsear el prompt para system/user: {e_parse_prompt}. Se usará el prompt completo como user_content.", exc_info=True)
-        system_content = "" # Resetear por si acaso
-        user_content = prompt_from_builder.strip()
-
-
-    messages: List[Dict[str, str]] = []
-    if system_content: # Solo añadir system message si tiene contenido
-        messages.append({"role": "system", "content": system_content})
-    
-    if not user_content: # user_content no debería estar vacío después de la lógica anterior
-        logger.error(f"  Error Crítico: El contenido del usuario (user_content) está vacío después del parseo. Prompt original (preview): '{prompt_from_builder[:100]}...'")
+    messages = _split_prompt_into_messages(prompt_from_builder)
+    if messages is None:
         return "Error interno: La pregunta del usuario resultó vacía después del procesamiento."
-        
-    messages.append({"role": "user", "content": user_content})
+    system_content = messages[0]["content"] if messages[0]["role"] == "system" else ""
+    user_content = messages[-1]["content"]
 
     # Obtener parámetros desde settings
     llm_temp = float(getattr(settings, 'LLM_TEMPERATURE', 0.7))
@@ -862,4 +875,83 @@ async def get_llm_response(
         
     except Exception as e_unexpected: # Captura cualquier otra excepción no prevista
         logger.error(f"  Error inesperado y no manejado en get_llm_response (OpenRouter): {e_unexpected}", exc_info=True)
-        return f"Error inesperado al comunicarse con el servicio LLM: {str(e_unexpected)[:200]}"
\ No newline at end of file
+        return f"Error inesperado al comunicarse con el servicio LLM: {str(e_unexpected)[:200]}"
+
+@async_circuit_stream
+async def get_llm_response_stream(
+    prompt_from_builder: str,
+    http_client: Optional[httpx.AsyncClient] = None
+) -> AsyncIterator[str]:
+    """
+    Variante en streaming de get_llm_response: envía la petición con "stream": True y
+    produce los fragmentos (delta.content) a medida que OpenRouter los genera (SSE).
+    
+    Si la respuesta ya está en caché se produce completa en un único fragmento, y al
+    terminar el stream el texto completo se guarda en caché igual que en get_llm_response.
+    Los errores HTTP/red se propagan al llamador, que decide si recurrir a get_llm_response.
+    Comparte el circuit breaker de get_llm_response: los fallos del stream también lo abren.
+    """
+    request_id_str = get_request_id() or "sin-request-id"
+
+    if not SETTINGS_LOADED or not settings:
+        raise ValueError("Configuración de la aplicación no disponible para el LLM.")
+
+    cache_key = llm_cache.key_for_prompt(prompt_from_builder)
+    cached_response = llm_cache.get(cache_key)
+    if cached_response:
+        logger.info(f"[{request_id_str}] Respuesta (stream) recuperada de caché. Evitando llamada a OpenRouter.")
+        yield cached_response
+        return
+
+    openrouter_model_id = getattr(settings, 'OPENROUTER_MODEL_CHAT', None)
+    if not getattr(settings, 'OPENROUTER_API_KEY', None) or not openrouter_model_id:
+        raise ValueError("OPENROUTER_API_KEY u OPENROUTER_MODEL_CHAT no configurados.")
+
+    messages = _split_prompt_into_messages(prompt_from_builder)
+    if messages is None:
+        raise ValueError("La pregunta del usuario resultó vacía después del procesamiento.")
+
+    payload = {
+        "model": openrouter_model_id,
+        "messages": messages,
+        "temperature": float(getattr(settings, 'LLM_TEMPERATURE', 0.7)),
+        "top_p": float(getattr(settings, 'LLM_TOP_P', 1.0)),
+        "frequency_penalty": float(getattr(settings, 'LLM_FREQUENCY_PENALTY', 0.0)),
+        "presence_penalty": float(getattr(settings, 'LLM_PRESENCE_PENALTY', 0.0)),
+        "max_tokens": int(getattr(settings, 'LLM_MAX_TOKENS', 1000)),
+        "stream": True
+    }
+    if request_id_str != "sin-request-id":
+        payload["user"] = f"req-{request_id_str}"
+        payload["metadata"] = {"request_id": request_id_str}
+
+    # Igual que get_llm_response, se usa siempre un cliente del factory (evita "Event loop is closed")
+    if http_client is not None:
+        logger.debug("LLM stream: Ignorando cliente HTTP proporcionado, se usa el factory")
+
+    logger.info(f"[{request_id_str}] Enviando solicitud en streaming a OpenRouter. Modelo: '{openrouter_model_id}'.")
+    chunks: List[str] = []
+    async with get_llm_client_factory().client_context() as safe_client:
+        async with safe_client.stream("POST", CHAT_COMPLETIONS_ENDPOINT_PATH, json=payload) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                # Las líneas que empiezan con ":" son comentarios SSE (keep-alive de OpenRouter)
+                if not line.startswith("data: "):
+                    continue
+                data = line[6:].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    choices = json.loads(data).get("choices") or []
+                except json.JSONDecodeError:
+                    logger.warning(f"[{request_id_str}] Fragmento SSE no decodificable ignorado: '{data[:100]}'")
+                    continue
+                delta = choices[0].get("delta", {}).get("content") if choices else None
+                if delta:
+                    chunks.append(delta)
+                    yield delta
+
+    full_text = "".join(chunks).strip()
+    if full_text:
+        llm_cache.set(cache_key, full_text)
+    logger.info(f"[{request_id_str}] Streaming de OpenRouter completado ({len(full_text)} caracteres).")
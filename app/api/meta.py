@@ -2,9 +2,13 @@
 # app/api/meta.py
 import httpx
 import json
+import logging
+import orjson
 import re
 import os
 import asyncio
+import random
+import time
 from fastapi import APIRouter, HTTPException, Request, Response, status, BackgroundTasks, Query, Depends
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Dict, Any
@@ -19,6 +23,56 @@ from app.utils.logger import logger
 token_manager = None
 http_client_meta = None
 
+# Límite de envíos simultáneos a la Graph API: protege el pool del cliente y el rate limit de Meta
+# cuando varios workers (y el streaming del LLM) envían a la vez
+_send_semaphore = asyncio.Semaphore(getattr(settings, 'WHATSAPP_MAX_CONCURRENT_SENDS', 50) if settings else 50)
+
+# Reintentos de envío: backoff exponencial (factor 2) con jitter, acotado a 5 s
+_SEND_MAX_RETRIES = 3
+_SEND_BACKOFF_INITIAL = 0.2
+_SEND_BACKOFF_MAX = 5.0
+_SEND_BACKOFF_JITTER = 0.25
+# Códigos de Meta que conviene reintentar: rate limit y errores transitorios del servidor
+_RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+
+class _TokenBucket:
+    """Token bucket asíncrono: como máximo `rate` envíos por segundo, con ráfagas de hasta `capacity`.
+    Una sola instancia por proceso, compartida por todos los workers y por el streaming del LLM."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = max(float(rate), 0.001)
+        self.capacity = capacity if capacity is not None else max(self.rate, 1.0)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        # El lock hace que los que esperan salgan en orden de llegada
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+_send_rate_limiter = _TokenBucket(getattr(settings, 'WHATSAPP_MAX_SENDS_PER_SECOND', 80.0) if settings else 80.0)
+
+
+def _send_backoff_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """Espera antes del reintento `attempt` (1-based); respeta Retry-After si Meta lo envía."""
+    if retry_after:
+        try:
+            return min(float(retry_after), _SEND_BACKOFF_MAX)
+        except ValueError:
+            pass
+    delay = min(_SEND_BACKOFF_INITIAL * (2 ** (attempt - 1)), _SEND_BACKOFF_MAX)
+    return delay + random.uniform(0, _SEND_BACKOFF_JITTER)
+
 class TokenManager:
     def __init__(self):
         self.token: Optional[str] = None
@@ -140,20 +194,47 @@ def create_meta_client():
     """
     # Configurar cliente HTTP para la API de Meta
     _BASE_URL_META_CLIENT = "https://graph.facebook.com"
-    _HTTP_TIMEOUT_META_CLIENT = 30.0
+    _HTTP_TIMEOUT_META_CLIENT = 10.0
     
     if settings and hasattr(settings, 'http_client_timeout'):
         _HTTP_TIMEOUT_META_CLIENT = float(settings.http_client_timeout)
     
+    # HTTP/2 + keep-alive: los envíos sucesivos (p.ej. flujo de agendamiento) se multiplexan
+    # sobre la misma conexión TLS en lugar de pagar un handshake por cada POST.
     meta_client = httpx.AsyncClient(
         base_url=f"{_BASE_URL_META_CLIENT}/{settings.META_API_VERSION}",
         timeout=_HTTP_TIMEOUT_META_CLIENT,
-        headers={"Content-Type": "application/json"}
+        headers={"Content-Type": "application/json"},
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
     )
     
-    logger.info(f"Cliente HTTP para Meta API creado. Base URL: {meta_client.base_url}")
+    # Registrar el cliente a nivel de módulo: los envíos desde tareas en segundo plano lo reutilizan
+    # sin tener que localizar el request en la pila de llamadas
+    global http_client_meta
+    http_client_meta = meta_client
+    
+    logger.info(f"Cliente HTTP/2 para Meta API creado. Base URL: {meta_client.base_url}")
     return meta_client
 
+def release_meta_client() -> None:
+    """Olvida la referencia global al cliente de Meta (el cierre lo hace el ciclo de vida de la app)."""
+    global http_client_meta
+    http_client_meta = None
+
+def _resolve_meta_client(
+    http_client: Optional[httpx.AsyncClient],
+    request: Optional[Request]
+) -> Optional[httpx.AsyncClient]:
+    """Devuelve el cliente de Meta a usar: el explícito, el de request.app.state o el global del módulo."""
+    if http_client is not None:
+        return http_client
+    if request is not None:
+        state_client = getattr(request.app.state, 'meta_http_client', None)
+        if state_client is not None:
+            return state_client
+    return http_client_meta
+
 # Inicializar solo el token_manager al importar el módulo
 # El cliente HTTP se inicializará en el lifespan de la app
 if settings:
@@ -230,23 +311,21 @@ async def receive_webhook_events(
     logger.info("META POST /webhook: Solicitud de mensaje entrante recibida.")
     
     try:
-        # Leer el payload del request
+        # Leer el cuerpo una sola vez y parsearlo con orjson (extensión C) en lugar de request.json()
         try:
-            payload_dict = await request.json()
-            # Loguear solo una parte del payload para no llenar los logs
-            logger.debug(f"  Payload JSON recibido (preview): {json.dumps(payload_dict, indent=2, ensure_ascii=False)[:1000]}...")
-        except json.JSONDecodeError as json_err:
-            raw_body_content = "No se pudo leer el cuerpo crudo."
-            try:
-                raw_body_bytes = await request.body()
-                raw_body_content = raw_body_bytes.decode(errors='replace')[:500] # Preview del cuerpo crudo
-            except Exception as body_read_err:
-                logger.debug(f"  Error adicional al intentar leer el cuerpo crudo: {body_read_err}")
-            logger.error(f"Error al parsear JSON del webhook: {json_err}. Cuerpo crudo (preview): {raw_body_content}", exc_info=True)
-            raise HTTPException(status_code=400, detail=f"Payload JSON inválido: {str(json_err)}")
+            raw_body_bytes = await request.body()
         except Exception as e_read_req:
-            logger.error(f"Error inesperado al obtener JSON del request: {e_read_req}", exc_info=True)
+            logger.error(f"Error inesperado al leer el cuerpo del request: {e_read_req}", exc_info=True)
             raise HTTPException(status_code=400, detail="Error al leer el cuerpo de la solicitud.")
+        try:
+            payload_dict = orjson.loads(raw_body_bytes)
+        except orjson.JSONDecodeError as json_err:
+            raw_body_content = raw_body_bytes.decode(errors='replace')[:500] # Preview del cuerpo crudo
+            logger.error(f"Error al parsear JSON del webhook: {json_err}. Cuerpo crudo (preview): {raw_body_content}", exc_info=True)
+            raise HTTPException(status_code=400, detail=f"Payload JSON inválido: {str(json_err)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            # Loguear solo una parte del payload para no llenar los logs
+            logger.debug("  Payload JSON recibido (preview): %s...", raw_body_bytes[:1000].decode(errors='replace'))
 
         # Validación básica del payload
         if not isinstance(payload_dict, dict) or 'object' not in payload_dict:
@@ -294,33 +373,11 @@ async def send_whatsapp_message(
     to: str, 
     message_payload: Union[str, Dict[str, Any]],
     interactive_buttons: Optional[List[Dict[str, Any]]] = None,
-    request: Optional[Request] = None
+    request: Optional[Request] = None,
+    http_client: Optional[httpx.AsyncClient] = None
 ) -> Optional[Dict[str, Any]]:
-    # Obtener el cliente HTTP desde el contexto actual
-    http_client = None
-    
-    # Intentar obtener el cliente HTTP desde el request si está disponible
-    if request and hasattr(request.app.state, 'meta_http_client'):
-        http_client = request.app.state.meta_http_client
-    
-    # Si no tenemos request o el cliente no está en el estado, intentar obtenerlo desde contexto actual
-    if http_client is None:
-        # Intentar obtener el contexto actual si estamos en un endpoint FastAPI
-        try:
-            from fastapi import Request
-            from starlette.concurrency import iterate_in_threadpool
-            import inspect
-            
-            # Buscar el request en la pila de llamadas
-            frame = inspect.currentframe()
-            while frame:
-                if 'request' in frame.f_locals and isinstance(frame.f_locals['request'], Request):
-                    if hasattr(frame.f_locals['request'].app.state, 'meta_http_client'):
-                        http_client = frame.f_locals['request'].app.state.meta_http_client
-                        break
-                frame = frame.f_back
-        except Exception as e:
-            logger.debug(f"No se pudo obtener el request actual: {e}")
+    # Cliente HTTP compartido (keep-alive + HTTP/2); nunca se crea uno por envío
+    http_client = _resolve_meta_client(http_client, request)
     
     # Si después de todo no tenemos cliente, reportar error
     if http_client is None:
@@ -368,7 +425,7 @@ async def send_whatsapp_message(
                             (message_payload.get("text", "Se produjo un error al mostrar las opciones.") if isinstance(message_payload, dict) else "Error.")
             # Evitar recursión infinita si message_payload es complejo y no string/dict con text
             if isinstance(text_fallback, str):
-                return await send_whatsapp_message(to, text_fallback) 
+                return await send_whatsapp_message(to, text_fallback, http_client=http_client) 
             else:
                 logger.error("Fallback a texto simple falló porque el payload no es string/dict con 'text'. No se envía mensaje.")
                 return {"error": True, "status_code": "PAYLOAD_ERROR", "details": "Invalid payload for text fallback."}
@@ -397,9 +454,8 @@ async def send_whatsapp_message(
     logger.debug(f"Enviando POST a Meta API. Path con versión: {url_path}")
     logger.debug(f"Payload de WhatsApp a enviar: {json.dumps(data_to_send, ensure_ascii=False, indent=2)}")
 
-    # Implementar reintentos para errores de red
-    max_retries = 3
-    retry_delay = 1  # segundos
+    # Reintentos con backoff para errores de red, 429 y 5xx
+    max_retries = _SEND_MAX_RETRIES
     last_exception = None
     
     try:
@@ -407,7 +463,9 @@ async def send_whatsapp_message(
             try:
                 # Intento de envío
                 logger.debug(f"Intento {attempt}/{max_retries} de envío a Meta API")
-                response = await http_client.post(url_path, headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}, json=data_to_send)
+                await _send_rate_limiter.acquire()
+                async with _send_semaphore:
+                    response = await http_client.post(url_path, headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}, json=data_to_send)
                 
                 # Loguear siempre la respuesta de Meta, incluso si no es un error de status
                 response_status = response.status_code
@@ -431,6 +489,11 @@ async def send_whatsapp_message(
                     return {"error": False, "status_code": response_status, "details": "Success status but invalid JSON response from Meta.", "raw_response": response_content_text}
 
             except httpx.HTTPStatusError as e_status:
+                if e_status.response.status_code in _RETRYABLE_STATUS_CODES and attempt < max_retries:
+                    retry_delay = _send_backoff_delay(attempt, e_status.response.headers.get("Retry-After"))
+                    logger.warning(f"Meta respondió {e_status.response.status_code} al enviar a {recipient_waid} (intento {attempt}/{max_retries}). Reintentando en {retry_delay:.2f}s...")
+                    await asyncio.sleep(retry_delay)
+                    continue
                 # El cuerpo del error ya fue logueado arriba si response_content_text se leyó
                 logger.error(f"Error HTTP ({e_status.response.status_code}) al enviar mensaje de WhatsApp a {recipient_waid}. URL: {e_status.request.url}.")
                 
@@ -454,10 +517,9 @@ async def send_whatsapp_message(
                 last_exception = e_req
                 # Si no es el último intento, reintentamos
                 if attempt < max_retries:
-                    logger.warning(f"Error de red al enviar mensaje de WhatsApp a {recipient_waid} (intento {attempt}/{max_retries}): {e_req}. Reintentando en {retry_delay}s...")
+                    retry_delay = _send_backoff_delay(attempt)
+                    logger.warning(f"Error de red al enviar mensaje de WhatsApp a {recipient_waid} (intento {attempt}/{max_retries}): {e_req}. Reintentando en {retry_delay:.2f}s...")
                     await asyncio.sleep(retry_delay)
-                    # Incrementar el delay para el próximo reintento (backoff exponencial)
-                    retry_delay *= 2
                 else:
                     # Si hemos agotado los reintentos, logueamos el error final
                     logger.error(f"Error de red al enviar mensaje de WhatsApp a {recipient_waid} después de {max_retries} intentos: {e_req}", exc_info=True)
@@ -472,32 +534,11 @@ async def send_messenger_message(
     recipient_id: str,
     message_text: str,
     quick_replies: Optional[List[Dict[str, Any]]] = None,
-    request: Optional[Request] = None
+    request: Optional[Request] = None,
+    http_client: Optional[httpx.AsyncClient] = None
 ) -> Optional[Dict[str, Any]]:
-    # Obtener el cliente HTTP desde el contexto actual
-    http_client = None
-    
-    # Intentar obtener el cliente HTTP desde el request si está disponible
-    if request and hasattr(request.app.state, 'meta_http_client'):
-        http_client = request.app.state.meta_http_client
-    
-    # Si no tenemos request o el cliente no está en el estado, intentar obtenerlo desde contexto actual
-    if http_client is None:
-        # Intentar obtener el contexto actual si estamos en un endpoint FastAPI
-        try:
-            from fastapi import Request
-            import inspect
-            
-            # Buscar el request en la pila de llamadas
-            frame = inspect.currentframe()
-            while frame:
-                if 'request' in frame.f_locals and isinstance(frame.f_locals['request'], Request):
-                    if hasattr(frame.f_locals['request'].app.state, 'meta_http_client'):
-                        http_client = frame.f_locals['request'].app.state.meta_http_client
-                        break
-                frame = frame.f_back
-        except Exception as e:
-            logger.debug(f"No se pudo obtener el request actual: {e}")
+    # Cliente HTTP compartido del módulo o del estado de la app
+    http_client = _resolve_meta_client(http_client, request)
     
     # Si después de todo no tenemos cliente, reportar error
     if http_client is None:
@@ -35,9 +35,11 @@ class Settings(BaseSettings):
     # --- Configuración del Servidor y Entorno ---
     ENVIRONMENT: str = "development"
     DEBUG: bool = False
+    DEBUG_RAG_STATE_VERIFY: bool = False  # Releer UserState tras la transición a RAG solo para diagnóstico (SELECT extra)
     LOG_LEVEL: str = "INFO"
     # FIX: Re-introducido para compatibilidad con el módulo de logging
     LOG_FORMAT: str = '%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s'
+    LOG_BUFFER: int = 512  # Registros acumulados en memoria antes de escribir al archivo (ERROR o superior vacía al instante)
     SERVER_HOST: str = "0.0.0.0"
     SERVER_PORT: int = 8000
     PROJECT_SITE_URL: str = "http://localhost:8000"
@@ -46,6 +48,14 @@ class Settings(BaseSettings):
     # Pydantic validará la URL y la mantendrá como un objeto DSN.
     # La conversión a string se hará en database.py.
     DATABASE_URL: PostgresDsn
+    # Pool de conexiones: LIFO reutiliza la conexión más reciente y deja que las ociosas expiren.
+    # Los valores son POR PROCESO: WORKERS de gunicorn × (POOL_SIZE + MAX_OVERFLOW)
+    # debe quedar por debajo de max_connections del servidor Postgres.
+    DATABASE_POOL_SIZE: int = 5
+    DATABASE_MAX_OVERFLOW: int = 5
+    DATABASE_POOL_TIMEOUT: int = 30  # Segundos de espera por una conexión libre
+    DATABASE_POOL_RECYCLE: int = 1800  # Reciclar conexiones cada 30 minutos
+    DATABASE_POOL_USE_LIFO: bool = True
 
     # --- IA: RAG, Embeddings y PGVector ---
     EMBEDDING_MODEL_NAME: str = "sentence-transformers/all-mpnet-base-v2"
@@ -99,6 +109,14 @@ class Settings(BaseSettings):
     LLM_TOP_P: float = 1.0  # Nuevo parámetro
     LLM_FREQUENCY_PENALTY: float = 0.0  # Nuevo parámetro
     LLM_PRESENCE_PENALTY: float = 0.0  # Nuevo parámetro
+    WEBHOOK_WORKERS: int = 8  # Workers que consumen los mensajes encolados por el webhook (0 = procesar en línea)
+    WEBHOOK_QUEUE_MAXSIZE: int = 1000  # Lotes pendientes máximos entre todas las colas
+    GRACEFUL_TIMEOUT: int = 30  # Mismo valor que graceful_timeout de gunicorn (gunicorn.conf.py)
+    WEBHOOK_DRAIN_TIMEOUT: Optional[float] = None  # Espera al apagar para vaciar las colas (None = GRACEFUL_TIMEOUT - 5s)
+    WHATSAPP_MAX_CONCURRENT_SENDS: int = 50  # POST simultáneos máximos a la Graph API
+    WHATSAPP_MAX_SENDS_PER_SECOND: float = 80.0  # Token bucket de envíos salientes (tier base de Meta: 80 mps)
+    LLM_STREAMING_ENABLED: bool = True  # Enviar la respuesta RAG por párrafos mientras se genera
+    LLM_STREAM_MIN_CHUNK_CHARS: int = 400  # Tamaño mínimo de cada bloque enviado por WhatsApp
     
     # --- Palabras clave para salir de la conversación ---
     EXIT_CONVERSATION_KEYWORDS: List[str] = ["salir", "adiós", "cancelar", "terminar", "stop", "chao", "bye", "hasta luego"]
@@ -42,6 +42,12 @@ def get_db_engine() -> Optional[AsyncEngine]:
     """
     return _engine
 
+def get_session_factory() -> Optional[async_sessionmaker[AsyncSession]]:
+    """Devuelve la fábrica de sesiones inicializada o None si la base de datos no está lista.
+    Útil para tareas en segundo plano que necesitan abrir su propia sesión.
+    """
+    return _session_maker
+
 # --- Configuración de logging independiente de la aplicación ---
 _db_logger = logging.getLogger("database")
 if not _db_logger.handlers:
@@ -103,7 +109,12 @@ async def initialize_database() -> bool:
     engine_options: Dict[str, Any] = {
         "echo": getattr(settings, 'SQL_ECHO', False),
         "pool_pre_ping": True,
-        "pool_recycle": 3600,  # Recicla conexiones cada hora
+        "pool_recycle": getattr(settings, 'DATABASE_POOL_RECYCLE', 1800),
+        "pool_size": getattr(settings, 'DATABASE_POOL_SIZE', 5),
+        "max_overflow": getattr(settings, 'DATABASE_MAX_OVERFLOW', 5),
+        "pool_timeout": getattr(settings, 'DATABASE_POOL_TIMEOUT', 30),
+        # LIFO: bajo carga se reutilizan las conexiones "calientes" y las sobrantes quedan ociosas hasta reciclarse
+        "pool_use_lifo": getattr(settings, 'DATABASE_POOL_USE_LIFO', True),
         "json_serializer": lambda obj: json.dumps(obj, ensure_ascii=False)
     }
     
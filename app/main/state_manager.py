@@ -2,6 +2,7 @@
 import asyncio
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from sqlalchemy import func
 from sqlalchemy.orm import selectinload
 from typing import List, Optional, Dict, Any, Tuple
 from datetime import datetime, timezone, timedelta # timedelta para expiración de caché
@@ -12,6 +13,7 @@ from app.models.company_models import Company
 from app.models.interaction_models import Interaction
 from app.models.appointment_models import Appointment
 from app.utils.logger import logger
+from app.core.config import settings
 
 # --- Constantes de Estados ---
 STAGE_SELECTING_BRAND = "selecting_brand"
@@ -26,12 +28,38 @@ STAGE_COLLECTING_PHONE = "collecting_phone"
 STAGE_COLLECTING_PURPOSE = "collecting_purpose"
 
 # --- Caché de Compañías ---
+# Las compañías casi nunca cambian: se cargan todas juntas y se indexan en memoria por id y por
+# nombre/alias, de modo que resolver current_brand_id en cada mensaje no toca la base de datos.
 _company_cache: Optional[List[Company]] = None
+_company_by_id: Dict[int, Company] = {}
+_company_id_by_name: Dict[str, int] = {}  # nombre en minúsculas y alias comunes -> id
 _cache_last_loaded_at: Optional[datetime] = None
-_CACHE_EXPIRATION_MINUTES = 60
+_CACHE_EXPIRATION_MINUTES = 10
+_company_cache_lock = asyncio.Lock()
 
-async def get_all_companies(session: AsyncSession, use_cache: bool = True, force_reload_cache: bool = False) -> List[Company]:
+def _build_company_name_index(companies: List[Company]) -> Dict[str, int]:
+    """Construye el mapa nombre/alias -> id usado en la selección de marca."""
+    company_map: Dict[str, int] = {comp.name.lower(): comp.id for comp in companies}
+    # Añadir alias comunes
+    for comp in companies:
+        name_lower = comp.name.lower()
+        if "fundaci" in name_lower: company_map["fundacion"] = comp.id
+        if "ehecatl" in name_lower: company_map["ehecatl"] = comp.id
+        if "bazan" in name_lower: company_map["bazan"] = comp.id; company_map["javier bazan"] = comp.id
+        if "udd" in name_lower: company_map["udd"] = comp.id; company_map["universidad"] = comp.id
+        if "fes" in name_lower: company_map["fes"] = comp.id; company_map["frente"] = comp.id
+    return company_map
+
+def invalidate_company_cache() -> None:
+    """Descarta la caché de compañías; la siguiente lectura recarga desde la DB.
+    Llamar después de crear, renombrar o eliminar una compañía."""
     global _company_cache, _cache_last_loaded_at
+    _company_cache = None
+    _cache_last_loaded_at = None
+    logger.info("Caché de compañías invalidada.")
+
+async def get_all_companies(session: AsyncSession, use_cache: bool = True, force_reload_cache: bool = False) -> List[Company]:
+    global _company_cache, _company_by_id, _company_id_by_name, _cache_last_loaded_at
     
     now = datetime.now(timezone.utc)
     cache_expired = False
@@ -48,18 +76,23 @@ async def get_all_companies(session: AsyncSession, use_cache: bool = True, force
         logger.debug("Usando caché de compañías.")
         return _company_cache
 
-    logger.info("Consultando compañías desde la DB...")
-    stmt = select(Company).order_by(Company.id)
-    result = await session.execute(stmt)
-    companies_from_db = list(result.scalars().all())
-    
-    if companies_from_db:
+    # Un solo SELECT aunque varios mensajes concurrentes encuentren la caché vacía
+    async with _company_cache_lock:
+        if use_cache and _company_cache is not None:
+            return _company_cache
+
+        logger.info("Consultando compañías desde la DB...")
+        stmt = select(Company).order_by(Company.id)
+        result = await session.execute(stmt)
+        companies_from_db = list(result.scalars().all())
+        
+        if companies_from_db:
+            logger.info(f"Se cargaron {len(companies_from_db)} compañías y se almacenaron en caché.")
+        else:
+            logger.warning("No se encontraron compañías en la DB.")
         _company_cache = companies_from_db
-        _cache_last_loaded_at = now
-        logger.info(f"Se cargaron {len(companies_from_db)} compañías y se almacenaron en caché.")
-    else:
-        logger.warning("No se encontraron compañías en la DB.")
-        _company_cache = []
+        _company_by_id = {comp.id: comp for comp in companies_from_db}
+        _company_id_by_name = _build_company_name_index(companies_from_db)
         _cache_last_loaded_at = now
         
     return _company_cache
@@ -67,10 +100,9 @@ async def get_all_companies(session: AsyncSession, use_cache: bool = True, force
 async def get_company_by_id(session: AsyncSession, company_id: Optional[int]) -> Optional[Company]:
     if company_id is None: return None
     await get_all_companies(session) # Asegura que caché esté poblada/fresca
-    if _company_cache:
-        for company_obj_cache in _company_cache:
-            if company_obj_cache.id == company_id:
-                 return company_obj_cache
+    company_obj_cache = _company_by_id.get(company_id)
+    if company_obj_cache is not None:
+        return company_obj_cache
     
     company_obj_db = await session.get(Company, company_id)
     if not company_obj_db: logger.warning(f"Compañía ID {company_id} NO encontrada en DB.")
@@ -93,15 +125,8 @@ async def get_company_id_by_selection(session: AsyncSession, user_input: str) ->
                 return companies[option_number - 1].id
         except ValueError: pass
 
-    company_map: Dict[str, int] = {comp.name.lower(): comp.id for comp in companies}
-    # Añadir alias comunes
-    for comp in companies:
-        name_lower = comp.name.lower()
-        if "fundaci" in name_lower: company_map["fundacion"] = comp.id
-        if "ehecatl" in name_lower: company_map["ehecatl"] = comp.id
-        if "bazan" in name_lower: company_map["bazan"] = comp.id; company_map["javier bazan"] = comp.id
-        if "udd" in name_lower: company_map["udd"] = comp.id; company_map["universidad"] = comp.id
-        if "fes" in name_lower: company_map["fes"] = comp.id; company_map["frente"] = comp.id
+    # Mapa nombre/alias -> id precalculado al cargar la caché
+    company_map = _company_id_by_name
     
     # Buscar coincidencias con emojis numéricos (1️⃣, 2️⃣, etc.)
     number_emojis = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣", "🔟"]
@@ -186,7 +211,8 @@ async def update_user_state_db(db_session: AsyncSession, user_state_obj: UserSta
         else:
             logger.warning(f"Intento de actualizar campo inexistente '{key}' en UserState para {user_key}.")
     
-    user_state_obj.last_interaction_at = datetime.now(timezone.utc) # Asegurar que onupdate funcione o actualizar manualmente
+    # Timestamp resuelto por PostgreSQL (NOW()) al hacer flush: sin reloj de la app ni objeto datetime
+    user_state_obj.last_interaction_at = func.now()
     
     try:
         # Asegurar que obtenemos la referencia más reciente desde la DB
@@ -197,7 +223,7 @@ async def update_user_state_db(db_session: AsyncSession, user_state_obj: UserSta
             for key, value in updates.items():
                 if hasattr(db_user_state, key):
                     setattr(db_user_state, key, value)
-            db_user_state.last_interaction_at = user_state_obj.last_interaction_at
+            db_user_state.last_interaction_at = func.now()
             
             # Marcar ambos objetos para actualización
             db_session.add(db_user_state)
@@ -215,7 +241,7 @@ async def update_user_state_db(db_session: AsyncSession, user_state_obj: UserSta
             logger.info(f"UserState {user_key} actualizado y guardado en DB con: {updated_fields_log}")
             
             # Verificación adicional de diagnóstico
-            if "stage" in updates and updates["stage"] == STAGE_MAIN_CHAT_RAG:
+            if settings.DEBUG_RAG_STATE_VERIFY and updates.get("stage") == STAGE_MAIN_CHAT_RAG:
                 # Verificar que el cambio a RAG se haya guardado correctamente
                 verification = await db_session.get(UserState, (user_state_obj.user_id, user_state_obj.platform))
                 if verification and verification.stage == STAGE_MAIN_CHAT_RAG:
@@ -233,7 +259,13 @@ async def update_user_state_db(db_session: AsyncSession, user_state_obj: UserSta
     if updates.get("stage") == STAGE_SELECTING_BRAND:
         await clear_conversation_history(db_session, user_state_obj.user_id, user_state_obj.platform)
 
-async def reset_user_to_brand_selection(db_session: AsyncSession, user_state_obj: UserState, force: bool = False):
+async def reset_user_to_brand_selection(
+    db_session: AsyncSession,
+    user_state_obj: UserState,
+    force: bool = False,
+    extra_fields: Optional[Dict[str, Any]] = None,
+    delete_last_user_msg: bool = False
+):
     """
     🔄 ¡Vuelta a empezar! Devuelve al usuario al menú de selección inicial.
     
@@ -242,6 +274,9 @@ async def reset_user_to_brand_selection(db_session: AsyncSession, user_state_obj
         user_state_obj: El perfil de usuario que recibirá un refrescante nuevo comienzo
         force: Un poder especial que mantenemos por compatibilidad, aunque ahora la magia
                del reinicio ocurre siempre, independientemente de dónde se encuentre el usuario
+        extra_fields: Campos adicionales que se guardan en la misma actualización (tienen prioridad
+                      sobre los valores del reseteo, p.ej. {"session_explicitly_ended": True})
+        delete_last_user_msg: Si es True, quita también el último mensaje del usuario del historial
     """
     # CORRECCIÓN: Eliminada la restricción que impedía reiniciar cuando el usuario está en RAG
     # Ahora el comando "Salir" siempre permitirá volver al menú de selección de marca
@@ -265,6 +300,11 @@ async def reset_user_to_brand_selection(db_session: AsyncSession, user_state_obj
         "conversation_history": "[]",  # Explícitamente limpiar el historial de conversación
         # No resetear collected_name, email, phone, o is_subscribed aquí por defecto
     }
+    if extra_fields:
+        fields_to_reset.update(extra_fields)
+    if delete_last_user_msg:
+        await remove_last_user_message_from_history(db_session, user_state_obj.user_id, user_state_obj.platform)
+    # Un único UPDATE + commit para el reseteo y los campos adicionales
     await update_user_state_db(db_session, user_state_obj, fields_to_reset)
     # clear_conversation_history ya se llama dentro de update_user_state_db si stage es STAGE_SELECTING_BRAND
     logger.info(f"UserState {user_state_obj.platform}:{user_state_obj.user_id} reseteado a selección de marca.")
@@ -407,7 +447,7 @@ async def get_company_selection_message(db_session: AsyncSession, user_state_obj
     body_message = "Soy tu enlace directo con nuestras plataformas de innovación y desarrollo. Mi propósito es ser el catalizador de tus objetivos. 🧠\n\n¿Qué motor de crecimiento te gustaría activar hoy?"
     
     # Obtener las empresas de la base de datos
-    companies = await get_all_companies(db_session, force_reload_cache=True)
+    companies = await get_all_companies(db_session)
     
     if not companies:
         return "¡Ups! 😅 Parece que nuestras opciones están tomando un descanso ahora mismo. Por favor, inténtalo de nuevo más tarde."
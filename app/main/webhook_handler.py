@@ -1,8 +1,16 @@
 # app/main/webhook_handler.py
 from __future__ import annotations
 
+import asyncio
+import itertools
+import logging
+import os
+import random
+import secrets
 import re
+import time
 import httpx
+from collections import OrderedDict
 
 # Palabras para detección de contenido inapropiado
 INAPPROPRIATE_WORDS = [
@@ -39,34 +47,48 @@ CONTACT_INFO_KEYWORDS = {
     "donde puedo encontrarlos", "dónde puedo encontrarlos", "manera de contactar"
 }
 
-def _contains_contact_info_keywords(text: str) -> bool:
-    """Detecta si el texto contiene palabras clave relacionadas con solicitud de información de contacto."""
-    text_normalized = text.lower()
-    
+def _compile_keyword_pattern(keywords) -> "re.Pattern[str]":
+    """Compila un conjunto de palabras clave en una sola alternancia (coincidencia por subcadena)."""
+    return re.compile("|".join(re.escape(keyword) for keyword in sorted(keywords, key=len, reverse=True)))
+
+# Patrones compilados una sola vez: un único barrido en C por mensaje en lugar de un any() por palabra
+_CONTACT_INFO_RE = _compile_keyword_pattern(CONTACT_INFO_KEYWORDS)
+
+# Patrones de frases comunes para solicitar contacto
+_CONTACT_PHRASES_RE = re.compile("|".join([
+    "como (te|los|les) (puedo )?contact",  # Cómo los contacto, cómo te puedo contactar, etc.
+    "(datos|informacion|información) (de |para )?contacto",
+    "(medio|forma|manera) (de |para )?contact",
+    "(quiero|necesito|me gustaria|me gustaría) contacta",
+    "(como|cómo) (puedo )?(comunicarme|contactar)"
+]))
+
+def _contains_contact_info_keywords(text_normalized: str) -> bool:
+    """Detecta si el texto (ya en minúsculas) contiene palabras clave de solicitud de información de contacto."""
     # Buscar coincidencias exactas de palabras clave
-    if any(keyword in text_normalized for keyword in CONTACT_INFO_KEYWORDS):
+    if _CONTACT_INFO_RE.search(text_normalized):
         return True
     
-    # Patrones de frases comunes para solicitar contacto
-    contact_phrases = [
-        "como (te|los|les) (puedo )?contact",  # Cómo los contacto, cómo te puedo contactar, etc.
-        "(datos|informacion|información) (de |para )?contacto",
-        "(medio|forma|manera) (de |para )?contact",
-        "(quiero|necesito|me gustaria|me gustaría) contacta",
-        "(como|cómo) (puedo )?(comunicarme|contactar)"
-    ]
-    
-    # Buscar patrones usando expresiones regulares
-    for pattern in contact_phrases:
-        if re.search(pattern, text_normalized):
-            return True
-            
-    return False
-
-def _contains_scheduling_keywords(text: str) -> bool:
-    """Detecta si el texto contiene palabras clave relacionadas con agendamiento."""
-    text_normalized = text.lower()
-    return any(keyword in text_normalized for keyword in SCHEDULING_KEYWORDS)
+    # Buscar frases comunes usando expresiones regulares
+    return _CONTACT_PHRASES_RE.search(text_normalized) is not None
+
+# Raíces que reconoce detect_scheduling_intent ("agend" incluye "agendar", "hora" incluye
+# "horario", "disponible" incluye "disponibilidad").
+_SCHEDULING_HINTS = frozenset({
+    "agend", "cita", "reunion", "reunión", "calendario", "visita", "programar",
+    "reservar", "consulta", "entrevista", "hora", "disponible"
+})
+# Unión de SCHEDULING_KEYWORDS y las raíces de detect_scheduling_intent: un solo barrido en el chat RAG
+_MAIN_CHAT_SCHEDULING_RE = _compile_keyword_pattern(SCHEDULING_KEYWORDS | _SCHEDULING_HINTS)
+
+_INAPPROPRIATE_WORDS_RE = _compile_keyword_pattern(INAPPROPRIATE_WORDS)
+# Frases de frustración
+_FRUSTRATION_RE = re.compile("|".join([
+    r"\bque (?:mal|pesimo|horrible)\b",
+    r"\bno (?:sirves|funciona|entiendes?)\b",
+    r"\best[aá]s (?:mal|equivocad[oa]|confundid[oa])\b",
+    r"\beres (?:un[ao]? )?(?:ton|idiot|estupid|inutil)"
+]))
 
 def contains_inappropriate_content(text: str) -> bool:
     """
@@ -80,24 +102,11 @@ def contains_inappropriate_content(text: str) -> bool:
     """
     text_lower = text.lower()
     
-    # Verificar insultos directos
-    for word in INAPPROPRIATE_WORDS:
-        if word in text_lower:
-            return True
-            
-    # Verificar frases de frustración
-    frustration_patterns = [
-        r"\bque (?:mal|pesimo|horrible)\b",
-        r"\bno (?:sirves|funciona|entiendes?)\b",
-        r"\best[aá]s (?:mal|equivocad[oa]|confundid[oa])\b",
-        r"\beres (?:un[ao]? )?(?:ton|idiot|estupid|inutil)"
-    ]
-    
-    for pattern in frustration_patterns:
-        if re.search(pattern, text_lower):
-            return True
-    
-    return False
+    # Verificar insultos directos y frases de frustración
+    return (
+        _INAPPROPRIATE_WORDS_RE.search(text_lower) is not None
+        or _FRUSTRATION_RE.search(text_lower) is not None
+    )
 
 # FIX: Cambiado de importación relativa a absoluta para mayor robustez en Docker
 # Import state constants from state_manager
@@ -113,7 +122,8 @@ from app.main.state_manager import (
     STAGE_COLLECTING_PURPOSE,
     remove_last_user_message_from_history
 )
-from typing import Dict, Any, Optional, List, Union, Set, TYPE_CHECKING
+from typing import Dict, Any, Optional, List, Tuple, Union, Set, Callable, Awaitable, TYPE_CHECKING
+from dataclasses import dataclass
 from datetime import date, timedelta, datetime, timezone
 from unidecode import unidecode
 
@@ -138,6 +148,68 @@ if TYPE_CHECKING:
 # Conjunto para rastrear usuarios en transición al flujo RAG
 _pending_rag_transitions = set()
 
+# Respuestas naturales y útiles cuando no se encuentra información específica ({brand} = nombre de la marca)
+_NO_CONTEXT_TEMPLATES: Tuple[str, ...] = (
+    "¡Hola! Veo que estás interesado en saber más. Aunque no tengo los detalles específicos sobre eso, puedo contarte sobre los servicios y productos de {brand}. ¿Te gustaría que te cuente más sobre lo que ofrecemos?",
+    "¡Gracias por tu consulta! Actualmente no tengo esa información a mano, pero estaré encantado de ayudarte con otros aspectos de {brand}. ¿Te gustaría saber sobre nuestros servicios, horarios de atención o cómo contactarnos?",
+    "¡Interesante pregunta! Aunque no tengo esa información específica en este momento, puedo ayudarte con muchas otras consultas sobre {brand}. ¿Te gustaría que te cuente sobre nuestros productos destacados o servicios más populares?",
+    "¡Hola! Me encantaría ayudarte con eso. Mientras actualizo mi base de conocimiento, ¿podrías contarme más sobre lo que necesitas? Mientras tanto, podría informarte sobre otros aspectos de {brand} que podrían ser de tu interés.",
+    "Gracias por tu paciencia. Aunque no tengo la respuesta exacta ahora mismo, en {brand} valoramos mucho tus consultas. ¿Te gustaría que te ayude con información sobre nuestros servicios o que te ponga en contacto con un asesor especializado?",
+)
+
+# Respuestas consecutivas "sin contexto" por usuario (LRU acotado para no crecer sin límite)
+_NO_CTX_MAX = 10_000
+_no_context_counts: "OrderedDict[str, int]" = OrderedDict()
+
+# Ventana LRU de IDs de mensajes ya procesados (los reintentos de Meta reenvían el mismo ID)
+_PROCESSED_MSG_IDS_MAX = 4096
+_processed_msg_ids: "OrderedDict[str, None]" = OrderedDict()
+
+# Número de administración para avisos de error; se resuelve una vez al importar
+_ADMIN_NOTIFICATION_NUMBER: Optional[str] = getattr(settings, 'ADMIN_NOTIFICATION_NUMBER', None)
+
+# Perfiles ya sincronizados (usuario existe y tiene nombre): (user_id, platform) -> expiración monotónica.
+# Evita el SELECT de update_user_profile en cada mensaje de un remitente activo.
+_PROFILE_SYNC_TTL_SECONDS = 300
+_PROFILE_SYNC_MAX = 10_000
+_profile_synced_until: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+
+def _profile_recently_synced(profile_key: Tuple[str, str]) -> bool:
+    """True si el perfil se verificó/guardó hace menos de _PROFILE_SYNC_TTL_SECONDS."""
+    expires_at = _profile_synced_until.get(profile_key)
+    if expires_at is None:
+        return False
+    if expires_at <= time.monotonic():
+        del _profile_synced_until[profile_key]
+        return False
+    return True
+
+def _mark_profile_synced(profile_key: Tuple[str, str]) -> None:
+    """Registra el perfil como sincronizado, expulsando la entrada más antigua si se llena."""
+    _profile_synced_until[profile_key] = time.monotonic() + _PROFILE_SYNC_TTL_SECONDS
+    _profile_synced_until.move_to_end(profile_key)
+    if len(_profile_synced_until) > _PROFILE_SYNC_MAX:
+        _profile_synced_until.popitem(last=False)
+
+def _bump_no_context_count(user_key: str) -> int:
+    """Incrementa y devuelve el contador "sin contexto" del usuario, expulsando al menos reciente."""
+    count = _no_context_counts.get(user_key, 0) + 1
+    _no_context_counts[user_key] = count
+    _no_context_counts.move_to_end(user_key)
+    if len(_no_context_counts) > _NO_CTX_MAX:
+        _no_context_counts.popitem(last=False)
+    return count
+
+def _mark_message_processed(msg_id: str) -> bool:
+    """Registra el ID del mensaje; devuelve False si ya estaba en la ventana de deduplicación."""
+    if msg_id in _processed_msg_ids:
+        _processed_msg_ids.move_to_end(msg_id)
+        return False
+    _processed_msg_ids[msg_id] = None
+    if len(_processed_msg_ids) > _PROCESSED_MSG_IDS_MAX:
+        _processed_msg_ids.popitem(last=False)
+    return True
+
 def format_context_from_docs(docs: List[Any]) -> str:
     """
     Formatea una lista de documentos en un string de contexto legible.
@@ -185,6 +257,10 @@ async def update_user_profile(
     Actualiza la información del perfil del usuario en la base de datos.
     Si el usuario no existe, crea un nuevo registro.
     """
+    profile_key = (user_id, platform)
+    if _profile_recently_synced(profile_key):
+        return
+    
     from app.models.user_state import UserState  # Usar UserState en lugar de User
     try:
         # Buscar el usuario por ID y plataforma
@@ -203,9 +279,14 @@ async def update_user_profile(
         elif not user_state.collected_name:
             # Si existe pero no tiene nombre, actualizarlo
             user_state.collected_name = profile_name
+        else:
+            # Nada que persistir: evitar un COMMIT vacío en cada mensaje entrante
+            _mark_profile_synced(profile_key)
+            return
             
         await db_session.commit()
-        logger.info(f"Perfil de usuario {user_id} actualizado exitosamente.")
+        _mark_profile_synced(profile_key)
+        logger.info("Perfil de usuario %s actualizado exitosamente.", user_id)
         
     except Exception as e:
         logger.error(f"Error al actualizar perfil de usuario {user_id}: {e}")
@@ -225,9 +306,13 @@ _pending_rag_transitions = set()
 
 # FIX: Cambiado de importación relativa a absoluta
 from app.models.webhook_models import (
-    WhatsAppPayload, WhatsAppMessage, WhatsAppInteractive,
-    WhatsAppButtonReply, WhatsAppInteractiveListReply, WhatsAppContact
+    WhatsAppMessage, WhatsAppInteractive,
+    WhatsAppButtonReply, WhatsAppInteractiveListReply, WhatsAppContact,
+    WHATSAPP_MESSAGES_ADAPTER
 )
+from pydantic import ValidationError
+from tenacity import AsyncRetrying, retry_if_exception_type, retry_if_result, stop_after_attempt, wait_exponential, wait_random
+
 # Asegúrate que UserState esté bien definido y se importe.
 # from app.models.user_state import UserState # Si lo tienes en un modelo separado de DB
 # O si es una clase Pydantic o dataclass para el estado en memoria/sesión:
@@ -243,6 +328,30 @@ class UserStateModel(BaseModel): # Ejemplo de modelo Pydantic para el estado
     purpose_of_inquiry: Optional[str] = None
     # ... otros campos de estado que necesites
 
+@dataclass(frozen=True, slots=True)
+class ConversationContext:
+    """Datos de un turno de conversación que se pasan al manejador de cada etapa.
+    
+    Inmutable: todo lo que depende de la marca se resuelve una vez al construirlo.
+    """
+    from_phone: str
+    platform_name: str
+    user_key: str
+    user_input_text: str
+    button_id_pressed: Optional[str]
+    db_session: AsyncSession
+    request: Request
+    current_user_state_obj: UserStateModel
+    current_stage: str
+    current_brand_id: Optional[int]
+    brand_name_display: str
+    brand_normalized: str = ""  # normalize_brand_name(brand_name_display), clave para RAG y perfiles
+    normalized_input: str = ""  # user_input_text en minúsculas y sin espacios extremos
+    company_obj: Optional[Company] = None
+    brand_profile: Optional[Dict[str, Any]] = None
+    brand_farewell: Optional[str] = None
+    brand_calendly_link: Optional[str] = None
+
 # FIX: Cambiado de importación relativa a absoluta
 from app.models.company_models import Company
 
@@ -262,8 +371,7 @@ async def _handle_contact_info_request(db_session: AsyncSession, current_brand_i
             return "Lo siento, no puedo proporcionar información de contacto en este momento. Por favor, intenta nuevamente más tarde."
             
         brand_name = company_obj.name
-        normalized_brand_name = normalize_brand_name(brand_name)
-        brand_profile = BRAND_PROFILES.get(normalized_brand_name, BRAND_PROFILES.get("default", {}))
+        _, _, brand_profile = _brand_fast_entry(brand_name)
         
         # Obtener información de contacto del perfil de la marca
         contact_info = brand_profile.get("contact_info_notes", "")
@@ -328,37 +436,88 @@ from app.main.state_manager import (
 
 from app.api.meta import send_whatsapp_message as _send_whatsapp_message_base
 
-# Función envoltoria para send_whatsapp_message que pasa automáticamente el objeto request
+# Función envoltoria para send_whatsapp_message que conserva la firma usada en este módulo
 async def send_whatsapp_message(to: str, message_payload: Union[str, Dict[str, Any]], interactive_buttons=None):
-    """Wrapper para enviar mensajes de WhatsApp pasando automáticamente el request actual.
+    """Wrapper para enviar mensajes de WhatsApp con el cliente HTTP compartido.
     
-    Esta función obtiene el request actual del contexto de ejecución y lo pasa a la función
-    base para asegurar que se use el cliente HTTP compartido.
+    La función base resuelve el cliente registrado por create_meta_client, por lo que ya no
+    hace falta recorrer la pila de llamadas buscando el request en cada envío.
     """
-    # Obtenemos el request del contexto actual
-    import inspect
-    frame = inspect.currentframe()
-    request = None
-    
-    # Buscamos request en la pila de llamadas
-    while frame:
-        if 'request' in frame.f_locals:
-            request = frame.f_locals['request']
-            break
-        frame = frame.f_back
-    
-    # Llamamos a la función base pasando el request
-    return await _send_whatsapp_message_base(to, message_payload, interactive_buttons, request=request)
+    return await _send_whatsapp_message_base(to, message_payload, interactive_buttons)
 from app.api.calendly import get_available_slots, get_scheduling_link
-from app.api.llm_client import get_llm_response
+from app.api.llm_client import get_llm_response, get_llm_response_stream
 from app.ai.rag_retriever import search_relevant_documents
 from app.ai.rag_prompt_builder import build_llm_prompt, BRAND_PROFILES
 
+# Tabla precalculada {nombre_normalizado: (farewell_message, calendly_link, perfil)} para que las
+# ramas de salida/agendamiento resuelvan el perfil de marca con una sola búsqueda O(1).
+BrandFastEntry = Tuple[Optional[str], Optional[str], Dict[str, Any]]
+_BRAND_FAST: Dict[str, BrandFastEntry] = {
+    normalize_brand_name(name): (profile.get("farewell_message"), profile.get("calendly_link"), profile)
+    for name, profile in BRAND_PROFILES.items()
+}
+_BRAND_FAST_DEFAULT: BrandFastEntry = _BRAND_FAST.get("default", (None, None, {}))
+
+def _brand_fast_entry(brand_name: str) -> BrandFastEntry:
+    """Devuelve (farewell_message, calendly_link, perfil) de la marca, o los de "default"."""
+    return _BRAND_FAST.get(normalize_brand_name(brand_name), _BRAND_FAST_DEFAULT)
+
+_STREAM_CUT_OFF_NOTICE = "⚠️ Mi respuesta se cortó por un problema técnico. Si te faltó información, vuelve a preguntarme, por favor."
+
+async def _stream_llm_reply_to_whatsapp(to: str, full_prompt: str, llm_http_client) -> Optional[str]:
+    """Envía la respuesta del LLM por párrafos a medida que se genera.
+    
+    WhatsApp no admite edición incremental, así que cada bloque de al menos
+    LLM_STREAM_MIN_CHUNK_CHARS caracteres que termina en un párrafo se envía como
+    mensaje propio. Devuelve el texto enviado, o None si falló antes de enviar nada
+    (el llamador recurre entonces a get_llm_response). Si falla a mitad de la respuesta,
+    avisa al usuario de que quedó cortada.
+    """
+    min_chunk_chars = settings.LLM_STREAM_MIN_CHUNK_CHARS
+    buffer = ""
+    sent_parts: List[str] = []
+    try:
+        async for delta in get_llm_response_stream(full_prompt, http_client=llm_http_client):
+            buffer += delta
+            cut = buffer.rfind("\n\n")
+            if cut >= min_chunk_chars:
+                part = buffer[:cut].strip()
+                buffer = buffer[cut + 2:]
+                if part:
+                    await send_whatsapp_message(to, part)
+                    sent_parts.append(part)
+    except Exception as e_stream:
+        if not sent_parts:
+            logger.warning("LLM stream falló antes de enviar contenido a %s: %s. Se usará la respuesta completa.", to, e_stream)
+            return None
+        logger.error(f"LLM stream interrumpido tras enviar {len(sent_parts)} bloque(s) a {to}: {e_stream}", exc_info=True)
+        # El resto de la respuesta se perdió: avisar en lugar de dejarla cortada sin más
+        await send_whatsapp_message(to, _STREAM_CUT_OFF_NOTICE)
+        return "\n\n".join(sent_parts)
+    tail = buffer.strip()
+    if tail:
+        await send_whatsapp_message(to, tail)
+        sent_parts.append(tail)
+    return "\n\n".join(sent_parts) if sent_parts else None
+
 RESET_KEYWORDS = {"menu", "menú", "inicio", "reset", "/reset", "/menu", "volver", "cambiar marca", "salir", "cancelar", "principal"}
 # Palabras clave para dar de baja al usuario (desuscribirse completamente del servicio)
 OPT_OUT_KEYWORDS = {"baja", "unsubscribe", "no quiero mensajes", "cancelar mensajes", "detener mensajes", "no más mensajes", "desuscribir", "quitar suscripción"}
 OPT_IN_KEYWORDS = {"start", "alta", "subscribe", "quiero mensajes", "iniciar mensajes", "continuar mensajes"}
 
+_EXIT_KEYWORDS_RE = _compile_keyword_pattern(EXIT_KEYWORDS)
+_RESET_KEYWORDS_RE = _compile_keyword_pattern(RESET_KEYWORDS)
+_OPT_OUT_KEYWORDS_RE = _compile_keyword_pattern(OPT_OUT_KEYWORDS)
+_OPT_IN_KEYWORDS_RE = _compile_keyword_pattern(OPT_IN_KEYWORDS)
+# Normalizadas una sola vez al importar; la entrada del usuario siempre se compara en minúsculas
+_EXIT_KEYWORDS_LOWER = frozenset(keyword.lower() for keyword in settings.EXIT_CONVERSATION_KEYWORDS)
+_RESET_KEYWORDS_LOWER = frozenset(keyword.lower() for keyword in RESET_KEYWORDS)
+_EXIT_CONVERSATION_RE = _compile_keyword_pattern(_EXIT_KEYWORDS_LOWER)
+# Comando de salida: el texto es la palabra clave o empieza por ella seguida de un espacio
+_EXIT_COMMAND_RE = re.compile(
+    r"^(?:" + "|".join(re.escape(keyword) for keyword in sorted(_EXIT_KEYWORDS_LOWER, key=len, reverse=True)) + r")(?: |\Z)"
+)
+
 # --- Funciones Helper (normalize_brand_name, format_context_from_docs, format_available_slots_message se mantienen igual, omitidas por brevedad) ---
 # ... normalize_brand_name ...
 # ... format_context_from_docs ...
@@ -371,7 +530,7 @@ async def _handle_providing_scheduling_info(
 ) -> Optional[Union[str, Dict[str, Any]]]:
     sender_user_id_for_log = f"{current_user_state_obj.platform}:{current_user_state_obj.user_id}"
     
-    logger.info(f"_handle_providing_scheduling_info: Iniciando para usuario {sender_user_id_for_log}, BrandID: {current_brand_id}")
+    logger.info("_handle_providing_scheduling_info: Iniciando para usuario %s, BrandID: %s", sender_user_id_for_log, current_brand_id)
 
     if not settings.CALENDLY_EVENT_TYPE_URI or not settings.CALENDLY_API_KEY:
         logger.error(f"_handle_providing_scheduling_info: CRÍTICO - CALENDLY_EVENT_TYPE_URI o CALENDLY_API_KEY no están configurados. Usuario: {sender_user_id_for_log}")
@@ -381,7 +540,7 @@ async def _handle_providing_scheduling_info(
     company = await get_company_by_id(db_session, current_brand_id) if current_brand_id else None
     company_name_display = company.name if company else "nuestro equipo"
     user_first_name = current_user_state_obj.collected_name.split()[0] if current_user_state_obj.collected_name else "tú"
-    logger.debug(f"_handle_providing_scheduling_info: Compañía: '{company_name_display}', Nombre usuario: '{user_first_name}'")
+    logger.debug("_handle_providing_scheduling_info: Compañía: '%s', Nombre usuario: '%s'", company_name_display, user_first_name)
 
     response_parts = [f"¡Genial, {user_first_name}! Me alegra poder ayudarte."]
     purpose = current_user_state_obj.purpose_of_inquiry
@@ -392,16 +551,16 @@ async def _handle_providing_scheduling_info(
     slots_message_part = "No pude obtener los horarios disponibles en este momento."
     try:
         slots_days_to_check = settings.CALENDLY_DAYS_TO_CHECK if settings.CALENDLY_DAYS_TO_CHECK and settings.CALENDLY_DAYS_TO_CHECK > 0 else 7
-        logger.debug(f"_handle_providing_scheduling_info: Buscando slots en Calendly para los próximos {slots_days_to_check} días.")
+        logger.debug("_handle_providing_scheduling_info: Buscando slots en Calendly para los próximos %s días.", slots_days_to_check)
         start_date = date.today()
         end_date = start_date + timedelta(days=slots_days_to_check)
         available_slots_data = await get_available_slots(str(settings.CALENDLY_EVENT_TYPE_URI), start_date, end_date)
         
         if available_slots_data:
-            logger.debug(f"_handle_providing_scheduling_info: Slots obtenidos de Calendly: {len(available_slots_data)} slots. Formateando...")
+            logger.debug("_handle_providing_scheduling_info: Slots obtenidos de Calendly: %s slots. Formateando...", len(available_slots_data))
             slots_message_part = format_available_slots_message(available_slots_data)
         else:
-            logger.info(f"_handle_providing_scheduling_info: No se encontraron slots disponibles en Calendly para {sender_user_id_for_log} en el rango especificado.")
+            logger.info("_handle_providing_scheduling_info: No se encontraron slots disponibles en Calendly para %s en el rango especificado.", sender_user_id_for_log)
             slots_message_part = "Lo siento, no encontré horarios disponibles en los próximos días para este evento."
     except Exception as e:
         logger.error(f"_handle_providing_scheduling_info: Error al obtener/formatear slots de Calendly para {sender_user_id_for_log}: {e}", exc_info=True)
@@ -414,9 +573,9 @@ async def _handle_providing_scheduling_info(
             scheduling_link_url = settings.CALENDLY_GENERAL_SCHEDULING_LINK
             # Asegurarse de que el enlace sea destacado y visible
             link_message_part = f"\n📌 *Aquí tienes el enlace para elegir el horario que mejor te convenga:*\n\n{scheduling_link_url}\n"
-            logger.info(f"_handle_providing_scheduling_info: Usando enlace general de agendamiento: {scheduling_link_url}")
+            logger.info("_handle_providing_scheduling_info: Usando enlace general de agendamiento: %s", scheduling_link_url)
         else:
-            logger.warning(f"_handle_providing_scheduling_info: No se pudo proporcionar enlace de agendamiento para {sender_user_id_for_log} porque CALENDLY_GENERAL_SCHEDULING_LINK no está configurado.")
+            logger.warning("_handle_providing_scheduling_info: No se pudo proporcionar enlace de agendamiento para %s porque CALENDLY_GENERAL_SCHEDULING_LINK no está configurado.", sender_user_id_for_log)
             link_message_part = "\n❌ No pude generar un enlace de agendamiento. Por favor, escribe 'menu' e intenta nuevamente."
     except Exception as e:
         logger.error(f"_handle_providing_scheduling_info: Error al generar enlace de Calendly para {sender_user_id_for_log}: {e}", exc_info=True)
@@ -429,7 +588,7 @@ async def _handle_providing_scheduling_info(
     # IMPORTANTE: No resetear el estado aquí a STAGE_AWAITING_ACTION.
     # El llamador (handle_whatsapp_message) decidirá el siguiente estado.
     # Por ejemplo, podría transicionar a STAGE_MAIN_CHAT_RAG para permitir preguntas de seguimiento.
-    logger.info(f"_handle_providing_scheduling_info: Respuesta de agendamiento preparada para {sender_user_id_for_log}.")
+    logger.info("_handle_providing_scheduling_info: Respuesta de agendamiento preparada para %s.", sender_user_id_for_log)
     return final_response_message
 
 async def handle_whatsapp_message(
@@ -454,17 +613,17 @@ async def handle_whatsapp_message(
             button_id_pressed = interactive.button_reply.id
             # Usar el title del botón como user_input_text si no hay texto (o para consistencia)
             user_input_text = interactive.button_reply.title.strip() 
-            logger.info(f"Botón presionado ID: '{button_id_pressed}', Título: '{user_input_text}'")
+            logger.info("Botón presionado ID: '%s', Título: '%s'", button_id_pressed, user_input_text)
         elif interactive.type == "list_reply" and interactive.list_reply:
             button_id_pressed = interactive.list_reply.id # ID de la opción de lista
             user_input_text = interactive.list_reply.title.strip()
-            logger.info(f"Opción de lista seleccionada ID: '{button_id_pressed}', Título: '{user_input_text}'")
+            logger.info("Opción de lista seleccionada ID: '%s', Título: '%s'", button_id_pressed, user_input_text)
 
     if not user_input_text:
-        logger.warning(f"Mensaje sin contenido procesable (texto o botón/lista) recibido de {user_key}")
+        logger.warning("Mensaje sin contenido procesable (texto o botón/lista) recibido de %s", user_key)
         return {"status": "ignored", "reason": "empty_or_unhandled_message_content"}
 
-    logger.info(f"Procesando input para {user_key}: '{user_input_text}' (Botón ID: {button_id_pressed})")
+    logger.info("Procesando input para %s: '%s' (Botón ID: %s)", user_key, user_input_text, button_id_pressed)
 
     current_user_state_obj: UserStateModel = await get_or_create_user_state(
         db_session=db_session,
@@ -475,7 +634,7 @@ async def handle_whatsapp_message(
 
     if not await is_user_subscribed(db_session, from_phone, platform_name):
         # (Lógica de no suscrito se mantiene)
-        logger.info(f"Usuario {user_key} no está suscrito. Ignorando mensaje.")
+        logger.info("Usuario %s no está suscrito. Ignorando mensaje.", user_key)
         return {"status": "ignored", "reason": "user_not_subscribed"}
         
     # Verificar si la sesión fue finalizada explícitamente y se encuentra en selección de marca
@@ -493,7 +652,7 @@ async def handle_whatsapp_message(
         # Resetear al estado de selección de marca
         await reset_user_to_brand_selection(db_session, current_user_state_obj)
         
-        logger.info(f"Usuario {user_key} envió mensaje después de finalizar sesión: '{user_input_text}'. Mostrando menú de selección de marcas.")
+        logger.info("Usuario %s envió mensaje después de finalizar sesión: '%s'. Mostrando menú de selección de marcas.", user_key, user_input_text)
         
         # Enviamos el menú de selección de marcas
         selection_message = await get_company_selection_message(db_session, current_user_state_obj)
@@ -501,19 +660,19 @@ async def handle_whatsapp_message(
         
         return {"status": "success", "action": "brand_selection_shown_after_session_end"}
 
+    # Normalización única de la entrada: todos los chequeos posteriores reutilizan estas cadenas
     normalized_input_lower = user_input_text.lower()
+    normalized_input = normalized_input_lower.strip()
 
     # Detectar comando de salida (terminar completamente la conversación)
-    if any(keyword in normalized_input_lower for keyword in EXIT_KEYWORDS):
+    if _EXIT_KEYWORDS_RE.search(normalized_input_lower):
         if current_brand_id:
             company_obj = await get_company_by_id(db_session, current_brand_id)
             if company_obj:
                 brand_name = company_obj.name
-                normalized_brand_name = normalize_brand_name(brand_name)
-                brand_profile = BRAND_PROFILES.get(normalized_brand_name, BRAND_PROFILES.get("default"))
                 
                 # Obtener mensaje de despedida personalizado del perfil de marca
-                farewell_message = brand_profile.get("farewell_message", None)
+                farewell_message, _, _ = _brand_fast_entry(brand_name)
                 
                 # Si no hay mensaje personalizado en el perfil o es None, usar uno humanizado genérico
                 if not farewell_message:
@@ -526,14 +685,13 @@ async def handle_whatsapp_message(
                         f"¡Ha sido un placer conversar contigo{user_name_part}! Recuerda que en {brand_name} estamos para ayudarte siempre que lo necesites. ¡Hasta la próxima! 👋"
                     ]
                     # Seleccionar aleatoriamente una variante para que parezca más natural
-                    import random
                     farewell_message = random.choice(farewell_variants)
                 
                 # Enviar mensaje de despedida personalizado
                 await send_whatsapp_message(from_phone, farewell_message)
                 
                 # Registrar en el log con más detalle para mejor trazabilidad
-                logger.info(f"Usuario {user_key} terminó la conversación con '{user_input_text}'. Mensaje de despedida enviado: '{farewell_message[:50]}...'")
+                logger.info("Usuario %s terminó la conversación con '%s'. Mensaje de despedida enviado: '%s...'", user_key, user_input_text, farewell_message[:50])
                 
                 # Marcar la sesión como explícitamente terminada en lugar de resetear al menú
                 await update_user_state_db(db_session, current_user_state_obj, {"session_explicitly_ended": True})
@@ -545,18 +703,14 @@ async def handle_whatsapp_message(
         farewell_message = f"¡Gracias por escribirnos{user_name_part}! Ha sido un placer ayudarte. Si necesitas cualquier cosa en el futuro, ¡estaremos aquí para ti! ¡Hasta pronto! 👋"
         await send_whatsapp_message(from_phone, farewell_message)
         await update_user_state_db(db_session, current_user_state_obj, {"session_explicitly_ended": True})
-        logger.info(f"Usuario {user_key} terminó conversación sin marca seleccionada. Mensaje de despedida enviado.")
+        logger.info("Usuario %s terminó conversación sin marca seleccionada. Mensaje de despedida enviado.", user_key)
         return {"status": "success", "action": "conversation_completely_ended_no_brand"}
     
     # Detectar comandos para mostrar menú o reiniciar (mantiene el comportamiento original)
-    if any(keyword in normalized_input_lower for keyword in RESET_KEYWORDS):
+    if _RESET_KEYWORDS_RE.search(normalized_input_lower):
         if current_brand_id:
             company_obj = await get_company_by_id(db_session, current_brand_id)
             if company_obj:
-                brand_name = company_obj.name
-                normalized_brand_name = normalize_brand_name(brand_name)
-                brand_profile = BRAND_PROFILES.get(normalized_brand_name, BRAND_PROFILES.get("default"))
-                
                 # Mensaje para comandos de menú/reinicio
                 reset_message = f"Volviendo al menú principal. ¿En qué más puedo ayudarte?"
                 
@@ -564,7 +718,7 @@ async def handle_whatsapp_message(
                 await send_whatsapp_message(from_phone, reset_message)
                 
                 # Registrar en el log
-                logger.info(f"Usuario {user_key} solicitó reiniciar o mostrar menú con '{user_input_text}'")
+                logger.info("Usuario %s solicitó reiniciar o mostrar menú con '%s'", user_key, user_input_text)
         
         # Resetear el estado del usuario al menú de selección de marca
         await reset_user_to_brand_selection(db_session, current_user_state_obj)
@@ -572,13 +726,13 @@ async def handle_whatsapp_message(
         await send_whatsapp_message(from_phone, selection_message)
         return {"status": "success", "action": "reset_to_brand_selection_by_keyword"}
 
-    if any(keyword in normalized_input_lower for keyword in OPT_OUT_KEYWORDS):
+    if _OPT_OUT_KEYWORDS_RE.search(normalized_input_lower):
         # (Lógica de opt-out se mantiene)
         await update_user_subscription_status(db_session, from_phone, platform_name, False)
         await send_whatsapp_message(from_phone, "Has sido dado de baja...")
         return {"status": "success", "action": "unsubscribed_by_keyword"}
         
-    if any(keyword in normalized_input_lower for keyword in OPT_IN_KEYWORDS):
+    if _OPT_IN_KEYWORDS_RE.search(normalized_input_lower):
         # (Lógica de opt-in se mantiene)
         await update_user_subscription_status(db_session, from_phone, platform_name, True)
         await send_whatsapp_message(from_phone, "¡Bienvenido de nuevo!...")
@@ -589,915 +743,1020 @@ async def handle_whatsapp_message(
     current_stage = current_user_state_obj.stage
     current_brand_id = current_user_state_obj.current_brand_id
     brand_name_display = "la marca seleccionada" # Placeholder, obtener de la DB si es posible
+    # La compañía y su perfil se resuelven una sola vez por mensaje y se comparten vía ctx
+    company_obj = None
+    brand_farewell, brand_calendly_link, brand_profile = _BRAND_FAST_DEFAULT
     if current_brand_id:
         company_obj = await get_company_by_id(db_session, current_brand_id)
         if company_obj:
             brand_name_display = company_obj.name
-
-    logger.info(f"Usuario {user_key} en etapa: {current_stage}, Marca ID: {current_brand_id}, Input: '{user_input_text}'")
+    brand_normalized = normalize_brand_name(brand_name_display)
+    if company_obj:
+        brand_farewell, brand_calendly_link, brand_profile = _BRAND_FAST.get(brand_normalized, _BRAND_FAST_DEFAULT)
+
+    logger.info("Usuario %s en etapa: %s, Marca ID: %s, Input: '%s'", user_key, current_stage, current_brand_id, user_input_text)
+
+    ctx = ConversationContext(
+        from_phone=from_phone,
+        platform_name=platform_name,
+        user_key=user_key,
+        user_input_text=user_input_text,
+        button_id_pressed=button_id_pressed,
+        db_session=db_session,
+        request=request,
+        current_user_state_obj=current_user_state_obj,
+        current_stage=current_stage,
+        current_brand_id=current_brand_id,
+        brand_name_display=brand_name_display,
+        brand_normalized=brand_normalized,
+        normalized_input=normalized_input,
+        company_obj=company_obj,
+        brand_profile=brand_profile,
+        brand_farewell=brand_farewell,
+        brand_calendly_link=brand_calendly_link,
+    )
 
     # --- Flujo Principal de la Conversación ---
-    if current_stage == STAGE_SELECTING_BRAND:
-        company_id_selected = await get_company_id_by_selection(db_session, user_input_text)
-        if company_id_selected:
-            await update_user_state_db(db_session, current_user_state_obj, {
-                "current_brand_id": company_id_selected,
-                "stage": STAGE_AWAITING_ACTION # Transición a la espera de acción
-            })
-            # Obtener el nombre de la compañía seleccionada
-            company = await get_company_by_id(db_session, company_id_selected)
-            company_name = company.name if company else None
-            
-            action_message_payload = await get_action_selection_message(
-                company_name=company_name,  # Pasar el nombre de la compañía
-                user_state_obj=current_user_state_obj
-            )
-            message_text_to_send = action_message_payload.get("text", "Error: Mensaje de acción no encontrado.")
-            buttons_to_send = action_message_payload.get("buttons", [])
-            await send_whatsapp_message(from_phone, message_text_to_send, buttons_to_send)
-            return {"status": "success", "action": "brand_selected", "brand_id": company_id_selected}
-        else:
-            selection_message_text = await get_company_selection_message(db_session, current_user_state_obj)
-            await send_whatsapp_message(from_phone, f"Opción no reconocida. Por favor, selecciona una opción válida de la lista:\n\n{selection_message_text}")
-            return {"status": "success", "action": "invalid_brand_selection_retry"}
-
-    elif current_stage == STAGE_AWAITING_ACTION:
-        if not current_brand_id: # Seguridad: si no hay marca, volver a seleccionar
-            logger.warning(f"Usuario {user_key} en STAGE_AWAITING_ACTION sin current_brand_id. Reseteando.")
-            await reset_user_to_brand_selection(db_session, current_user_state_obj) #... (enviar mensaje de selección)
-            return {"status": "error", "action": "reset_missing_brand_in_awaiting_action"}
-
-        # Priorizar ID del botón si fue presionado
-        if button_id_pressed == "action_schedule": # ID del botón "🗓️ Agendar Cita"
-            logger.info(f"Usuario {user_key} seleccionó Agendar Cita (botón action_schedule).")
-            # Iniciamos el flujo de recolección de datos para el agendamiento
-            # Primero pedimos el nombre
-            await update_user_state_db(db_session, current_user_state_obj, {
-                "stage": STAGE_COLLECTING_NAME,
-                "purpose_of_inquiry": user_input_text # Guardar el título del botón como propósito inicial
-            })
-            await send_whatsapp_message(from_phone, f"Para agendar tu cita con *{brand_name_display}*, necesito algunos datos. \n\nPor favor, escribe tu nombre completo:")
-            return {"status": "success", "action": "transition_to_collecting_name_for_appointment"}
-
-        elif button_id_pressed == "action_rag": # ID del botón "📚 Consultar información"
-            logger.info(f"Usuario {user_key} seleccionó Consultar información (botón action_rag). Iniciando transición a RAG.")
-        
-            # Agregamos al usuario a la caché de transiciones pendientes ANTES de la actualización
-            _pending_rag_transitions.add(user_key)
-            logger.info(f"DIAGNÓSTICO-RAG: Usuario {user_key} añadido a caché de transiciones RAG pendientes. Estado actual: {current_user_state_obj.stage}")
+    # Despacho O(1) por etapa en lugar de una cadena if/elif de comparaciones de strings.
+    stage_handler = _STAGE_HANDLERS.get(current_stage, _handle_unknown_stage)
+    return await stage_handler(ctx)
+
+async def _handle_stage_selecting_brand(ctx: ConversationContext) -> Dict[str, Any]:
+    """Procesa la selección de marca del usuario."""
+    company_id_selected = await get_company_id_by_selection(ctx.db_session, ctx.user_input_text)
+    if company_id_selected:
+        await update_user_state_db(ctx.db_session, ctx.current_user_state_obj, {
+            "current_brand_id": company_id_selected,
+            "stage": STAGE_AWAITING_ACTION # Transición a la espera de acción
+        })
+        # Obtener el nombre de la compañía seleccionada
+        company = await get_company_by_id(ctx.db_session, company_id_selected)
+        company_name = company.name if company else None
         
-            # Actualizamos el estado en la base de datos
-            try:
-                old_stage = current_user_state_obj.stage
-                await update_user_state_db(db_session, current_user_state_obj, {"stage": STAGE_AWAITING_QUERY_FOR_RAG})
-            
-                # Verificación extra: asegurarnos que el cambio se reflejó en el objeto
-                if current_user_state_obj.stage == STAGE_AWAITING_QUERY_FOR_RAG:
-                    logger.info(f"Transición exitosa para usuario {user_key} de {old_stage} a {current_user_state_obj.stage}")
-                else:
-                    logger.warning(f"¡ALERTA! La actualización de estado para usuario {user_key} no se reflejó en el objeto. Sigue en: {current_user_state_obj.stage}")
-            except Exception as e_update:
-                logger.error(f"DIAGNÓSTICO-RAG: Error al actualizar estado para usuario {user_key}: {e_update}", exc_info=True)
-                # Si hay error, eliminamos al usuario de la caché de transiciones pendientes
-                if user_key in _pending_rag_transitions:
-                    _pending_rag_transitions.remove(user_key)
-                    logger.info(f"DIAGNÓSTICO-RAG: Usuario {user_key} eliminado de caché de transiciones debido a error en actualización")
+        action_message_payload = await get_action_selection_message(
+            company_name=company_name,  # Pasar el nombre de la compañía
+            user_state_obj=ctx.current_user_state_obj
+        )
+        message_text_to_send = action_message_payload.get("text", "Error: Mensaje de acción no encontrado.")
+        buttons_to_send = action_message_payload.get("buttons", [])
+        await send_whatsapp_message(ctx.from_phone, message_text_to_send, buttons_to_send)
+        return {"status": "success", "action": "brand_selected", "brand_id": company_id_selected}
+    else:
+        selection_message_text = await get_company_selection_message(ctx.db_session, ctx.current_user_state_obj)
+        await send_whatsapp_message(ctx.from_phone, f"Opción no reconocida. Por favor, selecciona una opción válida de la lista:\n\n{selection_message_text}")
+        return {"status": "success", "action": "invalid_brand_selection_retry"}
+
+async def _handle_stage_awaiting_action(ctx: ConversationContext) -> Dict[str, Any]:
+    """Procesa la acción elegida (agendar, consultar o volver al menú) tras seleccionar marca."""
+    if not ctx.current_brand_id: # Seguridad: si no hay marca, volver a seleccionar
+        logger.warning("Usuario %s en STAGE_AWAITING_ACTION sin current_brand_id. Reseteando.", ctx.user_key)
+        await reset_user_to_brand_selection(ctx.db_session, ctx.current_user_state_obj) #... (enviar mensaje de selección)
+        return {"status": "error", "action": "reset_missing_brand_in_awaiting_action"}
+
+    # Priorizar ID del botón si fue presionado
+    if ctx.button_id_pressed == "action_schedule": # ID del botón "🗓️ Agendar Cita"
+        logger.info("Usuario %s seleccionó Agendar Cita (botón action_schedule).", ctx.user_key)
+        # Iniciamos el flujo de recolección de datos para el agendamiento
+        # Primero pedimos el nombre
+        await update_user_state_db(ctx.db_session, ctx.current_user_state_obj, {
+            "stage": STAGE_COLLECTING_NAME,
+            "purpose_of_inquiry": ctx.user_input_text # Guardar el título del botón como propósito inicial
+        })
+        await send_whatsapp_message(ctx.from_phone, f"Para agendar tu cita con *{ctx.brand_name_display}*, necesito algunos datos. \n\nPor favor, escribe tu nombre completo:")
+        return {"status": "success", "action": "transition_to_collecting_name_for_appointment"}
+
+    elif ctx.button_id_pressed == "action_rag": # ID del botón "📚 Consultar información"
+        logger.info("Usuario %s seleccionó Consultar información (botón action_rag). Iniciando transición a RAG.", ctx.user_key)
+    
+        # Agregamos al usuario a la caché de transiciones pendientes ANTES de la actualización
+        _pending_rag_transitions.add(ctx.user_key)
+        logger.info("DIAGNÓSTICO-RAG: Usuario %s añadido a caché de transiciones RAG pendientes. Estado actual: %s", ctx.user_key, ctx.current_user_state_obj.stage)
+    
+        # Actualizamos el estado en la base de datos
+        try:
+            old_stage = ctx.current_user_state_obj.stage
+            await update_user_state_db(ctx.db_session, ctx.current_user_state_obj, {"stage": STAGE_AWAITING_QUERY_FOR_RAG})
         
-            # Enviamos mensaje de bienvenida al flujo RAG
-            await send_whatsapp_message(from_phone, f"¡Claro! Estoy aquí para ayudarte con tu consulta sobre *{brand_name_display}*. ¿Qué te gustaría saber?")
-            return {"status": "success", "action": "transitioned_to_awaiting_query_for_rag"}
-
-        elif button_id_pressed == "action_reset_menu": # ID del botón para volver al menú principal
-            logger.info(f"Usuario {user_key} seleccionó Volver al Menú (botón action_reset_menu).")
-            await reset_user_to_brand_selection(db_session, current_user_state_obj)
-            selection_message = await get_company_selection_message(db_session, current_user_state_obj)
-            await send_whatsapp_message(from_phone, selection_message)
-            return {"status": "success", "action": "reset_to_brand_selection_from_action_menu"}
+            # Verificación extra: asegurarnos que el cambio se reflejó en el objeto
+            if ctx.current_user_state_obj.stage == STAGE_AWAITING_QUERY_FOR_RAG:
+                logger.info("Transición exitosa para usuario %s de %s a %s", ctx.user_key, old_stage, ctx.current_user_state_obj.stage)
+            else:
+                logger.warning("¡ALERTA! La actualización de estado para usuario %s no se reflejó en el objeto. Sigue en: %s", ctx.user_key, ctx.current_user_state_obj.stage)
+        except Exception as e_update:
+            logger.error(f"DIAGNÓSTICO-RAG: Error al actualizar estado para usuario {ctx.user_key}: {e_update}", exc_info=True)
+            # Si hay error, eliminamos al usuario de la caché de transiciones pendientes
+            if ctx.user_key in _pending_rag_transitions:
+                _pending_rag_transitions.remove(ctx.user_key)
+                logger.info("DIAGNÓSTICO-RAG: Usuario %s eliminado de caché de transiciones debido a error en actualización", ctx.user_key)
+    
+        # Enviamos mensaje de bienvenida al flujo RAG
+        await send_whatsapp_message(ctx.from_phone, f"¡Claro! Estoy aquí para ayudarte con tu consulta sobre *{ctx.brand_name_display}*. ¿Qué te gustaría saber?")
+        return {"status": "success", "action": "transitioned_to_awaiting_query_for_rag"}
+
+    elif ctx.button_id_pressed == "action_reset_menu": # ID del botón para volver al menú principal
+        logger.info("Usuario %s seleccionó Volver al Menú (botón action_reset_menu).", ctx.user_key)
+        await reset_user_to_brand_selection(ctx.db_session, ctx.current_user_state_obj)
+        selection_message = await get_company_selection_message(ctx.db_session, ctx.current_user_state_obj)
+        await send_whatsapp_message(ctx.from_phone, selection_message)
+        return {"status": "success", "action": "reset_to_brand_selection_from_action_menu"}
+    
+    else: # No se presionó un botón conocido, o fue texto libre. Intentar interpretar como chat.
+        logger.info("Usuario %s en STAGE_AWAITING_ACTION envió texto libre: '%s'. Se tratará como inicio de RAG.", ctx.user_key, ctx.user_input_text)
+        await update_user_state_db(ctx.db_session, ctx.current_user_state_obj, {"stage": STAGE_MAIN_CHAT_RAG})
+        # Re-llamar a esta misma función (o una subfunción) para que procese el input bajo STAGE_MAIN_CHAT_RAG
+        # Esto es un poco recursivo, considera una estructura de bucle o una llamada directa a la lógica de RAG.
+        # Para simplicidad, podemos asumir que la siguiente iteración del webhook lo manejará si la UI es rápida,
+        # o directamente llamar a la lógica de RAG aquí.
+        # Vamos a intentar procesarlo directamente como si fuera STAGE_MAIN_CHAT_RAG:
+        # --- COPIAR/PEGAR O REFACTORIZAR LÓGICA DE STAGE_MAIN_CHAT_RAG AQUÍ ---
+        # O, más limpio, preparar el mensaje de "Estoy listo para tu consulta" y dejar que el siguiente mensaje active RAG.
+        await send_whatsapp_message(ctx.from_phone, f"Entendido. Puedes hacerme tu consulta sobre *{ctx.brand_name_display}*.")
+        return {"status": "success", "action": "text_in_awaiting_action_treated_as_rag_prompt"}
+
+async def _handle_stage_awaiting_query_for_rag(ctx: ConversationContext) -> Dict[str, Any]:
+    """Procesa la primera consulta RAG después de pulsar "Consultar información"."""
+    logger.info("Usuario %s en estado STAGE_AWAITING_QUERY_FOR_RAG. Procesando consulta: '%s'", ctx.user_key, ctx.user_input_text)
+
+    if not ctx.current_brand_id:
+        logger.warning("Usuario %s en STAGE_AWAITING_QUERY_FOR_RAG sin current_brand_id. Reseteando.", ctx.user_key)
+        await reset_user_to_brand_selection(ctx.db_session, ctx.current_user_state_obj)
+        selection_message = await get_company_selection_message(ctx.db_session, ctx.current_user_state_obj)
+        await send_whatsapp_message(ctx.from_phone, selection_message)
+        return {"status": "error", "action": "reset_missing_brand_in_awaiting_query_for_rag"}
+    # Detectar intención de agendamiento (una sola regex precompilada)
+    company_obj = ctx.company_obj
+    if company_obj and detect_scheduling_intent(ctx.user_input_text):
+        logger.info("Usuario %s expresó intención de agendamiento en STAGE_AWAITING_QUERY_FOR_RAG: '%s'", ctx.user_key, ctx.user_input_text)
         
-        else: # No se presionó un botón conocido, o fue texto libre. Intentar interpretar como chat.
-            logger.info(f"Usuario {user_key} en STAGE_AWAITING_ACTION envió texto libre: '{user_input_text}'. Se tratará como inicio de RAG.")
-            await update_user_state_db(db_session, current_user_state_obj, {"stage": STAGE_MAIN_CHAT_RAG})
-            # Re-llamar a esta misma función (o una subfunción) para que procese el input bajo STAGE_MAIN_CHAT_RAG
-            # Esto es un poco recursivo, considera una estructura de bucle o una llamada directa a la lógica de RAG.
-            # Para simplicidad, podemos asumir que la siguiente iteración del webhook lo manejará si la UI es rápida,
-            # o directamente llamar a la lógica de RAG aquí.
-            # Vamos a intentar procesarlo directamente como si fuera STAGE_MAIN_CHAT_RAG:
-            # --- COPIAR/PEGAR O REFACTORIZAR LÓGICA DE STAGE_MAIN_CHAT_RAG AQUÍ ---
-            # O, más limpio, preparar el mensaje de "Estoy listo para tu consulta" y dejar que el siguiente mensaje active RAG.
-            await send_whatsapp_message(from_phone, f"Entendido. Puedes hacerme tu consulta sobre *{brand_name_display}*.")
-            return {"status": "success", "action": "text_in_awaiting_action_treated_as_rag_prompt"}
-
-
-    elif current_stage == STAGE_AWAITING_QUERY_FOR_RAG:
-        logger.info(f"Usuario {user_key} en estado STAGE_AWAITING_QUERY_FOR_RAG. Procesando consulta: '{user_input_text}'")
-
-        if not current_brand_id:
-            logger.warning(f"Usuario {user_key} en STAGE_AWAITING_QUERY_FOR_RAG sin current_brand_id. Reseteando.")
-            await reset_user_to_brand_selection(db_session, current_user_state_obj)
-            selection_message = await get_company_selection_message(db_session, current_user_state_obj)
-            await send_whatsapp_message(from_phone, selection_message)
-            return {"status": "error", "action": "reset_missing_brand_in_awaiting_query_for_rag"}
-                # Detectar intención de agendamiento
-        company_obj = await get_company_by_id(db_session, current_brand_id)
-        if company_obj and detect_scheduling_intent(user_input_text):
-            logger.info(f"Usuario {user_key} expresó intención de agendamiento en STAGE_AWAITING_QUERY_FOR_RAG: '{user_input_text}'")
+        # Usar el enlace general de agendamiento de la configuración
+        if settings.CALENDLY_GENERAL_SCHEDULING_LINK:
+            # Personalizar con el nombre del usuario si disponible
+            user_name_greeting = f", {ctx.current_user_state_obj.collected_name.split()[0]}" if ctx.current_user_state_obj.collected_name else ""
             
-            # Usar el enlace general de agendamiento de la configuración
-            if settings.CALENDLY_GENERAL_SCHEDULING_LINK:
-                # Personalizar con el nombre del usuario si disponible
-                user_name_greeting = f", {current_user_state_obj.collected_name.split()[0]}" if current_user_state_obj.collected_name else ""
-                
-                # Obtener información del perfil de marca si está disponible
-                brand_name = company_obj.name
-                normalized_brand_name = normalize_brand_name(brand_name)
-                brand_profile = BRAND_PROFILES.get(normalized_brand_name, BRAND_PROFILES.get("default"))
-                
-                # Mensaje humanizado y personalizado para agendar cita con variantes para mayor naturalidad
-                scheduling_variants = [
-                    f"¡Por supuesto{user_name_greeting}! Estaremos encantados de coordinar una cita con *{brand_name}*. \n\nAquí tienes el enlace para que elijas el horario que mejor te funcione:\n\n{settings.CALENDLY_GENERAL_SCHEDULING_LINK}\n\nUna vez que confirmes tu cita, recibirás un correo de confirmación con todos los detalles. ¿Te puedo ayudar con algo más?",
-                    
-                    f"¡Genial{user_name_greeting}! Vamos a agendar esa reunión con *{brand_name}*. \n\nPuedes seleccionar el día y hora que prefieras en este enlace:\n\n{settings.CALENDLY_GENERAL_SCHEDULING_LINK}\n\nDespués de agendar, te enviaremos la confirmación por correo electrónico. Si tienes cualquier duda adicional, estoy aquí para ayudarte.",
-                    
-                    f"Me alegra poder ayudarte con tu cita{user_name_greeting}. \n\nPara coordinar una reunión con *{brand_name}*, utiliza este enlace y elige el horario que mejor se adapte a tu agenda:\n\n{settings.CALENDLY_GENERAL_SCHEDULING_LINK}\n\nLuego de confirmar tu cita, te llegará un correo con toda la información. ¿Necesitas algo más?"
-                ]
-                
-                # Seleccionar aleatoriamente una variante para más naturalidad
-                import random
-                scheduling_message = random.choice(scheduling_variants)
-                
-                # Agregar mensaje de despedida si el perfil lo incluye
-                await send_whatsapp_message(from_phone, scheduling_message)
-                logger.info(f"Mensaje de agendamiento personalizado enviado a usuario {user_key} para marca {brand_name}")
-                return {"status": "success", "action": "scheduling_link_sent", "brand_id": current_brand_id}
-            else:
-                logger.warning(f"Intención de agendamiento detectada pero no hay URL de agendamiento configurada en las variables de entorno")
-                # Si no hay URL, dar respuesta más útil en lugar de ignorar
-                await send_whatsapp_message(from_phone, f"Entiendo que quieres agendar una reunión con *{company_obj.name}*. Por favor, escribe 'agendar cita' para que pueda ayudarte con el proceso completo de agendamiento.")
-                return {"status": "success", "action": "scheduling_intent_no_url"}  
-        # Verificar palabras clave para salir de la conversación
-        normalized_input = user_input_text.lower().strip()
-        if any(keyword in normalized_input for keyword in settings.EXIT_CONVERSATION_KEYWORDS):
-            logger.info(f"Usuario {user_key} utilizó palabra clave de salida: '{user_input_text}'")
+            brand_name = company_obj.name
             
-            # Obtener el mensaje de despedida personalizado según la marca
-            company_obj = await get_company_by_id(db_session, current_brand_id)
-            if company_obj:
-                brand_name = company_obj.name
-                # Normalizar el nombre de la marca para buscar en BRAND_PROFILES
-                normalized_brand_name = normalize_brand_name(brand_name)
-                brand_profile = BRAND_PROFILES.get(normalized_brand_name, BRAND_PROFILES.get("default"))
-                
-                # Obtener el mensaje de despedida personalizado o usar un mensaje genérico
-                farewell_message = brand_profile.get("farewell_message", 
-                    "¡Gracias por tu consulta! Si necesitas más información, estaré aquí. ¡Hasta pronto! 👋")
-                
-                # Enviar mensaje de despedida
-                await send_whatsapp_message(from_phone, farewell_message)
-                
-                # No registrar este mensaje como una consulta para el historial
-                # (Ya fue agregado antes, así que lo removemos)
-                remove_last_user_message_from_history(user_key)
+            # Mensaje humanizado y personalizado para agendar cita con variantes para mayor naturalidad
+            scheduling_variants = [
+                f"¡Por supuesto{user_name_greeting}! Estaremos encantados de coordinar una cita con *{brand_name}*. \n\nAquí tienes el enlace para que elijas el horario que mejor te funcione:\n\n{settings.CALENDLY_GENERAL_SCHEDULING_LINK}\n\nUna vez que confirmes tu cita, recibirás un correo de confirmación con todos los detalles. ¿Te puedo ayudar con algo más?",
                 
-                # Resetear estado del usuario a selección de marca
-                await reset_user_to_brand_selection(db_session, current_user_state_obj)
+                f"¡Genial{user_name_greeting}! Vamos a agendar esa reunión con *{brand_name}*. \n\nPuedes seleccionar el día y hora que prefieras en este enlace:\n\n{settings.CALENDLY_GENERAL_SCHEDULING_LINK}\n\nDespués de agendar, te enviaremos la confirmación por correo electrónico. Si tienes cualquier duda adicional, estoy aquí para ayudarte.",
                 
-                return {"status": "success", "action": "conversation_exit_farewell_sent"}
-        
-        # Verificar palabras clave para reinicio
-        if user_input_text.lower().strip() in RESET_KEYWORDS:
-            await reset_user_to_brand_selection(db_session, current_user_state_obj)
-            selection_message = await get_company_selection_message(db_session, current_user_state_obj)
-            await send_whatsapp_message(from_phone, selection_message)
-            return {"status": "success", "action": "reset_to_brand_selection_from_reset_keyword_in_awaiting_query_for_rag"}
-
-        # Procesar la consulta RAG
-        await add_to_conversation_history(db_session, from_phone, platform_name, "user", user_input_text)
-
-        normalized_brand_name_for_rag = normalize_brand_name(brand_name_display)
-        # La corrección para Javier Bazán y otros casos especiales ya se maneja
-        # directamente en la función normalize_brand_name
-
-        conversation_history = await get_conversation_history(db_session, from_phone, platform_name)
-
-        # Obtener la instancia del retriever del estado de la aplicación
-        retriever_instance = request.app.state.retriever
-        if not retriever_instance:
-            logger.error("No se pudo obtener la instancia del retriever del estado de la aplicación")
-            await send_whatsapp_message(from_phone, "Lo siento, estoy teniendo dificultades para buscar información en este momento. Por favor, intenta de nuevo más tarde o escribe 'menu' para volver al menú principal.")
-            return {"status": "error", "message": "Error interno: componente de búsqueda no disponible"}
-
-        # Usar la función search_relevant_documents con el retriever
-        relevant_docs = await search_relevant_documents(
-            retriever_instance=retriever_instance,
-            user_query=user_input_text,
-            target_brand=normalized_brand_name_for_rag,
-            k_final=getattr(settings, "RAG_NUM_DOCS_TO_RETRIEVE", 3)
-        )
-        context_from_docs = format_context_from_docs(relevant_docs)
+                f"Me alegra poder ayudarte con tu cita{user_name_greeting}. \n\nPara coordinar una reunión con *{brand_name}*, utiliza este enlace y elige el horario que mejor se adapte a tu agenda:\n\n{settings.CALENDLY_GENERAL_SCHEDULING_LINK}\n\nLuego de confirmar tu cita, te llegará un correo con toda la información. ¿Necesitas algo más?"
+            ]
+            
+            # Seleccionar aleatoriamente una variante para más naturalidad
+            scheduling_message = random.choice(scheduling_variants)
+            
+            # Agregar mensaje de despedida si el perfil lo incluye
+            await send_whatsapp_message(ctx.from_phone, scheduling_message)
+            logger.info("Mensaje de agendamiento personalizado enviado a usuario %s para marca %s", ctx.user_key, brand_name)
+            return {"status": "success", "action": "scheduling_link_sent", "brand_id": ctx.current_brand_id}
+        else:
+            logger.warning("Intención de agendamiento detectada pero no hay URL de agendamiento configurada en las variables de entorno")
+            # Si no hay URL, dar respuesta más útil en lugar de ignorar
+            await send_whatsapp_message(ctx.from_phone, f"Entiendo que quieres agendar una reunión con *{company_obj.name}*. Por favor, escribe 'agendar cita' para que pueda ayudarte con el proceso completo de agendamiento.")
+            return {"status": "success", "action": "scheduling_intent_no_url"}  
+    # Verificar palabras clave para salir de la conversación
+    normalized_input = ctx.normalized_input
+    if _EXIT_CONVERSATION_RE.search(normalized_input):
+        logger.info("Usuario %s utilizó palabra clave de salida: '%s'", ctx.user_key, ctx.user_input_text)
         
-        # Log del contexto RAG para verificación
-        logger.info(f"CONTEXTO_RAG_PARA_LLM: '''{context_from_docs}'''")
-
-        # Construir el prompt para el LLM - usando brand_name_display para acceder al perfil correcto
-        full_prompt = build_llm_prompt(
-            brand_name=brand_name_display, # Nombre legible de la marca en lugar del normalizado
-            user_query=user_input_text,
-            context=context_from_docs,
-            conversation_history=conversation_history,
-            user_collected_name=current_user_state_obj.collected_name if current_user_state_obj else None,
-            # Detectar automáticamente si es primera interacción
-            is_first_turn=(current_stage == STAGE_AWAITING_QUERY_FOR_RAG)
-        )
+        # Obtener el mensaje de despedida personalizado según la marca
+        company_obj = ctx.company_obj
+        if company_obj:
+            brand_name = company_obj.name
+            # Obtener el mensaje de despedida personalizado o usar un mensaje genérico
+            farewell_message = ctx.brand_farewell or "¡Gracias por tu consulta! Si necesitas más información, estaré aquí. ¡Hasta pronto! 👋"
+            
+            # Enviar mensaje de despedida
+            await send_whatsapp_message(ctx.from_phone, farewell_message)
+            
+            # Resetear estado del usuario a selección de marca, quitando del historial el mensaje
+            # de salida (ya fue agregado antes y no debe contar como consulta)
+            await reset_user_to_brand_selection(ctx.db_session, ctx.current_user_state_obj, delete_last_user_msg=True)
+            
+            return {"status": "success", "action": "conversation_exit_farewell_sent"}
+    
+    # Verificar palabras clave para reinicio
+    if ctx.normalized_input in _RESET_KEYWORDS_LOWER:
+        await reset_user_to_brand_selection(ctx.db_session, ctx.current_user_state_obj)
+        selection_message = await get_company_selection_message(ctx.db_session, ctx.current_user_state_obj)
+        await send_whatsapp_message(ctx.from_phone, selection_message)
+        return {"status": "success", "action": "reset_to_brand_selection_from_reset_keyword_in_awaiting_query_for_rag"}
+
+    # Procesar la consulta RAG (el mensaje del usuario ya se agregó al historial en handle_whatsapp_message)
+    normalized_brand_name_for_rag = ctx.brand_normalized
+    # La corrección para Javier Bazán y otros casos especiales ya se maneja
+    # directamente en la función normalize_brand_name
+
+    conversation_history = await get_conversation_history(ctx.db_session, ctx.from_phone, ctx.platform_name)
+
+    # Obtener la instancia del retriever del estado de la aplicación
+    retriever_instance = ctx.request.app.state.retriever
+    if not retriever_instance:
+        logger.error("No se pudo obtener la instancia del retriever del estado de la aplicación")
+        await send_whatsapp_message(ctx.from_phone, "Lo siento, estoy teniendo dificultades para buscar información en este momento. Por favor, intenta de nuevo más tarde o escribe 'menu' para volver al menú principal.")
+        return {"status": "error", "message": "Error interno: componente de búsqueda no disponible"}
+
+    # Usar la función search_relevant_documents con el retriever
+    relevant_docs = await search_relevant_documents(
+        retriever_instance=retriever_instance,
+        user_query=ctx.user_input_text,
+        target_brand=normalized_brand_name_for_rag,
+        k_final=getattr(settings, "RAG_NUM_DOCS_TO_RETRIEVE", 3)
+    )
+    context_from_docs = format_context_from_docs(relevant_docs)
+    
+    # Log del contexto RAG para verificación
+    logger.debug("CONTEXTO_RAG_PARA_LLM: '''%s'''", context_from_docs)
+
+    # Construir el prompt para el LLM - usando brand_name_display para acceder al perfil correcto
+    full_prompt = build_llm_prompt(
+        brand_name=ctx.brand_name_display, # Nombre legible de la marca en lugar del normalizado
+        user_query=ctx.user_input_text,
+        context=context_from_docs,
+        conversation_history=conversation_history,
+        user_collected_name=ctx.current_user_state_obj.collected_name if ctx.current_user_state_obj else None,
+        # Detectar automáticamente si es primera interacción
+        is_first_turn=(ctx.current_stage == STAGE_AWAITING_QUERY_FOR_RAG)
+    )
 
-        try:
-            # Obtener respuesta del LLM
-            # Obtener el cliente HTTP para LLM desde el estado de la aplicación
+    try:
+        # Obtener respuesta del LLM
+        # Obtener el cliente HTTP para LLM desde el estado de la aplicación
 
-            llm_http_client = request.app.state.llm_http_client
+        llm_http_client = ctx.request.app.state.llm_http_client
 
-            if not llm_http_client:
+        if not llm_http_client:
 
-                logger.error(f"Error crítico: Cliente HTTP para LLM no disponible en app.state para usuario {user_key}")
+            logger.error(f"Error crítico: Cliente HTTP para LLM no disponible en app.state para usuario {ctx.user_key}")
 
-                await send_whatsapp_message(from_phone, "Lo siento, estoy experimentando problemas técnicos. Por favor, intenta más tarde o escribe 'menú' para otras opciones.")
+            await send_whatsapp_message(ctx.from_phone, "Lo siento, estoy experimentando problemas técnicos. Por favor, intenta más tarde o escribe 'menú' para otras opciones.")
 
-                return {"status": "error", "action": "llm_http_client_not_available"}
+            return {"status": "error", "action": "llm_http_client_not_available"}
 
-                
+            
 
-            # Obtener respuesta del LLM pasando explícitamente el cliente HTTP
+        # Obtener respuesta del LLM pasando explícitamente el cliente HTTP
 
-            llm_api_response = await get_llm_response(full_prompt, http_client=llm_http_client)
-            
-            # Mensaje predeterminado en caso de error
-            bot_response = "No pude generar una respuesta en este momento. ¿Podrías intentar reformular tu pregunta o escribir 'menú' para otras opciones?"
-            
-            # Validar que la respuesta sea válida
-            if llm_api_response and isinstance(llm_api_response, str) and len(llm_api_response.strip()) > 0:
-                bot_response = llm_api_response.strip()
-                logger.info(f"RAG: Respuesta válida generada para {user_key}")
-            else:
-                logger.warning(f"RAG: Respuesta LLM inválida para {user_key}: '{llm_api_response}'")
-                
-            # Enviar respuesta al usuario
-            await send_whatsapp_message(from_phone, bot_response)
-            
-            # Agregar a historial con timestamp
-            await add_to_conversation_history(db_session, from_phone, platform_name, "assistant", bot_response, include_timestamp=True)
-            
-            # Actualizar estado del usuario para permitir conversación continua
-            await update_user_state_db(db_session, current_user_state_obj, {
-                "stage": STAGE_MAIN_CHAT_RAG,
-                "last_interaction_at": datetime.now(timezone.utc)
-            })
-            
-            # Log claro de la transición
-            logger.info(f"RAG: Transición completada para {user_key}: {current_stage} → {STAGE_MAIN_CHAT_RAG}")
-            
-            return {"status": "success", "action": "rag_response_sent_transition_to_main_chat_rag"}
-            
-        except Exception as e_llm:
-            logger.error(f"Error LLM para {user_key}: {e_llm}", exc_info=True)
-            
-            # Mensaje más específico según el tipo de error
-            if "timeout" in str(e_llm).lower():
-                fallback_message = "Estoy tardando más de lo esperado. ¿Podrías intentar con una pregunta más corta o específica?"
-            elif "rate" in str(e_llm).lower():
-                fallback_message = "Hay mucha demanda en este momento. Por favor, intenta nuevamente en unos segundos."
-            else:
-                fallback_message = "Lo siento, no pude procesar tu consulta. Por favor, escribe 'menu' para volver al menú principal."
-                
-            await send_whatsapp_message(from_phone, fallback_message)
-            return {"status": "error", "action": "llm_error_in_awaiting_query_for_rag"}
-            
-    elif current_stage == STAGE_COLLECTING_NAME:
-        # Validar y guardar el nombre del usuario
-        if not user_input_text or len(user_input_text.strip()) < 3:
-            await send_whatsapp_message(from_phone, "Por favor, proporciona tu nombre completo (al menos 3 caracteres).")
-            return {"status": "error", "action": "invalid_name_for_appointment"}
+        llm_api_response = await get_llm_response(full_prompt, http_client=llm_http_client)
         
-        # Guardar el nombre y pasar al siguiente estado (recolectar propósito)
-        await update_user_state_db(db_session, current_user_state_obj, {
-            "collected_name": user_input_text.strip(),
-            "stage": STAGE_COLLECTING_PURPOSE
-        })
+        # Mensaje predeterminado en caso de error
+        bot_response = "No pude generar una respuesta en este momento. ¿Podrías intentar reformular tu pregunta o escribir 'menú' para otras opciones?"
         
-        # Si ya tenemos un propósito del botón, podemos saltar este paso
-        if current_user_state_obj.purpose_of_inquiry and not current_user_state_obj.purpose_of_inquiry.startswith("🗓️"):
-            # Ya tenemos un propósito válido, pasar a recolectar email
-            await update_user_state_db(db_session, current_user_state_obj, {"stage": STAGE_COLLECTING_EMAIL})
-            await send_whatsapp_message(from_phone, f"Gracias {user_input_text.strip().split()[0]}. ¿Cuál es tu correo electrónico?")
-            return {"status": "success", "action": "name_saved_skip_purpose_for_appointment"}
+        # Validar que la respuesta sea válida
+        if llm_api_response and isinstance(llm_api_response, str) and len(llm_api_response.strip()) > 0:
+            bot_response = llm_api_response.strip()
+            logger.info("RAG: Respuesta válida generada para %s", ctx.user_key)
         else:
-            # Necesitamos preguntar el propósito
-            await send_whatsapp_message(from_phone, f"Gracias {user_input_text.strip().split()[0]}. ¿Cuál es el propósito de tu cita?")
-            return {"status": "success", "action": "name_saved_transition_to_purpose_for_appointment"}
+            logger.warning("RAG: Respuesta LLM inválida para %s: '%s'", ctx.user_key, llm_api_response)
             
-    elif current_stage == STAGE_COLLECTING_PURPOSE:
-        # Validar y guardar el propósito de la cita
-        if not user_input_text or len(user_input_text.strip()) < 3:
-            await send_whatsapp_message(from_phone, "Por favor, describe brevemente el propósito de tu cita.")
-            return {"status": "error", "action": "invalid_purpose_for_appointment"}
-        
-        # Guardar el propósito y pasar a recolectar email
-        await update_user_state_db(db_session, current_user_state_obj, {
-            "purpose_of_inquiry": user_input_text.strip(),
-            "stage": STAGE_COLLECTING_EMAIL
-        })
-        
-        # Pedir el correo electrónico
-        first_name = current_user_state_obj.collected_name.split()[0] if current_user_state_obj.collected_name else ""  
-        await send_whatsapp_message(from_phone, f"Gracias {first_name}. ¿Cuál es tu correo electrónico?")
-        return {"status": "success", "action": "purpose_saved_transition_to_email_for_appointment"}
+        # Enviar respuesta al usuario
+        await send_whatsapp_message(ctx.from_phone, bot_response)
         
-    elif current_stage == STAGE_COLLECTING_EMAIL:
-        # Validar y guardar el correo electrónico
-        if not local_validators.is_valid_email(user_input_text.strip()):
-            await send_whatsapp_message(from_phone, "Por favor, proporciona un correo electrónico válido.")
-            return {"status": "error", "action": "invalid_email_for_appointment"}
+        # Agregar a historial con timestamp
+        await add_to_conversation_history(ctx.db_session, ctx.from_phone, ctx.platform_name, "assistant", bot_response, include_timestamp=True)
         
-        # Guardar el email y pasar a recolectar teléfono
-        await update_user_state_db(db_session, current_user_state_obj, {
-            "collected_email": user_input_text.strip(),
-            "stage": STAGE_COLLECTING_PHONE
+        # Actualizar estado del usuario para permitir conversación continua
+        await update_user_state_db(ctx.db_session, ctx.current_user_state_obj, {
+            "stage": STAGE_MAIN_CHAT_RAG
         })
         
-        # Pedir el número de teléfono
-        first_name = current_user_state_obj.collected_name.split()[0] if current_user_state_obj.collected_name else ""
-        await send_whatsapp_message(from_phone, f"Gracias {first_name}. Por último, ¿cuál es tu número de teléfono de contacto? (Puede ser este mismo número u otro diferente)")
-        return {"status": "success", "action": "email_saved_transition_to_phone_for_appointment"}
+        # Log claro de la transición
+        logger.info("RAG: Transición completada para %s: %s → %s", ctx.user_key, ctx.current_stage, STAGE_MAIN_CHAT_RAG)
         
-    elif current_stage == STAGE_COLLECTING_PHONE:
-        # Validar y guardar el teléfono
-        phone = user_input_text.strip()
-        
-        # Validación mejorada del número de teléfono
-        digits = ''.join(filter(str.isdigit, phone))
-        
-        # Criterios de validación:
-        # 1. Debe contener dígitos
-        # 2. La longitud debe estar entre 8 y 15 dígitos (estándar internacional)
-        # 3. No debe contener solo el mismo dígito repetido (ej: 999999999)
-        if not digits:
-            await send_whatsapp_message(from_phone, "Por favor, ingresa un número telefónico que contenga dígitos.")
-            return {"status": "error", "action": "invalid_phone_no_digits"}
-        elif len(digits) < 8 or len(digits) > 15:
-            await send_whatsapp_message(from_phone, "Por favor, ingresa un número telefónico válido (entre 8 y 15 dígitos).")
-            return {"status": "error", "action": "invalid_phone_length"}
-        elif len(set(digits)) == 1 and len(digits) >= 8:  # Todos los dígitos son iguales
-            await send_whatsapp_message(from_phone, "El número telefónico no parece válido. Por favor, verifica e intenta nuevamente.")
-            return {"status": "error", "action": "invalid_phone_repeated_digits"}
-        
-        # Guardar el teléfono y pasar a mostrar información de agendamiento
-        await update_user_state_db(db_session, current_user_state_obj, {
-            "collected_phone": phone,
-            "stage": STAGE_PROVIDING_SCHEDULING_INFO
-        })
+        return {"status": "success", "action": "rag_response_sent_transition_to_main_chat_rag"}
         
-        # Mostrar información de agendamiento
-        scheduling_response_msg = await _handle_providing_scheduling_info(db_session, current_user_state_obj, current_brand_id)
-        if scheduling_response_msg:
-            await send_whatsapp_message(from_phone, scheduling_response_msg)
+    except Exception as e_llm:
+        logger.error(f"Error LLM para {ctx.user_key}: {e_llm}", exc_info=True)
         
-        # Después de mostrar la info, transicionar a chat RAG para preguntas de seguimiento
-        await update_user_state_db(db_session, current_user_state_obj, {"stage": STAGE_MAIN_CHAT_RAG})
-        return {"status": "success", "action": "all_data_collected_scheduling_info_provided"}
-        
-    elif current_stage == STAGE_PROVIDING_SCHEDULING_INFO:
-        # Este estado ahora significa que ya se mostró la info de Calendly.
-        # Cualquier mensaje aquí podría ser un "gracias", una pregunta de seguimiento, o una nueva consulta.
-        # Lo trataremos como una entrada para el chat RAG.
-        logger.info(f"Usuario {user_key} en STAGE_PROVIDING_SCHEDULING_INFO (post-display). Mensaje: '{user_input_text}'. Transicionando a RAG.")
-        await update_user_state_db(db_session, current_user_state_obj, {"stage": STAGE_MAIN_CHAT_RAG})
-        # La lógica de STAGE_MAIN_CHAT_RAG se encargará de este mensaje en la "siguiente" iteración o si la llamamos.
-        # Para evitar complejidad, asumimos que el siguiente webhook request con este mismo mensaje y el nuevo estado STAGE_MAIN_CHAT_RAG lo procesará.
-        # Alternativamente, podrías duplicar la lógica de RAG aquí.
-        # Por ahora, solo cambiamos el estado y enviamos un mensaje genérico si es la primera vez que entra aquí después de agendar.
-        # Si el `purpose_of_inquiry` todavía está con el texto de agendar, significa que es la primera vez.
-        if current_user_state_obj.purpose_of_inquiry and \
-           (current_user_state_obj.purpose_of_inquiry.startswith("🗓️") or "agendar" in current_user_state_obj.purpose_of_inquiry.lower()):
-            await update_user_state_db(db_session, current_user_state_obj, {"purpose_of_inquiry": "Seguimiento de agendamiento o nueva consulta"}) # Limpiar propósito
-        
-        # Llamaremos directamente a la lógica de RAG como si el estado ya fuera STAGE_MAIN_CHAT_RAG
-        # Esto evita esperar otro ciclo de webhook.
-        # Esencialmente, el código de STAGE_MAIN_CHAT_RAG se ejecutaría aquí.
-        # Para mantenerlo DRY, considera una función helper_process_rag_message.
-        # Por ahora, para ilustrar, duplicaré la lógica esencial:
-        if not current_brand_id:
-             await reset_user_to_brand_selection(db_session, current_user_state_obj); return {"status": "error"} # ...
-        
-        # --- INICIO LÓGICA RAG (duplicada/refactorizada de abajo) ---
-        normalized_brand_name_for_rag = normalize_brand_name(brand_name_display)
-        conversation_history_str = get_conversation_history(user_key)
-        system_prompt_template = BRAND_PROFILES.get(normalized_brand_name_for_rag, BRAND_PROFILES["default"])
+        # Mensaje más específico según el tipo de error
+        if "timeout" in str(e_llm).lower():
+            fallback_message = "Estoy tardando más de lo esperado. ¿Podrías intentar con una pregunta más corta o específica?"
+        elif "rate" in str(e_llm).lower():
+            fallback_message = "Hay mucha demanda en este momento. Por favor, intenta nuevamente en unos segundos."
+        else:
+            fallback_message = "Lo siento, no pude procesar tu consulta. Por favor, escribe 'menu' para volver al menú principal."
+            
+        await send_whatsapp_message(ctx.from_phone, fallback_message)
+        return {"status": "error", "action": "llm_error_in_awaiting_query_for_rag"}
+
+async def _handle_stage_collecting_name(ctx: ConversationContext) -> Dict[str, Any]:
+    """Valida y guarda el nombre del usuario para el agendamiento."""
+    # Validar y guardar el nombre del usuario
+    if not ctx.user_input_text or len(ctx.user_input_text.strip()) < 3:
+        await send_whatsapp_message(ctx.from_phone, "Por favor, proporciona tu nombre completo (al menos 3 caracteres).")
+        return {"status": "error", "action": "invalid_name_for_appointment"}
+    
+    # Guardar el nombre y pasar al siguiente estado (recolectar propósito)
+    await update_user_state_db(ctx.db_session, ctx.current_user_state_obj, {
+        "collected_name": ctx.user_input_text.strip(),
+        "stage": STAGE_COLLECTING_PURPOSE
+    })
+    
+    # Si ya tenemos un propósito del botón, podemos saltar este paso
+    if ctx.current_user_state_obj.purpose_of_inquiry and not ctx.current_user_state_obj.purpose_of_inquiry.startswith("🗓️"):
+        # Ya tenemos un propósito válido, pasar a recolectar email
+        await update_user_state_db(ctx.db_session, ctx.current_user_state_obj, {"stage": STAGE_COLLECTING_EMAIL})
+        await send_whatsapp_message(ctx.from_phone, f"Gracias {ctx.user_input_text.strip().split()[0]}. ¿Cuál es tu correo electrónico?")
+        return {"status": "success", "action": "name_saved_skip_purpose_for_appointment"}
+    else:
+        # Necesitamos preguntar el propósito
+        await send_whatsapp_message(ctx.from_phone, f"Gracias {ctx.user_input_text.strip().split()[0]}. ¿Cuál es el propósito de tu cita?")
+        return {"status": "success", "action": "name_saved_transition_to_purpose_for_appointment"}
+
+async def _handle_stage_collecting_purpose(ctx: ConversationContext) -> Dict[str, Any]:
+    """Valida y guarda el propósito de la cita."""
+    # Validar y guardar el propósito de la cita
+    if not ctx.user_input_text or len(ctx.user_input_text.strip()) < 3:
+        await send_whatsapp_message(ctx.from_phone, "Por favor, describe brevemente el propósito de tu cita.")
+        return {"status": "error", "action": "invalid_purpose_for_appointment"}
+    
+    # Guardar el propósito y pasar a recolectar email
+    await update_user_state_db(ctx.db_session, ctx.current_user_state_obj, {
+        "purpose_of_inquiry": ctx.user_input_text.strip(),
+        "stage": STAGE_COLLECTING_EMAIL
+    })
+    
+    # Pedir el correo electrónico
+    first_name = ctx.current_user_state_obj.collected_name.split()[0] if ctx.current_user_state_obj.collected_name else ""  
+    await send_whatsapp_message(ctx.from_phone, f"Gracias {first_name}. ¿Cuál es tu correo electrónico?")
+    return {"status": "success", "action": "purpose_saved_transition_to_email_for_appointment"}
+
+async def _handle_stage_collecting_email(ctx: ConversationContext) -> Dict[str, Any]:
+    """Valida y guarda el correo electrónico del usuario."""
+    # Validar y guardar el correo electrónico
+    if not local_validators.is_valid_email(ctx.user_input_text.strip()):
+        await send_whatsapp_message(ctx.from_phone, "Por favor, proporciona un correo electrónico válido.")
+        return {"status": "error", "action": "invalid_email_for_appointment"}
+    
+    # Guardar el email y pasar a recolectar teléfono
+    await update_user_state_db(ctx.db_session, ctx.current_user_state_obj, {
+        "collected_email": ctx.user_input_text.strip(),
+        "stage": STAGE_COLLECTING_PHONE
+    })
+    
+    # Pedir el número de teléfono
+    first_name = ctx.current_user_state_obj.collected_name.split()[0] if ctx.current_user_state_obj.collected_name else ""
+    await send_whatsapp_message(ctx.from_phone, f"Gracias {first_name}. Por último, ¿cuál es tu número de teléfono de contacto? (Puede ser este mismo número u otro diferente)")
+    return {"status": "success", "action": "email_saved_transition_to_phone_for_appointment"}
+
+async def _handle_stage_collecting_phone(ctx: ConversationContext) -> Dict[str, Any]:
+    """Valida el teléfono y muestra la información de agendamiento."""
+    # Validar y guardar el teléfono
+    phone = ctx.user_input_text.strip()
+    
+    # Validación mejorada del número de teléfono
+    digits = ''.join(filter(str.isdigit, phone))
+    
+    # Criterios de validación:
+    # 1. Debe contener dígitos
+    # 2. La longitud debe estar entre 8 y 15 dígitos (estándar internacional)
+    # 3. No debe contener solo el mismo dígito repetido (ej: 999999999)
+    if not digits:
+        await send_whatsapp_message(ctx.from_phone, "Por favor, ingresa un número telefónico que contenga dígitos.")
+        return {"status": "error", "action": "invalid_phone_no_digits"}
+    elif len(digits) < 8 or len(digits) > 15:
+        await send_whatsapp_message(ctx.from_phone, "Por favor, ingresa un número telefónico válido (entre 8 y 15 dígitos).")
+        return {"status": "error", "action": "invalid_phone_length"}
+    elif len(set(digits)) == 1 and len(digits) >= 8:  # Todos los dígitos son iguales
+        await send_whatsapp_message(ctx.from_phone, "El número telefónico no parece válido. Por favor, verifica e intenta nuevamente.")
+        return {"status": "error", "action": "invalid_phone_repeated_digits"}
+    
+    # Guardar el teléfono y pasar a mostrar información de agendamiento
+    await update_user_state_db(ctx.db_session, ctx.current_user_state_obj, {
+        "collected_phone": phone,
+        "stage": STAGE_PROVIDING_SCHEDULING_INFO
+    })
+    
+    # Mostrar información de agendamiento
+    scheduling_response_msg = await _handle_providing_scheduling_info(ctx.db_session, ctx.current_user_state_obj, ctx.current_brand_id)
+    if scheduling_response_msg:
+        await send_whatsapp_message(ctx.from_phone, scheduling_response_msg)
+    
+    # Después de mostrar la info, transicionar a chat RAG para preguntas de seguimiento
+    await update_user_state_db(ctx.db_session, ctx.current_user_state_obj, {"stage": STAGE_MAIN_CHAT_RAG})
+    return {"status": "success", "action": "all_data_collected_scheduling_info_provided"}
+
+async def _handle_stage_providing_scheduling_info(ctx: ConversationContext) -> Dict[str, Any]:
+    """Atiende mensajes posteriores a mostrar la información de agendamiento."""
+    # Este estado ahora significa que ya se mostró la info de Calendly.
+    # Cualquier mensaje aquí podría ser un "gracias", una pregunta de seguimiento, o una nueva consulta.
+    # Lo trataremos como una entrada para el chat RAG.
+    logger.info("Usuario %s en STAGE_PROVIDING_SCHEDULING_INFO (post-display). Mensaje: '%s'. Transicionando a RAG.", ctx.user_key, ctx.user_input_text)
+    await update_user_state_db(ctx.db_session, ctx.current_user_state_obj, {"stage": STAGE_MAIN_CHAT_RAG})
+    # La lógica de STAGE_MAIN_CHAT_RAG se encargará de este mensaje en la "siguiente" iteración o si la llamamos.
+    # Para evitar complejidad, asumimos que el siguiente webhook request con este mismo mensaje y el nuevo estado STAGE_MAIN_CHAT_RAG lo procesará.
+    # Alternativamente, podrías duplicar la lógica de RAG aquí.
+    # Por ahora, solo cambiamos el estado y enviamos un mensaje genérico si es la primera vez que entra aquí después de agendar.
+    # Si el `purpose_of_inquiry` todavía está con el texto de agendar, significa que es la primera vez.
+    if ctx.current_user_state_obj.purpose_of_inquiry and \
+       (ctx.current_user_state_obj.purpose_of_inquiry.startswith("🗓️") or "agendar" in ctx.current_user_state_obj.purpose_of_inquiry.lower()):
+        await update_user_state_db(ctx.db_session, ctx.current_user_state_obj, {"purpose_of_inquiry": "Seguimiento de agendamiento o nueva consulta"}) # Limpiar propósito
+    
+    # Llamaremos directamente a la lógica de RAG como si el estado ya fuera STAGE_MAIN_CHAT_RAG
+    # Esto evita esperar otro ciclo de webhook.
+    # Esencialmente, el código de STAGE_MAIN_CHAT_RAG se ejecutaría aquí.
+    # Para mantenerlo DRY, considera una función helper_process_rag_message.
+    # Por ahora, para ilustrar, duplicaré la lógica esencial:
+    if not ctx.current_brand_id:
+         await reset_user_to_brand_selection(ctx.db_session, ctx.current_user_state_obj); return {"status": "error"} # ...
+    
+    # --- INICIO LÓGICA RAG (duplicada/refactorizada de abajo) ---
+    normalized_brand_name_for_rag = ctx.brand_normalized
+    conversation_history_str = get_conversation_history(ctx.user_key)
+    system_prompt_template = BRAND_PROFILES.get(normalized_brand_name_for_rag, BRAND_PROFILES["default"])
+    
+    # Se corrigió la llamada a la función correcta de RAG
+    relevant_docs = await search_relevant_documents(ctx.user_input_text, target_brand=normalized_brand_name_for_rag)
+    context_from_docs = format_context_from_docs(relevant_docs)
+    
+    # Log del contexto RAG para verificación
+    logger.debug("CONTEXTO_RAG_PARA_LLM (desde STAGE_PROVIDING_SCHEDULING_INFO): '''%s'''", context_from_docs)
+
+    full_prompt = build_llm_prompt(
+        brand_name=ctx.brand_name_display,  # Usar el nombre original para correcta selección de perfil
+        user_query=ctx.user_input_text,
+        context=context_from_docs,
+        conversation_history=conversation_history_str,
+        user_collected_name=ctx.current_user_state_obj.collected_name if ctx.current_user_state_obj else None,
+        is_first_turn=True # Permitir saludo inicial cuando viene de scheduling
+    )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Prompt LLM (desde STAGE_PROVIDING_SCHEDULING_INFO) para %s:\n%s...", ctx.user_key, full_prompt[:500])
+    try:
+        # Obtener el cliente HTTP para LLM desde el estado de la aplicación
+        llm_http_client = ctx.request.app.state.llm_http_client
+        if not llm_http_client:
+            logger.error(f"Error crítico: Cliente HTTP para LLM no disponible en app.state para usuario {ctx.user_key}")
+            await send_whatsapp_message(ctx.from_phone, "Problemas con IA. Intenta de nuevo o 'menú'.")
+            return {"status": "error", "action": "llm_http_client_not_available"}
+            
+        # Obtener respuesta del LLM pasando explícitamente el cliente HTTP
+        llm_api_response = await get_llm_response(full_prompt, http_client=llm_http_client)
+        bot_response = llm_api_response or "No pude generar una respuesta. Intenta de nuevo."
+        await send_whatsapp_message(ctx.from_phone, bot_response)
+        await add_to_conversation_history(ctx.db_session, ctx.from_phone, ctx.platform_name, "assistant", bot_response)
+        # Podría volver a STAGE_AWAITING_ACTION o quedarse en RAG. Dejémoslo en RAG.
+        # await update_user_state_db(db_session, current_user_state_obj, {"stage": STAGE_AWAITING_ACTION}) 
+    except Exception as e_llm:
+        logger.error(f"Error LLM (desde STAGE_PROVIDING_SCHEDULING_INFO) para {ctx.user_key}: {e_llm}", exc_info=True)
+        await send_whatsapp_message(ctx.from_phone, "Problemas con IA. Intenta de nuevo o 'menú'.")
+    return {"status": "success", "action": "rag_response_after_scheduling_info"}
+    # --- FIN LÓGICA RAG ---
+
+async def _try_handle_scheduling(ctx: ConversationContext) -> Optional[Dict[str, Any]]:
+    """Responde con un enlace de agendamiento si el mensaje expresa esa intención.
+    
+    Escalera de enlaces: enlace personalizado de Calendly → CALENDLY_GENERAL_SCHEDULING_LINK →
+    calendly_link del perfil de marca. Devuelve None si no hay intención de agendar.
+    """
+    if not _MAIN_CHAT_SCHEDULING_RE.search(ctx.normalized_input):
+        return None
+    logger.info("Usuario %s expresó intención de agendamiento en STAGE_MAIN_CHAT_RAG: '%s'", ctx.user_key, ctx.user_input_text)
+    company_name = ctx.company_obj.name if ctx.company_obj else ctx.brand_name_display
+    
+    # Usar la misma lógica de obtención de enlaces que en _handle_providing_scheduling_info
+    # para garantizar consistencia en todos los enlaces de agendamiento
+    scheduling_link_url = None
+    action = "scheduling_link_sent_from_main_chat"
+    try:
+        # Usar el nombre del perfil si está disponible
+        name_for_calendly = ctx.current_user_state_obj.collected_name or "Invitado"
+        email_for_calendly = ctx.current_user_state_obj.collected_email
         
-        # Se corrigió la llamada a la función correcta de RAG
-        relevant_docs = await search_relevant_documents(user_input_text, target_brand=normalized_brand_name_for_rag)
-        context_from_docs = format_context_from_docs(relevant_docs)
+        # Validar email si es requerido por Calendly
+        if email_for_calendly and not local_validators.is_valid_email(email_for_calendly):
+            logger.warning("Email '%s' no válido para %s. No se usará para Calendly.", email_for_calendly, ctx.user_key)
+            email_for_calendly = None
         
-        # Log del contexto RAG para verificación
-        logger.info(f"CONTEXTO_RAG_PARA_LLM (desde STAGE_PROVIDING_SCHEDULING_INFO): '''{context_from_docs}'''")
-
-        full_prompt = build_llm_prompt(
-            brand_name=brand_name_display,  # Usar el nombre original para correcta selección de perfil
-            user_query=user_input_text,
-            context=context_from_docs,
-            conversation_history=conversation_history_str,
-            user_collected_name=current_user_state_obj.collected_name if current_user_state_obj else None,
-            is_first_turn=True # Permitir saludo inicial cuando viene de scheduling
+        # Generar el enlace personalizado
+        scheduling_link_url = await get_scheduling_link(
+            settings.CALENDLY_EVENT_TYPE_URI,
+            name=name_for_calendly,
+            email=email_for_calendly
         )
-        logger.debug(f"Prompt LLM (desde STAGE_PROVIDING_SCHEDULING_INFO) para {user_key}:\n{full_prompt[:500]}...")
-        try:
-            # Obtener el cliente HTTP para LLM desde el estado de la aplicación
-            llm_http_client = request.app.state.llm_http_client
-            if not llm_http_client:
-                logger.error(f"Error crítico: Cliente HTTP para LLM no disponible en app.state para usuario {user_key}")
-                await send_whatsapp_message(from_phone, "Problemas con IA. Intenta de nuevo o 'menú'.")
-                return {"status": "error", "action": "llm_http_client_not_available"}
-                
-            # Obtener respuesta del LLM pasando explícitamente el cliente HTTP
-            llm_api_response = await get_llm_response(full_prompt, http_client=llm_http_client)
-            bot_response = llm_api_response or "No pude generar una respuesta. Intenta de nuevo."
-            await send_whatsapp_message(from_phone, bot_response)
-            await add_to_conversation_history(db_session, from_phone, platform_name, "assistant", bot_response)
-            # Podría volver a STAGE_AWAITING_ACTION o quedarse en RAG. Dejémoslo en RAG.
-            # await update_user_state_db(db_session, current_user_state_obj, {"stage": STAGE_AWAITING_ACTION}) 
-        except Exception as e_llm:
-            logger.error(f"Error LLM (desde STAGE_PROVIDING_SCHEDULING_INFO) para {user_key}: {e_llm}", exc_info=True)
-            await send_whatsapp_message(from_phone, "Problemas con IA. Intenta de nuevo o 'menú'.")
-        return {"status": "success", "action": "rag_response_after_scheduling_info"}
-        # --- FIN LÓGICA RAG ---
-
-
-    elif current_stage == STAGE_MAIN_CHAT_RAG:
-        logger.info(f"Procesando mensaje para usuario {user_key} en estado STAGE_MAIN_CHAT_RAG: '{user_input_text}'")
+    except Exception as e:
+        logger.error("Error al generar enlace de Calendly para %s: %s", ctx.user_key, str(e), exc_info=True)
+    
+    if not (scheduling_link_url and scheduling_link_url.strip()):
+        scheduling_link_url = None
+        # Respaldo: enlace general configurado en las variables de entorno
+        if getattr(settings, "CALENDLY_GENERAL_SCHEDULING_LINK", None):
+            scheduling_link_url = settings.CALENDLY_GENERAL_SCHEDULING_LINK
+            action = "scheduling_link_sent_from_main_chat_general"
+            logger.info("Usando enlace general de Calendly para %s: %s", ctx.user_key, scheduling_link_url)
+        # Último recurso: enlace de Calendly del perfil de marca
+        elif ctx.brand_calendly_link:
+            scheduling_link_url = ctx.brand_calendly_link
+            action = "scheduling_link_sent_from_brand_profile"
+            logger.info("Usando enlace de Calendly del perfil de marca para %s: %s", ctx.user_key, scheduling_link_url)
+    else:
+        logger.info("Enlace de Calendly generado para %s: %s", ctx.user_key, scheduling_link_url)
+    
+    if scheduling_link_url:
+        scheduling_message = f"¡Claro! Con gusto te ayudo a agendar. Puedes elegir un horario con *{company_name}* aquí:\n\n{scheduling_link_url}\n\n¿Necesitas algo más?"
+        await send_whatsapp_message(ctx.from_phone, scheduling_message)
+        await add_to_conversation_history(ctx.db_session, ctx.from_phone, ctx.platform_name, "assistant", scheduling_message)
+        return {"status": "success", "action": action}
+    
+    # Si no hay ningún enlace disponible
+    logger.warning("Intención de agendamiento detectada pero no se pudo obtener URL para %s", ctx.user_key)
+    await send_whatsapp_message(ctx.from_phone, f"Entiendo que deseas agendar una cita con {company_name}. Por favor, comunícate directamente con ellos para coordinar una cita, ya que no tengo disponible un enlace de agendamiento en este momento.")
+    return {"status": "partial_success", "action": "scheduling_intent_acknowledged_no_url"}
+
+async def _handle_stage_main_chat_rag(ctx: ConversationContext) -> Dict[str, Any]:
+    """Procesa un turno de conversación RAG continua."""
+    logger.info("Procesando mensaje para usuario %s en estado STAGE_MAIN_CHAT_RAG: '%s'", ctx.user_key, ctx.user_input_text)
+    
+    if not ctx.current_brand_id:
+        logger.warning("Usuario %s en STAGE_MAIN_CHAT_RAG sin current_brand_id. Reseteando.", ctx.user_key)
+        await reset_user_to_brand_selection(ctx.db_session, ctx.current_user_state_obj)
+        selection_message = await get_company_selection_message(ctx.db_session, ctx.current_user_state_obj)
+        await send_whatsapp_message(ctx.from_phone, selection_message)
+        return {"status": "error", "action": "reset_missing_brand_in_rag"}
         
-        if not current_brand_id:
-            logger.warning(f"Usuario {user_key} en STAGE_MAIN_CHAT_RAG sin current_brand_id. Reseteando.")
-            await reset_user_to_brand_selection(db_session, current_user_state_obj)
-            selection_message = await get_company_selection_message(db_session, current_user_state_obj)
-            await send_whatsapp_message(from_phone, selection_message)
-            return {"status": "error", "action": "reset_missing_brand_in_rag"}
-            
-        # Detectar intención de agendamiento
-        company_obj = await get_company_by_id(db_session, current_brand_id)
-        if company_obj and (_contains_scheduling_keywords(user_input_text) or detect_scheduling_intent(user_input_text)):
-            logger.info(f"Usuario {user_key} expresó intención de agendamiento en STAGE_MAIN_CHAT_RAG: '{user_input_text}'")
-            
-            # Usar la misma lógica de obtención de enlaces que en _handle_providing_scheduling_info
-            # para garantizar consistencia en todos los enlaces de agendamiento
-            try:
-                # Usar el nombre del perfil si está disponible
-                name_for_calendly = current_user_state_obj.collected_name or "Invitado"
-                email_for_calendly = current_user_state_obj.collected_email
-                
-                # Validar email si es requerido por Calendly
-                if email_for_calendly and not local_validators.is_valid_email(email_for_calendly):
-                    logger.warning(f"Email '{email_for_calendly}' no válido para {user_key}. No se usará para Calendly.")
-                    email_for_calendly = None
-                
-                # Obtener el tipo de evento adecuado
-                event_type_uri = settings.CALENDLY_EVENT_TYPE_URI
-                
-                # Generar el enlace personalizado
-                scheduling_link_url = await get_scheduling_link(
-                    event_type_uri,
-                    name=name_for_calendly,
-                    email=email_for_calendly
-                )
-                
-                if scheduling_link_url and scheduling_link_url.strip():
-                    logger.info(f"Enlace de Calendly generado para {user_key}: {scheduling_link_url}")
-                    scheduling_message = f"¡Claro! Con gusto te ayudo a agendar. Puedes elegir un horario con *{company_obj.name}* aquí:\n\n{scheduling_link_url}\n\n¿Necesitas algo más?"
-                    await send_whatsapp_message(from_phone, scheduling_message)
-                    return {"status": "success", "action": "scheduling_link_sent_from_main_chat"}
-                else:
-                    # Intentar con el enlace general como respaldo
-                    if hasattr(settings, "CALENDLY_GENERAL_SCHEDULING_LINK") and settings.CALENDLY_GENERAL_SCHEDULING_LINK:
-                        scheduling_link_url = settings.CALENDLY_GENERAL_SCHEDULING_LINK
-                        logger.info(f"Usando enlace general de Calendly para {user_key}: {scheduling_link_url}")
-                        scheduling_message = f"¡Claro! Con gusto te ayudo a agendar. Puedes elegir un horario con *{company_obj.name}* aquí:\n\n{scheduling_link_url}\n\n¿Necesitas algo más?"
-                        await send_whatsapp_message(from_phone, scheduling_message)
-                        return {"status": "success", "action": "scheduling_link_sent_from_main_chat_general"}
-            except Exception as e:
-                logger.error(f"Error al generar enlace de Calendly para {user_key}: {str(e)}", exc_info=True)
-                
-            # En lugar de usar el enlace de la compañía como respaldo, siempre usar CALENDLY_GENERAL_SCHEDULING_LINK si está disponible
-            if hasattr(settings, "CALENDLY_GENERAL_SCHEDULING_LINK") and settings.CALENDLY_GENERAL_SCHEDULING_LINK:
-                scheduling_url = settings.CALENDLY_GENERAL_SCHEDULING_LINK
-                logger.info(f"Usando el enlace general de agendamiento configurado en las variables de entorno: {scheduling_url}")
-                scheduling_message = f"¡Claro! Con gusto te ayudo a agendar. Puedes elegir un horario con *{company_obj.name}* aquí:\n\n{scheduling_url}\n\n¿Necesitas algo más?"
-                await send_whatsapp_message(from_phone, scheduling_message)
-                return {"status": "success", "action": "scheduling_link_sent_from_env_variable"}
-                
-            # Si no hay ningún enlace disponible
-            logger.warning(f"Intención de agendamiento detectada pero no se pudo obtener URL para {user_key}")
-            await send_whatsapp_message(from_phone, f"Entiendo que deseas agendar una cita con {company_obj.name}. Por favor, comunícate directamente con ellos para coordinar una cita, ya que no tengo disponible un enlace de agendamiento en este momento.")
-            return {"status": "partial_success", "action": "scheduling_intent_acknowledged_no_url"}
-                
-        # Detectar solicitud de información de contacto
-        if company_obj and _contains_contact_info_keywords(user_input_text):
-            logger.info(f"Usuario {user_key} solicitó información de contacto en STAGE_MAIN_CHAT_RAG: '{user_input_text}'")
-            
-            # Generar respuesta con información de contacto
-            contact_info_message = await _handle_contact_info_request(db_session, current_brand_id)
-            await send_whatsapp_message(from_phone, contact_info_message)
-            
-            # Añadir a la conversación para mantener el historial
-            await add_to_conversation_history(db_session, from_phone, platform_name, "user", user_input_text)
-            await add_to_conversation_history(db_session, from_phone, platform_name, "assistant", contact_info_message)
+    # Detectar intención de agendamiento
+    scheduling_result = await _try_handle_scheduling(ctx)
+    if scheduling_result is not None:
+        return scheduling_result
             
-            return {"status": "success", "action": "contact_info_provided_from_main_chat"}
-            
-        # --- BLOQUE DE VERIFICACIÓN DE COMANDOS DE SALIDA ---
-        # Normalizar la entrada para mejorar la detección de palabras clave (asegurarse que es minúsculas)
-        normalized_input = user_input_text.lower().strip()
+    company_obj = ctx.company_obj
+    # Detectar solicitud de información de contacto
+    if company_obj and _contains_contact_info_keywords(ctx.normalized_input):
+        logger.info("Usuario %s solicitó información de contacto en STAGE_MAIN_CHAT_RAG: '%s'", ctx.user_key, ctx.user_input_text)
         
-        # Verificar si el mensaje contiene palabras de salida
-        if any(keyword in normalized_input for keyword in settings.EXIT_CONVERSATION_KEYWORDS):
-            company_obj = await get_company_by_id(db_session, current_brand_id)
-            if company_obj:
-                brand_name = company_obj.name
-                normalized_brand_name = normalize_brand_name(brand_name)
-                brand_profile = BRAND_PROFILES.get(normalized_brand_name, BRAND_PROFILES.get("default"))
-                farewell_message = brand_profile.get("farewell_message", "Gracias por contactarnos. ¡Hasta luego!")
-                await send_whatsapp_message(from_phone, farewell_message)
-                remove_last_user_message_from_history(user_key)
-                await reset_user_to_brand_selection(db_session, current_user_state_obj)
-                return {"status": "success", "action": "conversation_exit_farewell_sent_from_main_chat_rag"}
+        # Generar respuesta con información de contacto
+        contact_info_message = await _handle_contact_info_request(ctx.db_session, ctx.current_brand_id)
+        await send_whatsapp_message(ctx.from_phone, contact_info_message)
         
-        # Verificar si hay insultos o contenido inapropiado
-        if contains_inappropriate_content(normalized_input):
-            company_obj = await get_company_by_id(db_session, current_brand_id)
-            company_name = company_obj.name if company_obj else "nuestra marca"
-            polite_response = f"Entiendo tu frustración. Estoy aquí para ayudarte con información sobre {company_name}. ¿Puedo asistirte con algo más?"
-            await send_whatsapp_message(from_phone, polite_response)
-            remove_last_user_message_from_history(user_key)
-            return {"status": "handled", "action": "inappropriate_content_handled"}
-            
-        # Continuar con procesamiento normal RAG
-        exit_keywords_lower = [keyword.lower() for keyword in settings.EXIT_CONVERSATION_KEYWORDS]
+        # Añadir la respuesta a la conversación para mantener el historial
+        await add_to_conversation_history(ctx.db_session, ctx.from_phone, ctx.platform_name, "assistant", contact_info_message)
         
-        # Verificar si es un comando de salida (case insensitive y más flexible en la coincidencia)
-        is_exit_command = False
-        for keyword in exit_keywords_lower:
-            if normalized_input == keyword or normalized_input.startswith(keyword + " "):
-                is_exit_command = True
-                logger.info(f"Usuario {user_key} utilizó comando de salida detectado: '{user_input_text}' -> '{keyword}'")
-                break
-                
-        if is_exit_command:
-            logger.info(f"Usuario {user_key} utilizó palabra clave de salida en chat RAG: '{user_input_text}'")
-            
-            # Obtener el mensaje de despedida personalizado según la marca
-            company_obj = await get_company_by_id(db_session, current_brand_id)
-            if company_obj:
-                brand_name = company_obj.name
-                # Normalizar el nombre de la marca para buscar en BRAND_PROFILES
-                normalized_brand_name = normalize_brand_name(brand_name)
-                brand_profile = BRAND_PROFILES.get(normalized_brand_name, BRAND_PROFILES.get("default"))
-                
-                # Obtener el mensaje de despedida personalizado o usar un mensaje genérico
-                farewell_message = brand_profile.get("farewell_message", 
-                    "¡Gracias por su consulta! Ha sido un placer atenderle.\n\nLa conversación ha finalizado correctamente. Para iniciar una nueva consulta o seleccionar otra marca, simplemente envíe cualquier mensaje.\n\nQue tenga un excelente día. ¡Hasta pronto! 👋")
-                
-                # Enviar mensaje de despedida
-                await send_whatsapp_message(from_phone, farewell_message)
-                
-                # No registrar este mensaje como una consulta para el historial
-                # (Ya fue agregado antes, así que lo removemos)
-                remove_last_user_message_from_history(user_key)
-                
-                # Marcar explícitamente que la sesión terminó
-                await update_user_state_db(db_session, current_user_state_obj, {"session_explicitly_ended": True})
-                logger.info(f"Usuario {user_key}: Marca de sesión finalizada (session_explicitly_ended = True)")
-                
-                # Resetear explicitamente el estado del usuario a selección de marca
-                # Primero cambiamos stage directamente para evitar condición de carrera
-                current_user_state_obj.stage = STAGE_SELECTING_BRAND
-                
-                # Ahora forzamos el reseteo completo con force=True (doble seguridad)
-                await reset_user_to_brand_selection(db_session, current_user_state_obj, force=True)
-                logger.info(f"Usuario {user_key}: Reseteo forzado del estado a selección de marca completado.")
-                
-                # Asegurar que el flujo termina aquí
-                return {"status": "success", "action": "conversation_exit_completed_from_rag"}
-
-        # Verificar palabras clave para reinicio
-        if user_input_text.lower().strip() in RESET_KEYWORDS:
-            logger.info(f"Usuario {user_key} solicitó reinicio con palabra clave: '{user_input_text}'")
-            await reset_user_to_brand_selection(db_session, current_user_state_obj, force=True)
-            selection_message = await get_company_selection_message(db_session, current_user_state_obj)
-            await send_whatsapp_message(from_phone, selection_message)
-            return {"status": "success", "action": "reset_to_brand_selection_from_reset_keyword_in_main_chat_rag"}
+        return {"status": "success", "action": "contact_info_provided_from_main_chat"}
         
-        # Verificar palabras clave para agendar cita
-        normalized_input = user_input_text.lower().strip()
-        scheduling_keywords = ["agendar", "cita", "calendario", "reservar", "hablar", "contactar", "comunicar", "reunion"]
+    # --- BLOQUE DE VERIFICACIÓN DE COMANDOS DE SALIDA ---
+    # Entrada ya normalizada (minúsculas, sin espacios extremos) en handle_whatsapp_message
+    normalized_input = ctx.normalized_input
+    
+    # Verificar si el mensaje contiene palabras de salida
+    if _EXIT_CONVERSATION_RE.search(normalized_input):
+        company_obj = ctx.company_obj
+        if company_obj:
+            brand_name = company_obj.name
+            farewell_message = ctx.brand_farewell or "Gracias por contactarnos. ¡Hasta luego!"
+            await send_whatsapp_message(ctx.from_phone, farewell_message)
+            await reset_user_to_brand_selection(ctx.db_session, ctx.current_user_state_obj, delete_last_user_msg=True)
+            return {"status": "success", "action": "conversation_exit_farewell_sent_from_main_chat_rag"}
+    
+    # Verificar si hay insultos o contenido inapropiado
+    if contains_inappropriate_content(normalized_input):
+        company_obj = ctx.company_obj
+        company_name = company_obj.name if company_obj else "nuestra marca"
+        polite_response = f"Entiendo tu frustración. Estoy aquí para ayudarte con información sobre {company_name}. ¿Puedo asistirte con algo más?"
+        await send_whatsapp_message(ctx.from_phone, polite_response)
+        await remove_last_user_message_from_history(ctx.db_session, ctx.from_phone, ctx.platform_name)
+        return {"status": "handled", "action": "inappropriate_content_handled"}
         
-        if any(keyword in normalized_input for keyword in scheduling_keywords):
-            logger.info(f"Usuario {user_key} solicitó agendar cita con frase: '{user_input_text}'")
+    # Continuar con procesamiento normal RAG
+    # Verificar si es un comando de salida (case insensitive y más flexible en la coincidencia)
+    exit_command_match = _EXIT_COMMAND_RE.match(normalized_input)
+    if exit_command_match:
+        logger.info("Usuario %s utilizó palabra clave de salida en chat RAG: '%s' -> '%s'", ctx.user_key, ctx.user_input_text, exit_command_match.group(0).strip())
+        
+        # Obtener el mensaje de despedida personalizado según la marca
+        company_obj = ctx.company_obj
+        if company_obj:
+            brand_name = company_obj.name
+            # Obtener el mensaje de despedida personalizado o usar un mensaje genérico
+            farewell_message = ctx.brand_farewell or (
+                "¡Gracias por su consulta! Ha sido un placer atenderle.\n\nLa conversación ha finalizado correctamente. Para iniciar una nueva consulta o seleccionar otra marca, simplemente envíe cualquier mensaje.\n\nQue tenga un excelente día. ¡Hasta pronto! 👋")
             
-            # Obtener información de la compañía actual
-            company_obj = await get_company_by_id(db_session, current_brand_id)
-            # Verificar si existe una propiedad calendly_link en el perfil de marca
-            brand_name = company_obj.name if company_obj else "default"
-            normalized_brand_name = normalize_brand_name(brand_name)
-            brand_profile = BRAND_PROFILES.get(normalized_brand_name, BRAND_PROFILES.get("default"))
-            calendly_link = brand_profile.get("calendly_link")
+            # Enviar mensaje de despedida
+            await send_whatsapp_message(ctx.from_phone, farewell_message)
             
-            if calendly_link:
-                # Crear mensaje con enlace de Calendly
-                scheduling_message = f"¡Gracias por tu interés en agendar una cita! 📅\n\nPuedes hacerlo directamente a través del siguiente enlace:\n\n{calendly_link}\n\nUna vez agendada, recibirás una confirmación por correo electrónico. ¿Necesitas algo más?"
-                
-                # Enviar mensaje con el enlace
-                await send_whatsapp_message(from_phone, scheduling_message)
-                
-                # Añadir al historial de conversación
-                await add_to_conversation_history(db_session, from_phone, platform_name, "assistant", scheduling_message)
-                
-                return {"status": "success", "action": "scheduling_link_sent"}
-            else:
-                logger.warning(f"Usuario {user_key} solicitó agendar pero la compañía ID {current_brand_id} no tiene enlace de Calendly configurado")
-                # Continuamos con el flujo normal para que el LLM responda adecuadamente
+            # Reseteo a selección de marca, fin de sesión explícito y retirada del mensaje de salida
+            # del historial (ya fue agregado antes) en una sola actualización de UserState
+            await reset_user_to_brand_selection(
+                ctx.db_session, ctx.current_user_state_obj, force=True,
+                extra_fields={"session_explicitly_ended": True},
+                delete_last_user_msg=True
+            )
+            logger.info("Usuario %s: Sesión finalizada y estado reseteado a selección de marca.", ctx.user_key)
             
-        # Verificar caché de transiciones pendientes para RAG
-        if user_key in _pending_rag_transitions:
-            logger.info(f"Usuario {user_key} estaba en caché de transiciones pendientes RAG. Forzando estado STAGE_MAIN_CHAT_RAG")
-            current_user_state_obj.stage = STAGE_MAIN_CHAT_RAG
-            # Eliminar de la caché ya que estamos procesando correctamente el mensaje
-            _pending_rag_transitions.remove(user_key)
+            # Asegurar que el flujo termina aquí
+            return {"status": "success", "action": "conversation_exit_completed_from_rag"}
+
+    # Verificar palabras clave para reinicio
+    if ctx.normalized_input in _RESET_KEYWORDS_LOWER:
+        logger.info("Usuario %s solicitó reinicio con palabra clave: '%s'", ctx.user_key, ctx.user_input_text)
+        await reset_user_to_brand_selection(ctx.db_session, ctx.current_user_state_obj, force=True)
+        selection_message = await get_company_selection_message(ctx.db_session, ctx.current_user_state_obj)
+        await send_whatsapp_message(ctx.from_phone, selection_message)
+        return {"status": "success", "action": "reset_to_brand_selection_from_reset_keyword_in_main_chat_rag"}
     
-        # Añadir la consulta del usuario al historial de la conversación
-        await add_to_conversation_history(db_session, from_phone, platform_name, "user", user_input_text)
-        
-        # Lógica de RAG / LLM
-        normalized_brand_name_for_rag = normalize_brand_name(brand_name_display)
-        # La corrección para Javier Bazán y otros casos especiales ya se maneja
-        # directamente en la función normalize_brand_name
-        conversation_history = await get_conversation_history(db_session, from_phone, platform_name)
-        logger.info(f"Buscando documentos RAG para: '{user_input_text}' en marca '{normalized_brand_name_for_rag}'")
+    # Verificar caché de transiciones pendientes para RAG
+    if ctx.user_key in _pending_rag_transitions:
+        logger.info("Usuario %s estaba en caché de transiciones pendientes RAG. Forzando estado STAGE_MAIN_CHAT_RAG", ctx.user_key)
+        ctx.current_user_state_obj.stage = STAGE_MAIN_CHAT_RAG
+        # Eliminar de la caché ya que estamos procesando correctamente el mensaje
+        _pending_rag_transitions.remove(ctx.user_key)
+
+    # Lógica de RAG / LLM
+    normalized_brand_name_for_rag = ctx.brand_normalized
+    # La corrección para Javier Bazán y otros casos especiales ya se maneja
+    # directamente en la función normalize_brand_name
+    logger.info("Buscando documentos RAG para: '%s' en marca '%s'", ctx.user_input_text, normalized_brand_name_for_rag)
+    
+    # Obtener la instancia del retriever del estado de la aplicación
+    retriever_instance = ctx.request.app.state.retriever
+    if not retriever_instance:
+        logger.error("No se pudo obtener la instancia del retriever del estado de la aplicación")
+        return {"status": "error", "message": "Error interno: componente de búsqueda no disponible"}
         
-        # Obtener la instancia del retriever del estado de la aplicación
-        retriever_instance = request.app.state.retriever
-        if not retriever_instance:
-            logger.error("No se pudo obtener la instancia del retriever del estado de la aplicación")
-            return {"status": "error", "message": "Error interno: componente de búsqueda no disponible"}
-            
-        # Usar la función search_relevant_documents con el retriever
-        relevant_docs = await search_relevant_documents(
+    # Búsqueda vectorial e historial son independientes: se lanzan en paralelo.
+    fetches = (
+        lambda: search_relevant_documents(
             retriever_instance=retriever_instance,
-            user_query=user_input_text,
+            user_query=ctx.user_input_text,
             target_brand=normalized_brand_name_for_rag,
             k_final=getattr(settings, "RAG_NUM_DOCS_TO_RETRIEVE", 3)
-        )
-        context_from_docs = format_context_from_docs(relevant_docs)
-        
-        # Detectar si no hay suficiente contexto relevante
-        has_relevant_context = bool(relevant_docs) and len(context_from_docs.strip()) > 50
+        ),
+        lambda: get_conversation_history(ctx.db_session, ctx.from_phone, ctx.platform_name),
+    )
+    results = list(await asyncio.gather(*(fetch() for fetch in fetches), return_exceptions=True))
+    for i, result in enumerate(results):
+        if isinstance(result, Exception):
+            # Reintento secuencial de la llamada que falló en paralelo
+            logger.warning("RAG: Falló la obtención paralela #%s para %s: %s. Reintentando en secuencia.", i, ctx.user_key, result)
+            results[i] = await fetches[i]()
+    relevant_docs, conversation_history = results
+    company_obj = ctx.company_obj
+    context_from_docs = format_context_from_docs(relevant_docs)
+    
+    # Detectar si no hay suficiente contexto relevante
+    has_relevant_context = bool(relevant_docs) and len(context_from_docs.strip()) > 50
 
-        # Determinar si es primer turno basado en el historial de conversación
-        is_first_interaction = not conversation_history or len(conversation_history) <= 2
-        
-        # Usar el nombre original de la marca para la búsqueda del perfil
-        full_prompt = build_llm_prompt(
-            brand_name=brand_name_display,  # Usar el nombre original, no el normalizado
-            user_query=user_input_text,
-            context=context_from_docs,
-            conversation_history=conversation_history,
-            user_collected_name=current_user_state_obj.collected_name if current_user_state_obj else None,
-            is_first_turn=is_first_interaction # Determina dinámicamente si es primer turno
-        )
-        logger.debug(f"Prompt completo para LLM (usuario {user_key} en STAGE_MAIN_CHAT_RAG):\n{full_prompt[:500]}...") # Loggear solo una parte
+    # Determinar si es primer turno basado en el historial de conversación
+    is_first_interaction = not conversation_history or len(conversation_history) <= 2
+    
+    # Usar el nombre original de la marca para la búsqueda del perfil
+    full_prompt = build_llm_prompt(
+        brand_name=ctx.brand_name_display,  # Usar el nombre original, no el normalizado
+        user_query=ctx.user_input_text,
+        context=context_from_docs,
+        conversation_history=conversation_history,
+        user_collected_name=ctx.current_user_state_obj.collected_name if ctx.current_user_state_obj else None,
+        is_first_turn=is_first_interaction # Determina dinámicamente si es primer turno
+    )
+    if logger.isEnabledFor(logging.DEBUG):  # Evita cortar el prompt si DEBUG está apagado
+        logger.debug("Prompt completo para LLM (usuario %s en STAGE_MAIN_CHAT_RAG):\n%s...", ctx.user_key, full_prompt[:500]) # Loggear solo una parte
 
-        try:
-            # Obtener respuesta del LLM
-            # Obtener el cliente HTTP para LLM desde el estado de la aplicación
+    try:
+        # Obtener respuesta del LLM
+        # Obtener el cliente HTTP para LLM desde el estado de la aplicación
 
-            llm_http_client = request.app.state.llm_http_client
+        llm_http_client = ctx.request.app.state.llm_http_client
 
-            if not llm_http_client:
+        if not llm_http_client:
 
-                logger.error(f"Error crítico: Cliente HTTP para LLM no disponible en app.state para usuario {user_key}")
+            logger.error("Error crítico: Cliente HTTP para LLM no disponible en app.state para usuario %s", ctx.user_key)
 
-                await send_whatsapp_message(from_phone, "Lo siento, estoy experimentando problemas técnicos. Por favor, intenta más tarde o escribe 'menú' para otras opciones.")
+            await send_whatsapp_message(ctx.from_phone, "Lo siento, estoy experimentando problemas técnicos. Por favor, intenta más tarde o escribe 'menú' para otras opciones.")
 
-                return {"status": "error", "action": "llm_http_client_not_available"}
+            return {"status": "error", "action": "llm_http_client_not_available"}
 
-                
+            
 
-            # Si no hay contexto relevante, dar una respuesta más útil en lugar de generar respuesta genérica
-            if not has_relevant_context:
-                # Obtener el perfil de la marca para personalizar la respuesta
-                company_obj = await get_company_by_id(db_session, current_brand_id)
-                brand_name = company_obj.name if company_obj else "nuestra empresa"
-                
-                # Respuestas naturales y útiles cuando no se encuentra información específica
-                alternative_options = [
-                    f"¡Hola! Veo que estás interesado en saber más. Aunque no tengo los detalles específicos sobre eso, puedo contarte sobre los servicios y productos de {brand_name}. ¿Te gustaría que te cuente más sobre lo que ofrecemos?",
-                    f"¡Gracias por tu consulta! Actualmente no tengo esa información a mano, pero estaré encantado de ayudarte con otros aspectos de {brand_name}. ¿Te gustaría saber sobre nuestros servicios, horarios de atención o cómo contactarnos?",
-                    f"¡Interesante pregunta! Aunque no tengo esa información específica en este momento, puedo ayudarte con muchas otras consultas sobre {brand_name}. ¿Te gustaría que te cuente sobre nuestros productos destacados o servicios más populares?",
-                    f"¡Hola! Me encantaría ayudarte con eso. Mientras actualizo mi base de conocimiento, ¿podrías contarme más sobre lo que necesitas? Mientras tanto, podría informarte sobre otros aspectos de {brand_name} que podrían ser de tu interés.",
-                    f"Gracias por tu paciencia. Aunque no tengo la respuesta exacta ahora mismo, en {brand_name} valoramos mucho tus consultas. ¿Te gustaría que te ayude con información sobre nuestros servicios o que te ponga en contacto con un asesor especializado?"
-                ]
-                
-                # Elegir aleatoriamente para dar variedad
-                import random
-                bot_response = random.choice(alternative_options)
-                
-                # Si el usuario ha recibido respuestas sin contexto varias veces seguidas, ofrecer reiniciar
-                user_no_context_count = getattr(handle_whatsapp_message, f"_no_context_count_{user_key}", 0) + 1
-                setattr(handle_whatsapp_message, f"_no_context_count_{user_key}", user_no_context_count)
-                
-                if user_no_context_count >= 2:
-                    bot_response += "\n\nParece que estoy teniendo dificultades para responder a tus preguntas actuales. ¿Quieres reiniciar la conversación? Escribe 'reiniciar' o 'salir'."
-                    setattr(handle_whatsapp_message, f"_no_context_count_{user_key}", 0)  # Reiniciar contador
+        response_already_sent = False
+        # Si no hay contexto relevante, dar una respuesta más útil en lugar de generar respuesta genérica
+        if not has_relevant_context:
+            # Personalizar la respuesta con la compañía ya obtenida para este turno
+            brand_name = company_obj.name if company_obj else "nuestra empresa"
+            
+            # Respuesta útil elegida aleatoriamente entre las plantillas para dar variedad
+            bot_response = random.choice(_NO_CONTEXT_TEMPLATES).format(brand=brand_name)
+            
+            # Si el usuario ha recibido respuestas sin contexto varias veces seguidas, ofrecer reiniciar
+            user_no_context_count = _bump_no_context_count(ctx.user_key)
+            
+            if user_no_context_count >= 2:
+                bot_response += "\n\nParece que estoy teniendo dificultades para responder a tus preguntas actuales. ¿Quieres reiniciar la conversación? Escribe 'reiniciar' o 'salir'."
+                _no_context_counts.pop(ctx.user_key, None)  # Reiniciar contador
+        else:
+            # Resetear contador de "sin contexto" si hay contexto
+            _no_context_counts.pop(ctx.user_key, None)
+            
+            # Con streaming los párrafos se envían a medida que el LLM los genera
+            streamed_response = None
+            if settings.LLM_STREAMING_ENABLED:
+                streamed_response = await _stream_llm_reply_to_whatsapp(ctx.from_phone, full_prompt, llm_http_client)
+            
+            if streamed_response is not None:
+                bot_response = streamed_response
+                response_already_sent = True
             else:
-                # Resetear contador de "sin contexto" si hay contexto
-                setattr(handle_whatsapp_message, f"_no_context_count_{user_key}", 0)
-                
                 # Obtener respuesta del LLM pasando explícitamente el cliente HTTP
                 llm_api_response = await get_llm_response(full_prompt, http_client=llm_http_client)
                 
                 bot_response = "No pude generar una respuesta en este momento. ¿Podrías intentar reformular tu pregunta o escribir 'menú' para otras opciones?"
                 if llm_api_response:
                     bot_response = llm_api_response.strip()
+        
+        # Enviar respuesta al usuario
+        if not response_already_sent:
+            await send_whatsapp_message(ctx.from_phone, bot_response)
+        await add_to_conversation_history(ctx.db_session, ctx.from_phone, ctx.platform_name, "assistant", bot_response)
+        
+        # Decidir si después de una respuesta RAG vuelve a STAGE_AWAITING_ACTION o se queda en RAG.
+        # Para una conversación fluida, es mejor quedarse en STAGE_MAIN_CHAT_RAG.
+        # Si quieres que cada respuesta RAG termine y muestre el menú de acciones, cambia el estado:
+        # await update_user_state_db(db_session, current_user_state_obj, {"stage": STAGE_AWAITING_ACTION})
+        # logger.info(f"Usuario {user_key} respondió con RAG, volviendo a STAGE_AWAITING_ACTION.")
+        
+        # Si el proceso RAG fue exitoso y el usuario estaba en la caché de transiciones, eliminarlo
+        if ctx.user_key in _pending_rag_transitions:
+            _pending_rag_transitions.remove(ctx.user_key)
+            logger.info("DIAGNÓSTICO-RAG: Usuario %s procesado exitosamente en flujo RAG y eliminado de caché de transiciones", ctx.user_key)
             
-            # Enviar respuesta al usuario
-            await send_whatsapp_message(from_phone, bot_response)
-            await add_to_conversation_history(db_session, from_phone, platform_name, "assistant", bot_response)
-            
-            # Decidir si después de una respuesta RAG vuelve a STAGE_AWAITING_ACTION o se queda en RAG.
-            # Para una conversación fluida, es mejor quedarse en STAGE_MAIN_CHAT_RAG.
-            # Si quieres que cada respuesta RAG termine y muestre el menú de acciones, cambia el estado:
-            # await update_user_state_db(db_session, current_user_state_obj, {"stage": STAGE_AWAITING_ACTION})
-            # logger.info(f"Usuario {user_key} respondió con RAG, volviendo a STAGE_AWAITING_ACTION.")
-            
-            # Si el proceso RAG fue exitoso y el usuario estaba en la caché de transiciones, eliminarlo
-            if user_key in _pending_rag_transitions:
-                _pending_rag_transitions.remove(user_key)
-                logger.info(f"DIAGNÓSTICO-RAG: Usuario {user_key} procesado exitosamente en flujo RAG y eliminado de caché de transiciones")
-                
-                # Verificar estado en la DB para asegurar que todo está bien
+            # Verificación en memoria (sin I/O); la relectura en DB solo con DEBUG_RAG_STATE_VERIFY
+            if ctx.current_user_state_obj.stage != STAGE_MAIN_CHAT_RAG:
+                logger.warning("DIAGNÓSTICO-RAG: Inconsistencia - Estado en memoria para %s es %s, no STAGE_MAIN_CHAT_RAG", ctx.user_key, ctx.current_user_state_obj.stage)
+            elif settings.DEBUG_RAG_STATE_VERIFY:
                 try:
-                    verification_state = await db_session.get(UserState, (current_user_state_obj.user_id, current_user_state_obj.platform))
+                    from app.models.user_state import UserState
+                    verification_state = await ctx.db_session.get(UserState, (ctx.current_user_state_obj.user_id, ctx.current_user_state_obj.platform))
                     if verification_state and verification_state.stage == STAGE_MAIN_CHAT_RAG:
-                        logger.info(f"DIAGNÓSTICO-RAG: Verificado estado final en DB para {user_key}: correctamente en STAGE_MAIN_CHAT_RAG")
+                        logger.info("DIAGNÓSTICO-RAG: Verificado estado final en DB para %s: correctamente en STAGE_MAIN_CHAT_RAG", ctx.user_key)
                     else:
                         stage_in_db = verification_state.stage if verification_state else "desconocido"
-                        logger.warning(f"DIAGNÓSTICO-RAG: Inconsistencia - Estado en DB para {user_key} es {stage_in_db}, no STAGE_MAIN_CHAT_RAG")
+                        logger.warning("DIAGNÓSTICO-RAG: Inconsistencia - Estado en DB para %s es %s, no STAGE_MAIN_CHAT_RAG", ctx.user_key, stage_in_db)
                 except Exception as e_verify:
-                    logger.error(f"DIAGNÓSTICO-RAG: Error al verificar estado final en DB para {user_key}: {e_verify}", exc_info=True)
-            
-            return {"status": "success", "action": "llm_rag_response_sent"}
+                    logger.error("DIAGNÓSTICO-RAG: Error al verificar estado final en DB para %s: %s", ctx.user_key, e_verify, exc_info=True)
+        
+        return {"status": "success", "action": "llm_rag_response_sent"}
+
+    except Exception as e_llm:
+        logger.error("Error al obtener respuesta del LLM para %s en STAGE_MAIN_CHAT_RAG: %s", ctx.user_key, e_llm, exc_info=True)
+        await send_whatsapp_message(ctx.from_phone, "Lo siento, tuve problemas para procesar tu consulta con la IA en este momento. Por favor, intenta de nuevo más tarde o escribe 'menú'.")
+        return {"status": "error", "source": "llm_call_in_rag_stage"}
+
+async def _handle_unknown_stage(ctx: ConversationContext) -> Dict[str, Any]:
+    """Reinicia a selección de marca cuando la etapa no tiene manejador."""
+    logger.warning("Estado no reconocido o no manejado explícitamente: %s para usuario %s. Reiniciando a selección de marca.", ctx.current_stage, ctx.user_key)
+    await reset_user_to_brand_selection(ctx.db_session, ctx.current_user_state_obj, force=True)
+    selection_message = await get_company_selection_message(ctx.db_session, ctx.current_user_state_obj)
+    await send_whatsapp_message(ctx.from_phone, f"Parece que nos perdimos un poco. Volvamos al inicio.\n\n{selection_message}")
+    return {"status": "success", "action": "unhandled_stage_reset"}
+
+# Tabla de despacho etapa -> manejador (las claves son las mismas constantes de texto
+# que se guardan en user_states.stage).
+_STAGE_HANDLERS: Dict[str, Callable[[ConversationContext], Awaitable[Dict[str, Any]]]] = {
+    STAGE_SELECTING_BRAND: _handle_stage_selecting_brand,
+    STAGE_AWAITING_ACTION: _handle_stage_awaiting_action,
+    STAGE_AWAITING_QUERY_FOR_RAG: _handle_stage_awaiting_query_for_rag,
+    STAGE_COLLECTING_NAME: _handle_stage_collecting_name,
+    STAGE_COLLECTING_PURPOSE: _handle_stage_collecting_purpose,
+    STAGE_COLLECTING_EMAIL: _handle_stage_collecting_email,
+    STAGE_COLLECTING_PHONE: _handle_stage_collecting_phone,
+    STAGE_PROVIDING_SCHEDULING_INFO: _handle_stage_providing_scheduling_info,
+    STAGE_MAIN_CHAT_RAG: _handle_stage_main_chat_rag,
+}
 
-        except Exception as e_llm:
-            logger.error(f"Error al obtener respuesta del LLM para {user_key} en STAGE_MAIN_CHAT_RAG: {e_llm}", exc_info=True)
-            await send_whatsapp_message(from_phone, "Lo siento, tuve problemas para procesar tu consulta con la IA en este momento. Por favor, intenta de nuevo más tarde o escribe 'menú'.")
-            return {"status": "error", "source": "llm_call_in_rag_stage"}
-            
-    # Aquí irían los elif para STAGE_COLLECTING_NAME, STAGE_COLLECTING_EMAIL, STAGE_COLLECTING_PURPOSE
-    # Ejemplo:
-    # elif current_stage == STAGE_COLLECTING_NAME:
-    #     # Validar y guardar nombre
-    #     # Transicionar a STAGE_COLLECTING_EMAIL
-    #     # Enviar mensaje pidiendo email
-
-    else: # Estado desconocido o no manejado explícitamente
-        logger.warning(f"Estado no reconocido o no manejado explícitamente: {current_stage} para usuario {user_key}. Reiniciando a selección de marca.")
-        await reset_user_to_brand_selection(db_session, current_user_state_obj, force=True)
-        selection_message = await get_company_selection_message(db_session, current_user_state_obj)
-        await send_whatsapp_message(from_phone, f"Parece que nos perdimos un poco. Volvamos al inicio.\n\n{selection_message}")
-        return {"status": "success", "action": "unhandled_stage_reset"}
+# Contador de IDs de solicitud para correlacionar líneas de log de un mismo webhook.
+# El prefijo aleatorio distingue a cada proceso (workers de gunicorn y sus reciclajes);
+# se genera por PID porque con preload_app el módulo se importa antes del fork.
+_REQUEST_SEQ = itertools.count(1)
+_REQUEST_PREFIX = ""
+_REQUEST_PREFIX_PID = 0
+
+def _next_request_id() -> str:
+    global _REQUEST_SEQ, _REQUEST_PREFIX, _REQUEST_PREFIX_PID
+    pid = os.getpid()
+    if pid != _REQUEST_PREFIX_PID:
+        _REQUEST_PREFIX, _REQUEST_PREFIX_PID = secrets.token_hex(3), pid
+        _REQUEST_SEQ = itertools.count(1)
+    return f"req_{_REQUEST_PREFIX}_{next(_REQUEST_SEQ):x}"
+
+def _payload_has_messages(payload: dict) -> bool:
+    """Revisa el dict crudo y devuelve True si algún cambio trae mensajes entrantes."""
+    for entry_item in payload.get("entry") or ():
+        if not isinstance(entry_item, dict):
+            return True  # Estructura inesperada: el recorrido principal la registra
+        for change_item in entry_item.get("changes") or ():
+            if not isinstance(change_item, dict):
+                return True
+            value_item = change_item.get("value")
+            if isinstance(value_item, dict) and value_item.get("messages"):
+                return True
+    return False
+
+async def _process_incoming_message(
+    msg_obj_payload: WhatsAppMessage,
+    user_profile_name_extracted: Optional[str],
+    db_session: AsyncSession,
+    request: Request,
+    request_id: str
+) -> Optional[str]:
+    """Procesa un mensaje entrante de WhatsApp: perfil, deduplicación y despacho a la máquina de estados.
+    
+    Devuelve el aviso de error que se debe enviar al usuario, o None si no hace falta avisar.
+    """
+    current_platform = "whatsapp"
+    
+    # Actualizar perfil del usuario si tenemos el nombre del webhook (asíncrono, no bloqueante)
+    if user_profile_name_extracted:
+        # asyncio.create_task(update_user_profile(db_session, msg_obj_payload.from_number, current_platform, user_profile_name_extracted))
+        # Lo hacemos directamente await si no es problemático para el tiempo de respuesta del webhook
+        await update_user_profile(db_session, msg_obj_payload.from_number, current_platform, user_profile_name_extracted)
+
+    # Control de mensajes duplicados - usar una colección en memoria para evitar reprocesar mensajes
+    # Esta colección se reinicia cuando se reinicia el servidor, pero evita duplicación durante la misma sesión
+    # La ventana es un LRU acotado: al llenarse se expulsa solo el ID más antiguo
+    if not _mark_message_processed(msg_obj_payload.id):
+        logger.warning("MENSAJE DUPLICADO DETECTADO Y BLOQUEADO: %s", msg_obj_payload.to_plain())
+        return None
+        
+    logger.debug("Mensaje marcado como procesado: ID '%s'. Total en caché: %d.", msg_obj_payload.id, len(_processed_msg_ids))
+    
+    logger.debug("Procesando msg ID '%s' de '%s', Tipo '%s'.", msg_obj_payload.id, msg_obj_payload.from_number, msg_obj_payload.type)
+
+    # Solo procesar tipos de mensajes que la lógica de estados puede manejar (texto o interactivos)
+    # Nota: Tu modelo WhatsAppMessage ya debería unificar 'button' legacy a 'interactive' si esa es la intención.
+    # El código anterior para convertir 'button' a 'interactive' se puede mantener si es necesario,
+    # o se asume que msg_obj_payload ya viene normalizado.
+    if msg_obj_payload.type in ['text', 'interactive']:
+        try:
+            await handle_whatsapp_message(
+                msg_obj_payload, 
+                user_profile_name_extracted, 
+                current_platform, 
+                db_session,
+                request # Pasar request si es necesario para handle_whatsapp_message
+            )
+        except ValueError as e_val:
+            # Error de validación esperado
+            logger.warning("[%s] Error de validación al procesar mensaje: %s", request_id, e_val)
+            return "Lo siento, no pude procesar tu mensaje. Por favor, intenta de nuevo con un formato válido."
+        except Exception as e_msg:
+            # Error inesperado pero controlado
+            logger.error("[%s] Error procesando mensaje: %s", request_id, e_msg, exc_info=True)
+            return "Lo siento, estamos experimentando dificultades técnicas. Por favor, intenta de nuevo en unos momentos."
+        return None
+    
+    logger.info("[%s] Mensaje tipo '%s' de '%s' no procesado activamente. ID: %s", request_id, msg_obj_payload.type, msg_obj_payload.from_number, msg_obj_payload.id)
+    # Informar que este tipo no es soportado
+    return "Lo siento, actualmente no puedo procesar este tipo de mensaje. Por favor, envía un mensaje de texto."
+
+async def _dispatch_user_messages(
+    user_messages: List[Tuple[WhatsAppMessage, Optional[str]]],
+    db_session: AsyncSession,
+    request: Request,
+    request_id: str
+) -> None:
+    """Procesa en orden los mensajes de un mismo usuario para no desordenar su conversación.
+    
+    Los avisos de error se acumulan y se envían una sola vez al final del lote: si varios
+    mensajes fallan por la misma causa, el usuario recibe un único aviso.
+    """
+    pending_notices: List[str] = []
+    for msg_obj_payload, user_profile_name_extracted in user_messages:
+        notice = await _process_incoming_message(msg_obj_payload, user_profile_name_extracted, db_session, request, request_id)
+        if notice and notice not in pending_notices:
+            pending_notices.append(notice)
+    if pending_notices:
+        to_number = user_messages[0][0].from_number
+        for notice in pending_notices:
+            await send_whatsapp_message(to=to_number, message_payload=notice)
+
+async def _dispatch_user_messages_in_new_session(
+    session_factory: Callable[[], AsyncSession],
+    user_messages: List[Tuple[WhatsAppMessage, Optional[str]]],
+    request: Request,
+    request_id: str
+) -> None:
+    """Igual que _dispatch_user_messages pero con una sesión propia, para correr en paralelo con otros usuarios."""
+    async with session_factory() as user_session:
+        await _dispatch_user_messages(user_messages, user_session, request, request_id)
+
+# Referencias fuertes a las notificaciones en curso: el event loop solo guarda referencias débiles
+_admin_notify_tasks: Set["asyncio.Task[None]"] = set()
+
+async def _notify_admin_safe(request_id: str, error: BaseException) -> None:
+    """Avisa al número de administración de un error del webhook, con reintentos y sin propagar fallos."""
+    error_message = f"Error en webhook (ID: {request_id}): {str(error)[:100]}"
+    try:
+        # Backoff exponencial con jitter: 3 intentos, factor 2, hasta 250 ms aleatorios
+        async for attempt in AsyncRetrying(
+            stop=stop_after_attempt(3),
+            wait=wait_exponential(multiplier=1, exp_base=2) + wait_random(0, 0.25),
+            retry=retry_if_exception_type(Exception) | retry_if_result(lambda r: isinstance(r, dict) and bool(r.get("error"))),
+        ):
+            with attempt:
+                result = await send_whatsapp_message(to=_ADMIN_NOTIFICATION_NUMBER, message_payload=error_message)
+            if not attempt.retry_state.outcome.failed:
+                attempt.retry_state.set_result(result)
+    except Exception as e_notify:
+        logger.error("[%s] No se pudo notificar al admin sobre error: %s", request_id, e_notify)
+
+def _schedule_admin_notification(request_id: str, error: BaseException) -> None:
+    """Lanza _notify_admin_safe en segundo plano para no retrasar la respuesta del webhook."""
+    if not _ADMIN_NOTIFICATION_NUMBER:
+        return
+    task = asyncio.create_task(_notify_admin_safe(request_id, error))
+    _admin_notify_tasks.add(task)
+    task.add_done_callback(_admin_notify_tasks.discard)
 
 async def process_webhook_payload_in_background(payload: dict, request: Request):
     """
     Procesa el payload de un webhook de WhatsApp Business API en segundo plano.
     Crea su propia sesión de base de datos para evitar problemas de concurrencia.
     """
-    request_id = f"req_{datetime.now(tz=timezone.utc).strftime('%Y%m%d%H%M%S')}_{id(request)}"
-    logger.info(f"[{request_id}] process_webhook_payload_in_background: Procesando en segundo plano. Object Type: '{payload.get('object', 'N/A')}'")
+    # Secuencia monotónica del proceso: evita datetime.now()+strftime en cada webhook
+    request_id = _next_request_id()
+    logger.info("[%s] process_webhook_payload_in_background: Procesando en segundo plano. Object Type: '%s'", request_id, payload.get('object', 'N/A'))
     
-    # Crear una nueva sesión de base de datos para esta tarea en segundo plano
-    from sqlalchemy.ext.asyncio import AsyncSession as AsyncSessionType
-    from sqlalchemy.orm import sessionmaker
-    from ..core.database import engine
+    # Crear una nueva sesión de base de datos para esta tarea en segundo plano,
+    # tomada del pool compartido del engine (la fábrica se crea una sola vez en el lifespan)
+    from ..core.database import get_session_factory
     
-    async_session = sessionmaker(engine, class_=AsyncSessionType, expire_on_commit=False)
+    async_session = get_session_factory()
+    if async_session is None:
+        logger.error("[%s] Base de datos no inicializada; no se puede procesar el webhook.", request_id)
+        return
     db_session = async_session()
     
     try:
         object_type = payload.get("object")
         if object_type != "whatsapp_business_account":
-            logger.info(f"process_webhook_payload: Payload no es de 'whatsapp_business_account' (es '{object_type}'). Ignorando.")
+            logger.info("process_webhook_payload: Payload no es de 'whatsapp_business_account' (es '%s'). Ignorando.", object_type)
             return
 
-        try:
-            data = WhatsAppPayload.model_validate(payload)
-            logger.debug("process_webhook_payload: Payload validado exitosamente con WhatsAppPayload model.")
-        except Exception as pydantic_error:
-            logger.error(f"process_webhook_payload: Error de validación Pydantic: {pydantic_error}", exc_info=True)
+        # Atajo: las notificaciones de estado (sent/delivered/read) son la mayoría del tráfico y
+        # no se procesan, así que se descartan antes de recorrer y validar el payload
+        if not _payload_has_messages(payload):
+            logger.debug("process_webhook_payload: Payload sin mensajes entrantes (solo estados/errores). Ignorando.")
             return
 
-        if not data.entry:
-            logger.info("process_webhook_payload: Payload sin 'entry'.")
-            return
+        # Mensajes agrupados por remitente: se conserva el orden dentro de cada usuario
+        messages_by_user: Dict[str, List[Tuple[WhatsAppMessage, Optional[str]]]] = {}
+        for entry_item in payload.get("entry") or ():
+            if not isinstance(entry_item, dict):
+                logger.warning("process_webhook_payload: 'entry' con estructura inesperada: %r", entry_item)
+                continue
+            for change_item in entry_item.get("changes") or ():
+                value_item = change_item.get("value") if isinstance(change_item, dict) else None
+                if not isinstance(value_item, dict): continue
+
+                if value_item.get("statuses") or value_item.get("errors"):
+                    # Notificaciones de estado o errores de Meta: no se procesan por ahora
+                    continue
+                if change_item.get("field") != "messages" or not value_item.get("messages"):
+                    logger.debug("ChangeItem no contiene statuses, errors, ni messages procesables. Field: %s", change_item.get("field"))
+                    continue
 
-        for entry_item in data.entry:
-            if not entry_item.changes: continue
-            for change_item in entry_item.changes:
-                value_item = change_item.value
-                if not value_item: continue
-
-                if value_item.statuses: # Manejo de statuses
-                    # ... (tu código de manejo de status actual, se mantiene) ...
-                    pass
-                elif value_item.errors: # Manejo de errores
-                    # ... (tu código de manejo de errores actual, se mantiene) ...
-                    pass
-                elif change_item.field == "messages" and value_item.messages:
-                    logger.info(f"process_webhook_payload: {len(value_item.messages)} mensaje(s) entrante(s).")
-                    for msg_obj_payload in value_item.messages:
-                        user_profile_name_extracted: Optional[str] = None
-                        if value_item.contacts and value_item.contacts[0] and value_item.contacts[0].profile:
-                            user_profile_name_extracted = value_item.contacts[0].profile.name
-                        
-                        current_platform = "whatsapp"
-                        
-                        # Actualizar perfil del usuario si tenemos el nombre del webhook (asíncrono, no bloqueante)
-                        if user_profile_name_extracted:
-                           # asyncio.create_task(update_user_profile(db_session, msg_obj_payload.from_number, current_platform, user_profile_name_extracted))
-                           # Lo hacemos directamente await si no es problemático para el tiempo de respuesta del webhook
-                           await update_user_profile(db_session, msg_obj_payload.from_number, current_platform, user_profile_name_extracted)
-
-
-                        # Control de mensajes duplicados - usar una colección en memoria para evitar reprocesar mensajes
-                        # Esta colección se reinicia cuando se reinicia el servidor, pero evita duplicación durante la misma sesión
-                        processed_msg_ids = getattr(process_webhook_payload, "_processed_msg_ids", set())
-                        if msg_obj_payload.id in processed_msg_ids:
-                            logger.warning(f"MENSAJE DUPLICADO DETECTADO Y BLOQUEADO: ID '{msg_obj_payload.id}' de '{msg_obj_payload.from_number}', Tipo '{msg_obj_payload.type}', Contenido: '{msg_obj_payload.text if msg_obj_payload.type == 'text' else 'contenido interactivo'}'")
-                            continue
-                            
-                        # Limitar tamaño de la caché para evitar consumo excesivo de memoria
-                        if len(processed_msg_ids) > 1000:  # Mantener últimos 1000 mensajes procesados
-                            logger.info(f"Limpiando caché de mensajes procesados, tamaño actual: {len(processed_msg_ids)}")
-                            processed_msg_ids.clear()
-                            
-                        # Marcar mensaje como procesado
-                        processed_msg_ids.add(msg_obj_payload.id)
-                        setattr(process_webhook_payload, "_processed_msg_ids", processed_msg_ids)
-                        logger.info(f"Mensaje marcado como procesado: ID '{msg_obj_payload.id}'. Total en caché: {len(processed_msg_ids)}.")
-                        
-                        logger.debug(f"Procesando msg ID '{msg_obj_payload.id}' de '{msg_obj_payload.from_number}', Tipo '{msg_obj_payload.type}'.")
-
-                        # Solo procesar tipos de mensajes que la lógica de estados puede manejar (texto o interactivos)
-                        # Nota: Tu modelo WhatsAppMessage ya debería unificar 'button' legacy a 'interactive' si esa es la intención.
-                        # El código anterior para convertir 'button' a 'interactive' se puede mantener si es necesario,
-                        # o se asume que msg_obj_payload ya viene normalizado.
-                        if msg_obj_payload.type in ['text', 'interactive']:
-                            try:
-                                await handle_whatsapp_message(
-                                    msg_obj_payload, 
-                                    user_profile_name_extracted, 
-                                    current_platform, 
-                                    db_session,
-                                    request # Pasar request si es necesario para handle_whatsapp_message
-                                )
-                            except ValueError as e_val:
-                                # Error de validación esperado
-                                logger.warning(f"[{request_id}] Error de validación al procesar mensaje: {e_val}")
-                                await send_whatsapp_message(
-                                    to=msg_obj_payload.from_number, 
-                                    message_payload="Lo siento, no pude procesar tu mensaje. Por favor, intenta de nuevo con un formato válido."
-                                )
-                            except Exception as e_msg:
-                                # Error inesperado pero controlado
-                                logger.error(f"[{request_id}] Error procesando mensaje: {e_msg}", exc_info=True)
-                                await send_whatsapp_message(
-                                    to=msg_obj_payload.from_number, 
-                                    message_payload="Lo siento, estamos experimentando dificultades técnicas. Por favor, intenta de nuevo en unos momentos."
-                                )
-                        else:
-                            logger.info(f"[{request_id}] Mensaje tipo '{msg_obj_payload.type}' de '{msg_obj_payload.from_number}' no procesado activamente. ID: {msg_obj_payload.id}")
-                            # Enviar mensaje informando que este tipo no es soportado
-                            await send_whatsapp_message(
-                                to=msg_obj_payload.from_number, 
-                                message_payload="Lo siento, actualmente no puedo procesar este tipo de mensaje. Por favor, envía un mensaje de texto."
-                            )
-                else:
-                    logger.debug(f"ChangeItem no contiene statuses, errors, ni messages procesables. Field: {change_item.field}")
+                try:
+                    incoming_messages = WHATSAPP_MESSAGES_ADAPTER.validate_python(value_item["messages"])
+                except ValidationError as pydantic_error:
+                    logger.error("process_webhook_payload: Error de validación Pydantic en messages: %s", pydantic_error)
+                    continue
+
+                logger.info("process_webhook_payload: %s mensaje(s) entrante(s).", len(incoming_messages))
+                user_profile_name_extracted: Optional[str] = None
+                contacts = value_item.get("contacts")
+                if contacts and isinstance(contacts[0], dict):
+                    user_profile_name_extracted = (contacts[0].get("profile") or {}).get("name")
+                for msg_obj_payload in incoming_messages:
+                    messages_by_user.setdefault(msg_obj_payload.from_number, []).append(
+                        (msg_obj_payload, user_profile_name_extracted)
+                    )
+
+        from app.main.webhook_workers import webhook_workers_running, enqueue_user_messages
+        if messages_by_user and webhook_workers_running():
+            # Pool de workers activo: solo encolar; cada usuario cae siempre en la misma cola
+            for user_number, user_messages in messages_by_user.items():
+                await enqueue_user_messages(user_number, user_messages, request, request_id)
+            logger.debug("[%s] %d lote(s) de usuario encolados para los workers.", request_id, len(messages_by_user))
+        elif len(messages_by_user) == 1:
+            # Caso habitual: un solo usuario, se reutiliza la sesión ya abierta
+            await _dispatch_user_messages(next(iter(messages_by_user.values())), db_session, request, request_id)
+        elif messages_by_user:
+            # Lote con varios usuarios: se procesan en paralelo, cada uno con su propia sesión
+            # (AsyncSession no es segura entre tareas concurrentes)
+            results = await asyncio.gather(
+                *(_dispatch_user_messages_in_new_session(async_session, user_messages, request, request_id)
+                  for user_messages in messages_by_user.values()),
+                return_exceptions=True
+            )
+            for user_number, result in zip(messages_by_user, results):
+                if isinstance(result, Exception):
+                    logger.error("[%s] Error procesando mensajes de '%s': %s", request_id, user_number, result, exc_info=result)
 
     except Exception as e_main_webhook_processing:
-        logger.critical(f"[{request_id}] Error CRÍTICO en process_webhook_payload: {e_main_webhook_processing}", exc_info=True)
+        logger.critical("[%s] Error CRÍTICO en process_webhook_payload: %s", request_id, e_main_webhook_processing, exc_info=True)
         
-        # Intentar informar a admins, si es posible
-        admin_notification_number = getattr(settings, 'ADMIN_NOTIFICATION_NUMBER', None)
-        if admin_notification_number:
-            try:
-                error_message = f"Error en webhook (ID: {request_id}): {str(e_main_webhook_processing)[:100]}"
-                await send_whatsapp_message(to=admin_notification_number, message_payload=error_message)
-            except Exception as e_notify:
-                logger.error(f"No se pudo notificar al admin sobre error: {e_notify}")
+        # Informar a admins en segundo plano, sin retrasar la respuesta
+        _schedule_admin_notification(request_id, e_main_webhook_processing)
                 
         # Estructura de respuesta para monitorización y debugging
         error_response = {
@@ -1507,15 +1766,15 @@ async def process_webhook_payload_in_background(payload: dict, request: Request)
             "error_message": str(e_main_webhook_processing),
             "timestamp": datetime.now(tz=timezone.utc).isoformat()
         }
-        logger.error(f"[{request_id}] Error en proceso en segundo plano: {error_response}")
+        logger.error("[%s] Error en proceso en segundo plano: %s", request_id, error_response)
         return error_response
     finally:
         # Asegurarse de cerrar la sesión de base de datos
         try:
             await db_session.close()
-            logger.debug(f"[{request_id}] Sesión de base de datos cerrada correctamente")
+            logger.debug("[%s] Sesión de base de datos cerrada correctamente", request_id)
         except Exception as e_close:
-            logger.error(f"[{request_id}] Error al cerrar la sesión de base de datos: {e_close}")
+            logger.error("[%s] Error al cerrar la sesión de base de datos: %s", request_id, e_close)
 
 # Función de compatibilidad para mantener la interfaz existente
 async def process_webhook_payload(payload: dict, db_session: AsyncSession, request: Request):
@@ -0,0 +1,112 @@
+# app/main/webhook_workers.py
+"""
+Pool de workers asíncronos para procesar mensajes entrantes de WhatsApp.
+
+El webhook solo valida y encola; N workers iniciados en el lifespan consumen las colas.
+Cada usuario se asigna siempre a la misma cola (hash del número), de modo que sus
+mensajes se procesan en orden mientras usuarios distintos avanzan en paralelo.
+"""
+import asyncio
+from typing import Any, List, Optional, Tuple
+
+from fastapi import Request
+
+from app.utils.logger import logger
+
+# (mensajes del usuario, request original, request_id para correlacionar logs)
+WebhookWorkItem = Tuple[List[Tuple[Any, Optional[str]]], Request, str]
+
+_queues: List["asyncio.Queue[WebhookWorkItem]"] = []
+_worker_tasks: List["asyncio.Task[None]"] = []
+
+
+async def _worker(worker_index: int, queue: "asyncio.Queue[WebhookWorkItem]") -> None:
+    """Consume la cola asignada y procesa cada lote de mensajes con su propia sesión de BD."""
+    # Importación tardía: webhook_handler importa medio proyecto y este módulo se carga en el lifespan
+    from app.core.database import get_session_factory
+    from app.main.webhook_handler import _dispatch_user_messages
+
+    while True:
+        user_messages, request, request_id = await queue.get()
+        try:
+            session_factory = get_session_factory()
+            if session_factory is None:
+                logger.error("[%s] Worker %d: base de datos no inicializada; se descartan %d mensaje(s).", request_id, worker_index, len(user_messages))
+                continue
+            async with session_factory() as db_session:
+                await _dispatch_user_messages(user_messages, db_session, request, request_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e_worker:
+            logger.error("[%s] Worker %d: error procesando mensajes: %s", request_id, worker_index, e_worker, exc_info=True)
+        finally:
+            queue.task_done()
+
+
+def start_webhook_workers(num_workers: int, queue_maxsize: int) -> None:
+    """Crea las colas y lanza los workers. Debe llamarse dentro del event loop (lifespan)."""
+    if _worker_tasks:
+        logger.warning("start_webhook_workers: los workers ya están en ejecución.")
+        return
+    num_workers = max(1, num_workers)
+    # Cada cola recibe su parte proporcional del límite total
+    per_queue_maxsize = max(1, queue_maxsize // num_workers)
+    for worker_index in range(num_workers):
+        queue: "asyncio.Queue[WebhookWorkItem]" = asyncio.Queue(maxsize=per_queue_maxsize)
+        _queues.append(queue)
+        _worker_tasks.append(asyncio.create_task(_worker(worker_index, queue), name=f"webhook-worker-{worker_index}"))
+    logger.info(f"Workers de webhook iniciados: {num_workers} (capacidad por cola: {per_queue_maxsize}).")
+
+
+def _discard_queued_items() -> int:
+    """Vacía las colas sin tocar los lotes que un worker ya está procesando."""
+    discarded = 0
+    for queue in _queues:
+        while True:
+            try:
+                queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            queue.task_done()
+            discarded += 1
+    return discarded
+
+
+async def stop_webhook_workers(drain_timeout: float) -> None:
+    """
+    Espera hasta `drain_timeout` segundos a que se vacíen las colas. Si no da tiempo,
+    descarta los lotes que aún no empezaron, deja terminar los que están en curso
+    (Meta ya recibió su 200) y solo entonces cancela los workers, ya ociosos.
+    El límite duro lo pone el graceful_timeout de gunicorn.
+    """
+    if not _worker_tasks:
+        return
+    try:
+        await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in _queues)), timeout=drain_timeout)
+    except asyncio.TimeoutError:
+        discarded = _discard_queued_items()
+        logger.warning(f"stop_webhook_workers: {discarded} lote(s) descartados sin procesar al apagar; esperando a los que están en curso.")
+        # Con las colas vacías, join() solo espera al task_done() de los lotes en curso
+        await asyncio.gather(*(queue.join() for queue in _queues))
+    for task in _worker_tasks:
+        task.cancel()
+    await asyncio.gather(*_worker_tasks, return_exceptions=True)
+    _worker_tasks.clear()
+    _queues.clear()
+    logger.info("Workers de webhook detenidos.")
+
+
+def webhook_workers_running() -> bool:
+    """Indica si hay workers activos para recibir mensajes."""
+    return bool(_worker_tasks)
+
+
+async def enqueue_user_messages(
+    from_number: str,
+    user_messages: List[Tuple[Any, Optional[str]]],
+    request: Request,
+    request_id: str
+) -> None:
+    """Encola los mensajes de un usuario en la cola que le corresponde (espera si está llena)."""
+    queue = _queues[hash(from_number) % len(_queues)]
+    await queue.put((user_messages, request, request_id))
@@ -1,37 +1,77 @@
-from .base import BaseDBModel, BaseCreateModel, BaseUpdateModel, StatusEnum
-from .user_state import UserState, UserStateCreate, UserStateUpdate, UserStateInDB
-from .company import CompanyCreate, CompanyUpdate, CompanyInDB  # Modelos Pydantic
-from .company_models import Company  # Modelo SQLAlchemy
-from .conversation import Conversation, ConversationCreate, ConversationUpdate, ConversationInDB
-from .message import Message, MessageCreate, MessageUpdate, MessageInDB
-from .appointment import AppointmentCreate, AppointmentUpdate, AppointmentInDB  # Modelos Pydantic
-from .appointment_models import Appointment  # Modelo SQLAlchemy
-from .document import Document, DocumentCreate, DocumentUpdate, DocumentInDB
-from .interaction import InteractionCreate, InteractionUpdate, InteractionInDB  # Modelos Pydantic
-from .interaction_models import Interaction  # Modelo SQLAlchemy
+"""Modelos Pydantic y SQLAlchemy del proyecto.
+
+Los submódulos se importan de forma perezosa (PEP 562): importar ``app.models.webhook_models``
+ya no construye todos los modelos Pydantic ni registra todos los mappers al arrancar.
+"""
+import importlib
+from typing import Any
+
+# Nombre exportado -> submódulo que lo define
+_LAZY = {
+    # Base models
+    'BaseDBModel': 'base', 'BaseCreateModel': 'base', 'BaseUpdateModel': 'base', 'StatusEnum': 'base',
+    # User State
+    'UserState': 'user_state', 'UserStateCreate': 'user_state', 'UserStateUpdate': 'user_state', 'UserStateInDB': 'user_state',
+    # Company
+    'Company': 'company_models',  # Modelo SQLAlchemy
+    'CompanyCreate': 'company', 'CompanyUpdate': 'company', 'CompanyInDB': 'company',  # Modelos Pydantic
+    # Conversation
+    'Conversation': 'conversation', 'ConversationCreate': 'conversation', 'ConversationUpdate': 'conversation', 'ConversationInDB': 'conversation',
+    # Message
+    'Message': 'message', 'MessageCreate': 'message', 'MessageUpdate': 'message', 'MessageInDB': 'message',
+    # Appointment
+    'Appointment': 'appointment_models',  # Modelo SQLAlchemy
+    'AppointmentCreate': 'appointment', 'AppointmentUpdate': 'appointment', 'AppointmentInDB': 'appointment',  # Modelos Pydantic
+    # Document
+    'Document': 'document', 'DocumentCreate': 'document', 'DocumentUpdate': 'document', 'DocumentInDB': 'document',
+    # Interaction
+    'Interaction': 'interaction_models',  # Modelo SQLAlchemy
+    'InteractionCreate': 'interaction', 'InteractionUpdate': 'interaction', 'InteractionInDB': 'interaction',  # Modelos Pydantic
+}
+
+# Las relaciones SQLAlchemy se resuelven por nombre de clase: si se pide un modelo ORM
+# se cargan todos a la vez para que configure_mappers() encuentre cada destino.
+_ORM_MODULES = ('user_state', 'company_models', 'interaction_models', 'appointment_models')
+
+
+def __getattr__(name: str) -> Any:
+    module_name = _LAZY.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    if module_name in _ORM_MODULES:
+        for orm_module_name in _ORM_MODULES:
+            importlib.import_module(f'.{orm_module_name}', __package__)
+    value = getattr(importlib.import_module(f'.{module_name}', __package__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list:
+    return sorted(set(globals()) | set(_LAZY))
+
 
 __all__ = [
     # Base models
     'BaseDBModel', 'BaseCreateModel', 'BaseUpdateModel', 'StatusEnum',
-    
+
     # User State
     'UserState', 'UserStateCreate', 'UserStateUpdate', 'UserStateInDB',
-    
+
     # Company
     'Company', 'CompanyCreate', 'CompanyUpdate', 'CompanyInDB',  # Modelos Pydantic y SQLAlchemy
-    
+
     # Conversation
     'Conversation', 'ConversationCreate', 'ConversationUpdate', 'ConversationInDB',
-    
+
     # Message
     'Message', 'MessageCreate', 'MessageUpdate', 'MessageInDB',
-    
+
     # Appointment
     'Appointment', 'AppointmentCreate', 'AppointmentUpdate', 'AppointmentInDB',  # Modelos Pydantic y SQLAlchemy
-    
+
     # Document
     'Document', 'DocumentCreate', 'DocumentUpdate', 'DocumentInDB',
-    
+
     # Interaction
     'Interaction', 'InteractionCreate', 'InteractionUpdate', 'InteractionInDB'  # Modelos Pydantic y SQLAlchemy
-]
+]
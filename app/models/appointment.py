@@ -1,5 +1,5 @@
 ﻿from datetime import datetime
-from typing import Optional
+from typing import ClassVar, Optional
 from pydantic import Field
 from .base import BaseDBModel, BaseCreateModel, BaseUpdateModel
 
@@ -28,7 +28,6 @@ class AppointmentUpdate(BaseUpdateModel):
     end_time: Optional[datetime] = None
 
 class AppointmentInDB(AppointmentBase):
-    class Config:
-        table_name = "appointments"
+    table_name: ClassVar[str] = "appointments"
 
 Appointment = AppointmentInDB
@@ -2,7 +2,7 @@
 from datetime import datetime
 from typing import Optional, TYPE_CHECKING
 
-from sqlalchemy import String, Boolean, DateTime, ForeignKey
+from sqlalchemy import String, Boolean, DateTime, ForeignKey, Index, func, text
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 # Para type hints circulares
@@ -20,7 +20,14 @@ except ImportError:
 class Appointment(Base):
     """Modelo SQLAlchemy para la tabla de citas."""
     __tablename__ = "appointments"
-    __allow_unmapped__ = True  # Para compatibilidad con código heredado
+    __table_args__ = (
+        # Índice parcial: solo citas con recordatorio pendiente, ordenadas por hora de inicio
+        Index(
+            "ix_appointments_pending_reminders",
+            "start_time",
+            postgresql_where=text("reminder_sent = false"),
+        ),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
     start_time: Mapped[datetime] = mapped_column(DateTime, nullable=False)
@@ -47,16 +54,17 @@ class Appointment(Base):
         index=True
     )
     
-    # Relaciones
-    interaction: Mapped[Optional["Interaction"]] = relationship("Interaction", back_populates="appointment")
-    company: Mapped[Optional["Company"]] = relationship("Company", back_populates="appointments")
+    # Relaciones: lazy="raise" porque con AsyncSession una carga perezosa falla en tiempo de ejecución;
+    # quien las necesite debe pedirlas con selectinload(...) en la consulta
+    interaction: Mapped[Optional["Interaction"]] = relationship("Interaction", back_populates="appointment", lazy="raise")
+    company: Mapped[Optional["Company"]] = relationship("Company", back_populates="appointments", lazy="raise")
     
-    # Timestamps
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    # Timestamps resueltos por PostgreSQL (NOW()): sin llamada Python ni desfase entre réplicas
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     updated_at: Mapped[datetime] = mapped_column(
-        DateTime, 
-        default=datetime.utcnow, 
-        onupdate=datetime.utcnow, 
+        DateTime(timezone=True),
+        server_default=func.now(),
+        onupdate=func.now(),
         nullable=False
     )
     
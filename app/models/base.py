@@ -1,23 +1,31 @@
 ﻿from datetime import datetime
 from enum import Enum
-from typing import Optional, TypeVar
+from typing import ClassVar, Optional, TypeVar
 from pydantic import BaseModel, Field, ConfigDict
 
 T = TypeVar('T')
 
+# Configuración compartida (Pydantic v2), definida una sola vez para todos los modelos base
+_BASE_CONFIG = ConfigDict(
+    from_attributes=True,
+    # datetime se serializa en ISO 8601 de forma nativa (pydantic-core), sin json_encoders
+    ser_json_timedelta='iso8601',
+    ser_json_bytes='base64',
+)
+
 class BaseDBModel(BaseModel):
     # Modelo base para todas las entidades de la base de datos
     id: Optional[int] = None
     created_at: Optional[datetime] = None
     updated_at: Optional[datetime] = None
 
+    # Nombre de la tabla asociada; atributo de clase, no es un campo del modelo
+    table_name: ClassVar[Optional[str]] = None
+
     # Configuración compatible con Pydantic v2
     model_config = ConfigDict(
-        from_attributes=True,
+        **_BASE_CONFIG,
         arbitrary_types_allowed=True,
-        json_encoders={
-            datetime: lambda dt: dt.isoformat() if dt else None
-        },
         json_schema_extra={
             "example": {}
         }
@@ -25,23 +33,13 @@ class BaseDBModel(BaseModel):
 
 class BaseCreateModel(BaseModel):
     # Modelo base para la creación de entidades
-    model_config = ConfigDict(
-        from_attributes=True,
-        json_encoders={
-            datetime: lambda dt: dt.isoformat() if dt else None
-        }
-    )
+    model_config = _BASE_CONFIG
 
 class BaseUpdateModel(BaseModel):
     # Modelo base para la actualización de entidades
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
-    model_config = ConfigDict(
-        from_attributes=True,
-        json_encoders={
-            datetime: lambda dt: dt.isoformat() if dt else None
-        }
-    )
+    model_config = _BASE_CONFIG
 
 # Enums comunes
 class StatusEnum(str, Enum):
@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Optional
+from typing import ClassVar, Optional
 from pydantic import HttpUrl, Field
 from .base import BaseDBModel, BaseCreateModel, BaseUpdateModel
 
@@ -22,7 +22,6 @@ class CompanyUpdate(BaseUpdateModel):
     scheduling_url: Optional[str] = None
 
 class CompanyInDB(CompanyBase):
-    class Config:
-        table_name = "companies"
+    table_name: ClassVar[str] = "companies"
 
 Company = CompanyInDB
@@ -1,5 +1,5 @@
 ﻿from datetime import datetime
-from typing import Optional
+from typing import ClassVar, Optional
 from pydantic import Field
 from .base import BaseDBModel, BaseCreateModel, BaseUpdateModel, StatusEnum
 
@@ -20,7 +20,6 @@ class ConversationUpdate(BaseUpdateModel):
     last_message_at: Optional[datetime] = None
 
 class ConversationInDB(ConversationBase):
-    class Config:
-        table_name = "conversations"
+    table_name: ClassVar[str] = "conversations"
 
 Conversation = ConversationInDB
@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Optional, Any, List
+from typing import ClassVar, Optional, Any, List
 from pydantic import Field
 from .base import BaseDBModel, BaseCreateModel, BaseUpdateModel
 
@@ -22,7 +22,6 @@ class DocumentUpdate(BaseUpdateModel):
     embedding: Optional[List[float]] = None
 
 class DocumentInDB(DocumentBase):
-    class Config:
-        table_name = "documents"
+    table_name: ClassVar[str] = "documents"
 
 Document = DocumentInDB
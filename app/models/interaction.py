@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Optional
+from typing import ClassVar, Optional
 from pydantic import EmailStr, Field
 from .base import BaseDBModel, BaseCreateModel, BaseUpdateModel
 
@@ -31,7 +31,6 @@ class InteractionUpdate(BaseUpdateModel):
     interaction_metadata: Optional[dict] = Field(default=None, alias="metadata")
 
 class InteractionInDB(InteractionBase):
-    class Config:
-        table_name = "interactions"
+    table_name: ClassVar[str] = "interactions"
 
 Interaction = InteractionInDB
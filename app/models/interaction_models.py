@@ -2,7 +2,8 @@
 from datetime import datetime
 from typing import Dict, Optional, TYPE_CHECKING
 
-from sqlalchemy import String, DateTime, ForeignKey, JSON
+from sqlalchemy import String, DateTime, ForeignKey, Index, func
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 # Para type hints circulares
@@ -20,7 +21,12 @@ except ImportError:
 class Interaction(Base):
     """Modelo SQLAlchemy para la tabla de interacciones."""
     __tablename__ = "interactions"
-    __allow_unmapped__ = True  # Para compatibilidad con código heredado
+    __table_args__ = (
+        # Búsquedas por usuario siempre van acompañadas de la plataforma
+        Index("ix_interactions_user_platform", "user_wa_id", "platform"),
+        # Consultas de contención sobre metadata (metadata @> '{...}')
+        Index("ix_interaction_metadata_gin", "metadata", postgresql_using="gin"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
     user_wa_id: Mapped[str] = mapped_column(String(255), nullable=False, index=True)
@@ -28,7 +34,7 @@ class Interaction(Base):
     user_name: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
     user_phone: Mapped[Optional[str]] = mapped_column(String(50), nullable=True)
     user_email: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
-    interaction_metadata: Mapped[Dict] = mapped_column('metadata', JSON, default=dict, nullable=False)
+    interaction_metadata: Mapped[Dict] = mapped_column('metadata', JSONB, default=dict, nullable=False)
     
     # Claves foráneas
     company_id: Mapped[Optional[int]] = mapped_column(
@@ -37,20 +43,21 @@ class Interaction(Base):
         index=True
     )
     
-    # Relaciones
-    company: Mapped[Optional["Company"]] = relationship("Company", back_populates="interactions")
+    # Relaciones: lazy="raise" para detectar cargas perezosas (N+1); usar selectinload(...) en la consulta
+    company: Mapped[Optional["Company"]] = relationship("Company", back_populates="interactions", lazy="raise")
     appointment: Mapped[Optional["Appointment"]] = relationship(
         "Appointment", 
         back_populates="interaction", 
-        uselist=False
+        uselist=False,
+        lazy="raise"
     )
     
-    # Timestamps
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    # Timestamps resueltos por PostgreSQL (NOW()): sin llamada Python ni desfase entre réplicas
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     updated_at: Mapped[datetime] = mapped_column(
-        DateTime, 
-        default=datetime.utcnow, 
-        onupdate=datetime.utcnow, 
+        DateTime(timezone=True),
+        server_default=func.now(),
+        onupdate=func.now(),
         nullable=False
     )
     
@@ -1,5 +1,5 @@
 ﻿from datetime import datetime
-from typing import Optional
+from typing import ClassVar, Optional
 from pydantic import Field
 from enum import Enum
 from .base import BaseDBModel, BaseCreateModel, BaseUpdateModel
@@ -25,7 +25,6 @@ class MessageUpdate(BaseUpdateModel):
     content: Optional[str] = None
 
 class MessageInDB(MessageBase):
-    class Config:
-        table_name = "messages"
+    table_name: ClassVar[str] = "messages"
 
 Message = MessageInDB
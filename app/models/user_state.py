@@ -1,4 +1,4 @@
-from sqlalchemy import String, DateTime, func, Integer, ForeignKey, Text, Boolean
+from sqlalchemy import String, DateTime, func, Integer, ForeignKey, Text, Boolean, Index
 from sqlalchemy.orm import relationship, Mapped, mapped_column
 from datetime import datetime
 from typing import Optional, TYPE_CHECKING
@@ -25,6 +25,10 @@ class UserStatus(str, Enum):
 # Modelo SQLAlchemy
 class UserState(Base):
     __tablename__ = "user_states"
+    __table_args__ = (
+        # Consultas masivas por etapa y marca (p.ej. recordatorios y métricas por marca)
+        Index("ix_user_states_stage_brand", "stage", "current_brand_id"),
+    )
 
     # --- Clave Primaria Compuesta ---
     user_id: Mapped[str] = mapped_column(String(255), primary_key=True, index=True)
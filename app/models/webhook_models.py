@@ -1,30 +1,49 @@
-from pydantic import BaseModel, Field, field_validator, model_validator
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, field_validator
 from typing import List, Optional, Dict, Any
 
+# Configuración compartida: los payloads de Meta se leen una vez y se descartan.
+# frozen evita el hook de asignación y extra='ignore' descarta campos nuevos de Meta sin error.
+# Los campos con alias ('from' -> from_number) se validan solo por alias: el JSON de Meta
+# siempre trae 'from' y nadie construye estos modelos a mano, así que no hace falta el nombre.
+_WEBHOOK_CONFIG = ConfigDict(
+    extra='ignore',
+    frozen=True,
+    validate_assignment=False,
+    validate_by_alias=True,
+    validate_by_name=False,
+)
+
+class _WebhookModel(BaseModel):
+    model_config = _WEBHOOK_CONFIG
+
+    def to_plain(self) -> Dict[str, Any]:
+        """Dict para logs/diagnóstico: nombres de atributo (sin alias) y sin campos None."""
+        return self.model_dump(mode='python', exclude_none=True, by_alias=False)
+
 # --- Modelos para Mensajes de WhatsApp Entrantes ---
 
-class WhatsAppTextMessage(BaseModel):
+class WhatsAppTextMessage(_WebhookModel):
     body: str
 
-class WhatsAppButtonReply(BaseModel):
+class WhatsAppButtonReply(_WebhookModel):
     id: str
     title: str
 
-class WhatsAppInteractiveListReply(BaseModel):
+class WhatsAppInteractiveListReply(_WebhookModel):
     id: str
     title: str
     description: Optional[str] = None
 
-class WhatsAppInteractive(BaseModel):
+class WhatsAppInteractive(_WebhookModel):
     type: str
     button_reply: Optional[WhatsAppButtonReply] = None
     list_reply: Optional[WhatsAppInteractiveListReply] = None
 
-class WhatsAppContext(BaseModel):
+class WhatsAppContext(_WebhookModel):
     from_number: Optional[str] = Field(None, alias='from')
     id: Optional[str] = None
 
-class WhatsAppMessage(BaseModel):
+class WhatsAppMessage(_WebhookModel):
     from_number: str = Field(..., alias='from') # 'from' es palabra reservada, usa alias
     id: str
     timestamp: str
@@ -33,105 +52,104 @@ class WhatsAppMessage(BaseModel):
     interactive: Optional[WhatsAppInteractive] = None
     context: Optional[WhatsAppContext] = None
 
+# Ruta rápida del webhook: se valida solo value["messages"] en lugar de recorrer
+# Payload -> Entry -> Change -> Value. El adaptador se construye una vez al importar.
+WHATSAPP_MESSAGES_ADAPTER: TypeAdapter[List[WhatsAppMessage]] = TypeAdapter(List[WhatsAppMessage])
+
 # --- NUEVOS MODELOS PARA CONTACTS ---
-class WhatsAppProfile(BaseModel):
+class WhatsAppProfile(_WebhookModel):
     name: str
 
-class WhatsAppContact(BaseModel):
+class WhatsAppContact(_WebhookModel):
     profile: WhatsAppProfile
     wa_id: str # El ID de WhatsApp del usuario
 
 # --- Modelos para Notificaciones de Estado de WhatsApp ---
-class WhatsAppConversationOrigin(BaseModel):
+class WhatsAppConversationOrigin(_WebhookModel):
     type: str
 
-class WhatsAppConversation(BaseModel):
+class WhatsAppConversation(_WebhookModel):
     id: str
     origin: WhatsAppConversationOrigin
     expiration_timestamp: Optional[str] = None
 
-class WhatsAppPricing(BaseModel):
+class WhatsAppPricing(_WebhookModel):
     billable: bool
     pricing_model: str
     category: str
 
-class WhatsAppStatusErrorData(BaseModel):
+class WhatsAppStatusErrorData(_WebhookModel):
     details: str
 
-class WhatsAppStatusError(BaseModel):
+class WhatsAppStatusError(_WebhookModel):
     code: int
     title: str
     message: Optional[str] = None
     error_data: Optional[WhatsAppStatusErrorData] = None
 
-class WhatsAppStatus(BaseModel):
+class WhatsAppStatus(_WebhookModel):
     id: str
     recipient_id: str
     status: str
     timestamp: str
     conversation: Optional[WhatsAppConversation] = None
     pricing: Optional[WhatsAppPricing] = None
-    errors: Optional[List[WhatsAppStatusError]] = None
+    errors: List[WhatsAppStatusError] = Field(default_factory=list)
 
 # --- Modelos para la Estructura General del Payload de Webhook de WhatsApp ---
-class WhatsAppMetadata(BaseModel):
+class WhatsAppMetadata(_WebhookModel):
     display_phone_number: str
     phone_number_id: str
 
-class WhatsAppValue(BaseModel):
+class WhatsAppValue(_WebhookModel):
+    # Listas vacías por defecto (Meta omite la clave cuando no hay elementos): se iteran sin comprobar None
     messaging_product: str
     metadata: WhatsAppMetadata
-    contacts: Optional[List[WhatsAppContact]] = None
-    messages: Optional[List[WhatsAppMessage]] = None
-    statuses: Optional[List[WhatsAppStatus]] = None
-    errors: Optional[List[WhatsAppStatusError]] = None
+    contacts: List[WhatsAppContact] = Field(default_factory=list)
+    messages: List[WhatsAppMessage] = Field(default_factory=list)
+    statuses: List[WhatsAppStatus] = Field(default_factory=list)
+    errors: List[WhatsAppStatusError] = Field(default_factory=list)
 
-class WhatsAppChange(BaseModel):
+class WhatsAppChange(_WebhookModel):
     value: WhatsAppValue
     field: str
 
-class WhatsAppEntry(BaseModel):
+class WhatsAppEntry(_WebhookModel):
     id: str
     changes: List[WhatsAppChange]
 
-class WhatsAppPayload(BaseModel):
+class WhatsAppPayload(_WebhookModel):
+    """Payload completo; se conserva para esquema y documentación. El webhook valida con WHATSAPP_MESSAGES_ADAPTER."""
     object: str
     entry: List[WhatsAppEntry]
 
-    @model_validator(mode='before')
-    @classmethod
-    def ensure_object_is_whatsapp(cls, data: Any) -> Any:
-        if isinstance(data, dict) and data.get("object") != "whatsapp_business_account":
-            pass
-        return data
-
 # --- Modelos para Messenger ---
-class MessengerTextMessage(BaseModel):
+class MessengerTextMessage(_WebhookModel):
     mid: str
     text: str
 
-class MessengerSender(BaseModel):
+class MessengerSender(_WebhookModel):
     id: str # Page-Scoped User ID (PSID)
 
-class MessengerRecipient(BaseModel):
+class MessengerRecipient(_WebhookModel):
     id: str # Page ID
 
-class MessengerPostback(BaseModel):
+class MessengerPostback(_WebhookModel):
     payload: str
     title: Optional[str] = None
 
-class MessagingEvent(BaseModel):
+class MessagingEvent(_WebhookModel):
     sender: MessengerSender
     recipient: MessengerRecipient
     timestamp: int
     message: Optional[MessengerTextMessage] = None
     postback: Optional[MessengerPostback] = None
 
-class MessengerEntry(BaseModel):
+class MessengerEntry(_WebhookModel):
     id: str
     time: int
     messaging: List[MessagingEvent]
 
-class MessengerPayload(BaseModel):
+class MessengerPayload(_WebhookModel):
     object: str
     entry: List[MessengerEntry]
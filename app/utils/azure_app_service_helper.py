@@ -2,18 +2,60 @@
 Módulo para integración específica con Azure App Service.
 Proporciona utilidades para diagnóstico, logs y gestión del ciclo de vida de la aplicación.
 """
+import functools
 import os
+import re
 import sys
 import logging
-import json
+import orjson
 import platform
 import time
+from datetime import datetime
 from pathlib import Path
 from typing import Dict, List, Any, Optional, Set, Tuple
 
 # Configurar logger
 logger = logging.getLogger(__name__)
 
+# El entorno no cambia durante la vida del proceso: se detecta una sola vez al importar
+_IS_AZURE: bool = "WEBSITE_SITE_NAME" in os.environ
+
+# Rutas persistentes de App Service (HOME suele ser /home), construidas una vez
+_HOME = Path(os.environ.get("HOME", "/home"))
+_DATA_DIR = _HOME / "data"
+_LOGS_DIR = _HOME / "LogFiles"
+_FAISS_DIR = _DATA_DIR / "faiss_index"
+
+# Datos del intérprete y del sistema: no cambian durante la vida del proceso (platform() hace uname)
+_PLATFORM = platform.platform()
+_PYTHON_VERSION = f"{sys.version_info.major}.{sys.version_info.minor}.{sys.version_info.micro}"
+
+# Un diagnóstico más reciente que esto, de la misma instancia, no se reescribe en un reinicio
+_DIAG_FRESH_SECONDS = 60
+
+# Variables de entorno que no deben aparecer en el diagnóstico
+_DENIED_ENV_PREFIXES = ("APPSETTING_",)
+_SECRET_ENV_RE = re.compile(r'SECRET|PASSWORD|KEY|TOKEN', re.IGNORECASE)
+
+
+def _is_safe_env(key: str) -> bool:
+    """True si la variable puede incluirse en el diagnóstico (sin prefijos vetados ni nombres sensibles)."""
+    return not key.startswith(_DENIED_ENV_PREFIXES) and not _SECRET_ENV_RE.search(key)
+
+def _diag_file_is_fresh(log_file: Path, instance_id: Optional[str]) -> bool:
+    """True si log_file se escribió hace menos de _DIAG_FRESH_SECONDS por la misma instancia."""
+    if not instance_id:
+        return False
+    try:
+        if time.time() - log_file.stat().st_mtime >= _DIAG_FRESH_SECONDS:
+            return False
+        with log_file.open('rb') as f:
+            head = f.read(512)
+    except OSError:
+        return False
+    return instance_id.encode() in head
+
+
 class AzureAppServiceHelper:
     """
     Proporciona utilidades específicas para el despliegue y diagnóstico en Azure App Service.
@@ -22,17 +64,18 @@ class AzureAppServiceHelper:
     @staticmethod
     def is_running_in_azure() -> bool:
         """Determina si la aplicación está ejecutándose en Azure App Service."""
-        return os.environ.get("WEBSITE_SITE_NAME") is not None
+        return _IS_AZURE
     
     @staticmethod
+    @functools.lru_cache(maxsize=1)
     def get_azure_environment_info() -> Dict[str, Any]:
         """
         Recopila información relevante del entorno de Azure App Service.
         
         Returns:
-            Diccionario con información del entorno de Azure.
+            Diccionario con información del entorno de Azure (cacheado; no modificarlo).
         """
-        if not AzureAppServiceHelper.is_running_in_azure():
+        if not _IS_AZURE:
             return {"is_azure": False}
             
         env_info = {
@@ -43,7 +86,7 @@ class AzureAppServiceHelper:
             "slot_name": os.environ.get("WEBSITE_SLOT_NAME", "production"),
             "container_name": os.environ.get("CONTAINER_NAME"),
             "website_hostname": os.environ.get("WEBSITE_HOSTNAME"),
-            "local_storage_path": os.environ.get("HOME", "/home"),
+            "local_storage_path": str(_HOME),
         }
         
         return env_info
@@ -56,14 +99,11 @@ class AzureAppServiceHelper:
         Returns:
             Diccionario con las rutas de los directorios.
         """
-        # En Azure App Service, HOME suele ser /home
-        base_path = os.environ.get("HOME", "/home")
-        
         # Directorios que podrían necesitarse para persistencia
         directories = {
-            "data": os.path.join(base_path, "data"),
-            "logs": os.path.join(base_path, "LogFiles"),
-            "faiss_index": os.path.join(base_path, "data", "faiss_index"),
+            "data": str(_DATA_DIR),
+            "logs": str(_LOGS_DIR),
+            "faiss_index": str(_FAISS_DIR),
         }
         
         # Crear directorios si no existen
@@ -85,17 +125,11 @@ class AzureAppServiceHelper:
             Diccionario con información diagnóstica.
         """
         diag_info = {
-            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-            "python_version": f"{sys.version_info.major}.{sys.version_info.minor}.{sys.version_info.micro}",
-            "platform": platform.platform(),
+            "timestamp": datetime.now().isoformat(sep=" ", timespec="seconds"),
+            "python_version": _PYTHON_VERSION,
+            "platform": _PLATFORM,
             "azure_info": AzureAppServiceHelper.get_azure_environment_info(),
-            "environment_variables": {
-                k: v for k, v in os.environ.items() 
-                if not (k.startswith("APPSETTING_") or 
-                       "SECRET" in k.upper() or 
-                       "PASSWORD" in k.upper() or 
-                       "KEY" in k.upper())
-            }
+            "environment_variables": {k: v for k, v in os.environ.items() if _is_safe_env(k)}
         }
         
         # Agregar información sobre montajes de volumen si estamos en Azure
@@ -148,54 +182,65 @@ class AzureAppServiceHelper:
             
             # Guardar diagnóstico en archivo si estamos en Azure
             if diag_info['azure_info']['is_azure']:
-                log_dir = diag_info.get('persistent_dirs', {}).get('logs', '/home/LogFiles')
-                os.makedirs(log_dir, exist_ok=True)
+                log_dir = Path(diag_info.get('persistent_dirs', {}).get('logs', _LOGS_DIR))
+                log_file = log_dir / "app_startup_diag.json"
+                if _diag_file_is_fresh(log_file, diag_info['azure_info'].get('instance_id')):
+                    logger.info(f"Diagnóstico reciente de esta instancia ya existe en {log_file}; no se reescribe.")
+                    return
+                log_dir.mkdir(parents=True, exist_ok=True)
                 
-                log_file = os.path.join(log_dir, "app_startup_diag.json")
-                with open(log_file, 'w') as f:
-                    json.dump(diag_info, f, indent=2, default=str)
+                # orjson codifica en C; default=str cubre Path y otros tipos no nativos
+                log_file.write_bytes(
+                    orjson.dumps(diag_info, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS, default=str)
+                )
                 logger.info(f"Diagnóstico guardado en {log_file}")
         except Exception as e:
             logger.error(f"Error al registrar diagnóstico de inicio: {e}", exc_info=True)
     
     @staticmethod
-    def configure_azure_paths_from_env(settings_instance: Any) -> None:
+    def configure_azure_paths_from_env(settings_instance: Any) -> Any:
         """
         Configura rutas de archivos específicas para Azure App Service en la configuración.
         
         Args:
             settings_instance: Instancia de configuración de la aplicación.
+            
+        Returns:
+            Una copia de la configuración con las rutas de Azure (el llamador debe
+            reasignar su referencia), o la misma instancia si no hay nada que cambiar.
         """
         if not AzureAppServiceHelper.is_running_in_azure():
-            return
+            return settings_instance
             
         try:
-            # Obtener ruta base para almacenamiento persistente
-            base_path = os.environ.get("HOME", "/home")
-            
             # Establecer rutas para directorios persistentes si existen esos atributos
-            if hasattr(settings_instance, "DATA_DIR"):
-                data_dir = Path(os.path.join(base_path, "data"))
-                object.__setattr__(settings_instance, "DATA_DIR", data_dir)
-                
-            if hasattr(settings_instance, "LOG_DIR"):
-                log_dir = Path(os.path.join(base_path, "LogFiles"))
-                object.__setattr__(settings_instance, "LOG_DIR", log_dir)
-                
-            if hasattr(settings_instance, "FAISS_FOLDER_PATH") and hasattr(settings_instance, "FAISS_FOLDER_NAME"):
-                # Asegurarse de que data_dir esté definido antes de usarlo
-                data_dir = getattr(settings_instance, "DATA_DIR", Path(os.path.join(base_path, "data")))
-                faiss_dir = data_dir / settings_instance.FAISS_FOLDER_NAME
-                object.__setattr__(settings_instance, "FAISS_FOLDER_PATH", faiss_dir)
+            # model_copy solo actualiza campos declarados: una consulta al dict de campos de la clase
+            # sustituye los hasattr (que recorren descriptores y __getattr__ de pydantic)
+            model_fields = getattr(type(settings_instance), "model_fields", {})
+            updates: Dict[str, Path] = {
+                attr: value
+                for attr, value in (("DATA_DIR", _DATA_DIR), ("LOG_DIR", _LOGS_DIR))
+                if attr in model_fields
+            }
+            if "FAISS_FOLDER_PATH" in model_fields:
+                try:
+                    updates["FAISS_FOLDER_PATH"] = _DATA_DIR / settings_instance.FAISS_FOLDER_NAME
+                except AttributeError:
+                    pass
+            if not updates:
+                return settings_instance
+            
+            # Una sola copia en lugar de mutar la instancia con object.__setattr__
+            new_settings = settings_instance.model_copy(update=updates)
                 
             # Registrar los cambios
             logger.info("Rutas de directorios configuradas para Azure App Service:")
-            for attr in ["DATA_DIR", "LOG_DIR", "FAISS_FOLDER_PATH"]:
-                if hasattr(settings_instance, attr):
-                    logger.info(f"  {attr}: {getattr(settings_instance, attr)}")
+            for attr, value in updates.items():
+                logger.info(f"  {attr}: {value}")
+            return new_settings
         except Exception as e:
             logger.error(f"Error al configurar rutas para Azure App Service: {e}", exc_info=True)
-
+            return settings_instance
 
 # Función auxiliar para uso en startup.sh o main.py
 def prepare_azure_environment():
@@ -5,9 +5,11 @@ correctamente configurados antes del despliegue en Azure.
 """
 import os
 import sys
+import time
 import logging
 import importlib
-import json
+import importlib.util
+import orjson
 from pathlib import Path
 from typing import Dict, List, Any, Optional, Set, Tuple
 
@@ -63,13 +65,16 @@ class DeploymentValidator:
         results = {}
         
         for package in critical_packages:
-            package_base = package.split('.')[0]  # Para manejar submódulos como azure.storage.blob
+            # find_spec solo localiza el módulo, sin ejecutarlo (langchain/faiss pesan cientos de MB).
+            # Para submódulos como azure.storage.blob importa únicamente los paquetes padre.
             try:
-                importlib.import_module(package_base)
-                results[package] = True
+                available = importlib.util.find_spec(package) is not None
+            except (ImportError, ValueError):  # paquete padre ausente
+                available = False
+            results[package] = available
+            if available:
                 logger.info(f"✅ Dependencia {package} disponible")
-            except ImportError:
-                results[package] = False
+            else:
                 logger.error(f"❌ Dependencia {package} NO disponible")
         
         return results
@@ -176,7 +181,7 @@ class DeploymentValidator:
         validator = DeploymentValidator()
         
         report = {
-            "timestamp": import_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
             "environment": validator.check_environment(),
             "dependencies": validator.validate_critical_dependencies(),
             "file_structure": validator.validate_file_structure(),
@@ -237,8 +242,10 @@ class DeploymentValidator:
             output_path = f"deployment_report_{timestamp}.json"
             
         try:
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(report, f, indent=2, default=str)
+            # orjson codifica en C y escribe los bytes de una sola vez
+            Path(output_path).write_bytes(
+                orjson.dumps(report, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS, default=str)
+            )
             logger.info(f"Informe guardado en {output_path}")
             return output_path
         except Exception as e:
@@ -253,8 +260,6 @@ if __name__ == "__main__":
         format='%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s'
     )
     
-    import time as import_time
-    
     # Generar y guardar un informe
     validator = DeploymentValidator()
     report = validator.generate_deployment_report()
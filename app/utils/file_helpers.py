@@ -1,11 +1,18 @@
 # app/utils/file_helpers.py
 import re
+import stat
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional
 from unidecode import unidecode
 from app.core.config import settings
 from .logger import logger
 
+# Patrones de _normalize_brand_name compilados una sola vez
+_RE_NONWORD = re.compile(r'[^\w\s-]')
+_RE_SPACES = re.compile(r'\s+')
+_RE_TRAIL = re.compile(r'[^a-z0-9_-]')
+
 def _normalize_brand_name(name: str) -> str:
     """
     Normaliza un nombre de marca para usarlo como nombre de archivo.
@@ -15,16 +22,28 @@ def _normalize_brand_name(name: str) -> str:
         return "invalid_brand_name"
         
     s = unidecode(name).lower()
-    s = re.sub(r'[^\w\s-]', '', s)
-    s = re.sub(r'\s+', '_', s)
-    s = re.sub(r'[^a-z0-9_-]', '', s)
+    s = _RE_NONWORD.sub('', s)
+    s = _RE_SPACES.sub('_', s)
+    s = _RE_TRAIL.sub('', s)
     s = s.strip('_-')
     
     return s or "normalized_to_empty"
 
+@lru_cache(maxsize=128)
+def _read_brand_file(file_path: Path, mtime_ns: int) -> str:
+    """
+    Lee y decodifica un archivo de contexto de marca.
+    mtime_ns forma parte de la clave: si el archivo se reescribe, la entrada cacheada deja de usarse.
+    """
+    # read_bytes evita montar un TextIOWrapper; se conserva la normalización de saltos de línea de read_text
+    content = file_path.read_bytes().decode('utf-8').replace('\r\n', '\n').strip()
+    logger.info(f"Contexto de marca leído desde disco: '{file_path.name}'.")
+    return content
+
 def get_brand_context(brand_name: str) -> Optional[str]:
     """
     Obtiene el contexto de una marca desde un archivo de texto.
+    El contenido se sirve desde memoria mientras el archivo no cambie (mtime).
     
     Args:
         brand_name: Nombre de la marca cuyo contexto se quiere obtener
@@ -34,27 +53,39 @@ def get_brand_context(brand_name: str) -> Optional[str]:
     """
     # REFACTOR: Usar la nueva estructura de directorios desde settings
     brands_dir = settings.DATA_DIR_PATH / "brands"
-    
-    if not brands_dir.is_dir():
-        logger.error(f"El directorio de marcas no existe: {brands_dir}")
-        return None
-        
     normalized_filename = f"{_normalize_brand_name(brand_name)}.txt"
     file_path = brands_dir / normalized_filename
     
-    if not file_path.is_file():
+    try:
+        # Un solo stat: confirma que existe y da la clave de invalidación
+        file_stat = file_path.stat()
+    except FileNotFoundError:
+        if not brands_dir.is_dir():
+            logger.error(f"El directorio de marcas no existe: {brands_dir}")
+        else:
+            logger.warning(f"Archivo de contexto no encontrado para '{brand_name}' en '{file_path}'")
+        return None
+    except OSError as e:
+        logger.error(f"Error al acceder al archivo de contexto para '{brand_name}': {e}", exc_info=True)
+        return None
+        
+    if not stat.S_ISREG(file_stat.st_mode):
         logger.warning(f"Archivo de contexto no encontrado para '{brand_name}' en '{file_path}'")
         return None
         
     try:
-        content = file_path.read_text(encoding='utf-8').strip()
+        content = _read_brand_file(file_path, file_stat.st_mtime_ns)
         if not content:
             logger.warning(f"Archivo de contexto para '{brand_name}' está vacío.")
             return ""
             
-        logger.info(f"Contexto cargado para '{brand_name}' desde '{file_path.name}'.")
+        logger.debug(f"Contexto cargado para '{brand_name}' desde '{file_path.name}'.")
         return content
         
+    except FileNotFoundError:
+        # El archivo desapareció entre el stat y la lectura
+        logger.warning(f"Archivo de contexto para '{brand_name}' eliminado durante la lectura: '{file_path}'")
+        return None
     except Exception as e:
         logger.error(f"Error al leer archivo de contexto para '{brand_name}': {e}", exc_info=True)
         return None
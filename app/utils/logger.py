@@ -1,13 +1,15 @@
 # app/utils/logger.py
+import atexit
+import functools
 import logging
+import queue
+import secrets
 import sys
 import os
-import uuid
 import contextvars
 from pathlib import Path
-from logging.handlers import RotatingFileHandler
-import threading
-from typing import Optional, Dict, Any
+from logging.handlers import MemoryHandler, QueueHandler, QueueListener, RotatingFileHandler
+from typing import Optional, Dict, Any, List, Tuple
 
 # REFACTOR: Ahora evitamos dependencias circulares importando settings solo cuando sea necesario
 # y no a nivel de módulo, para que otros módulos puedan importar logger sin problemas
@@ -19,14 +21,14 @@ request_id_var = contextvars.ContextVar('request_id', default=None)
 logger = logging.getLogger("ChatbotApp")
 logger.setLevel(logging.INFO)  # Nivel por defecto hasta que se configure
 
-# Flag para evitar configuración múltiple
-_logger_configured = False
+# Listener que escribe en consola/archivo desde un hilo propio; los loggers solo encolan
+_queue_listener: Optional[QueueListener] = None
 
-# Bloqueo para concurrencia
-_logger_lock = threading.Lock()
+# Búfer delante del archivo de log: agrupa escrituras; se vacía con ERROR, al llenarse o al salir
+_file_buffer: Optional[MemoryHandler] = None
 
 
-def set_request_id(req_id: Optional[str] = None) -> str:
+def set_request_id(req_id: Optional[str] = None) -> Tuple[str, contextvars.Token]:
     """
     Establece un ID de solicitud para la ejecución actual.
     Si no se proporciona un ID, genera uno nuevo con UUID.
@@ -36,15 +38,16 @@ def set_request_id(req_id: Optional[str] = None) -> str:
         req_id: ID de solicitud opcional. Si es None, se generará uno nuevo.
         
     Returns:
-        El ID de solicitud establecido.
+        Tupla (ID de solicitud establecido, token para restaurar el valor anterior
+        con ``request_id_var.reset(token)``).
     """
     if req_id is None:
-        # Generar un UUID4 como request_id por defecto
-        req_id = f"req-{uuid.uuid4().hex[:12]}"
+        # 6 bytes aleatorios en hex (12 caracteres) como request_id por defecto
+        req_id = f"req-{secrets.token_hex(6)}"
     
-    # Almacena el ID en el contexto del thread actual
-    request_id_var.set(req_id)
-    return req_id
+    # Almacena el ID en el contexto actual
+    token = request_id_var.set(req_id)
+    return req_id, token
 
 
 def get_request_id() -> Optional[str]:
@@ -57,113 +60,249 @@ def get_request_id() -> Optional[str]:
     return request_id_var.get()
 
 
-def clear_request_id() -> None:
-    """
-    Elimina el ID de solicitud del contexto actual.
-    """
-    request_id_var.set(None)
-
-
 class RequestIdFilter(logging.Filter):
     """
     Filtro de logging que agrega el request_id a todos los registros.
     """
     def filter(self, record):
-        # Obtener el ID de solicitud actual y agregarlo al registro
-        request_id = get_request_id()
-        record.request_id = request_id if request_id else "-"
+        # Lectura directa del ContextVar; "-" cuando no hay solicitud en curso
+        record.request_id = request_id_var.get() or "-"
         return True
 
-def setup_logging():
+class CountingRotatingFileHandler(RotatingFileHandler):
     """
-    Configura el sistema de logging de forma auto-contenida.
-    Se llama automáticamente cuando este módulo es importado.
+    RotatingFileHandler que lleva en memoria los bytes escritos y solo consulta el archivo
+    (seek/tell) cada _SYNC_INTERVAL bytes o al acercarse a maxBytes, en lugar de en cada registro.
     """
-    global _logger_configured
-    
-    with _logger_lock:
-        if _logger_configured:
+    _SYNC_INTERVAL = 64 * 1024
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self._synced_size = self._file_size()
+        self._unsynced = 0
+
+    def _file_size(self) -> int:
+        if self.stream is None:  # delay=True: el archivo aún no está abierto
+            return 0
+        self.stream.seek(0, 2)
+        return self.stream.tell()
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.maxBytes <= 0:
+            return False
+        if self._unsynced < self._SYNC_INTERVAL and self._synced_size + self._unsynced < self.maxBytes - self._SYNC_INTERVAL:
+            return False
+        # Cerca del límite o tras muchos registros: resincronizar con el tamaño real
+        self._synced_size = self._file_size()
+        self._unsynced = 0
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        self._synced_size = self._file_size()
+        self._unsynced = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            msg = self.format(record)
+            self.stream.write(msg + self.terminator)
+            self.flush()
+            self._unsynced += len(msg) + len(self.terminator)
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def emit_batch(self, records: List[logging.LogRecord]) -> None:
+        """Escribe varios registros con un solo write() y un solo flush()."""
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.format(record) + self.terminator)
+            except RecursionError:
+                raise
+            except Exception:
+                self.handleError(record)
+        if not lines:
             return
+        self.acquire()
+        try:
+            # La rotación se decide por lote: el archivo puede pasar de maxBytes en un lote como mucho
+            if self.shouldRollover(records[0]):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            data = "".join(lines)
+            self.stream.write(data)
+            self.flush()
+            self._unsynced += len(data)
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(records[0])
+        finally:
+            self.release()
+
+
+class BatchingMemoryHandler(MemoryHandler):
+    """MemoryHandler que entrega el búfer completo al destino en una sola escritura."""
+
+    def flush(self) -> None:
+        self.acquire()
+        try:
+            if self.buffer and isinstance(self.target, CountingRotatingFileHandler):
+                self.target.emit_batch(self.buffer)
+                self.buffer.clear()
+            else:
+                super().flush()
+        finally:
+            self.release()
+
+
+def flush_log_buffers() -> None:
+    """
+    Escribe en disco los registros acumulados en el búfer del archivo.
+    Llamar antes de propagar un error fatal para no perder el contexto previo.
+    """
+    if _file_buffer is not None:
+        _file_buffer.flush()
+
+
+def _restart_queue_listener_in_child() -> None:
+    """
+    Con gunicorn preload_app el logger se configura en el proceso maestro; tras el fork
+    el hilo del listener no existe en el worker, así que se recrea con una cola nueva.
+    El búfer del archivo heredado se vacía sin escribir: esos registros son del maestro.
+    """
+    global _queue_listener
+    if _file_buffer is not None:
+        _file_buffer.buffer.clear()
+    if _queue_listener is None:
+        return
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    for handler in logger.handlers:
+        if isinstance(handler, QueueHandler):
+            handler.queue = log_queue
+    _queue_listener = QueueListener(log_queue, *_queue_listener.handlers, respect_handler_level=True)
+    _queue_listener.start()
+    atexit.register(_queue_listener.stop)
+
+
+if hasattr(os, "register_at_fork"):
+    # El maestro escribe su búfer antes de cada fork para que ningún worker lo herede
+    os.register_at_fork(before=flush_log_buffers, after_in_child=_restart_queue_listener_in_child)
+
+
+@functools.cache
+def _do_setup() -> None:
+    """Cuerpo de setup_logging; functools.cache garantiza que se ejecute una sola vez."""
+    global _queue_listener, _file_buffer
+    
+    print(f"[logger.py] Configurando el logger para PID {os.getpid()}")
+    
+    # Importar settings solo cuando sea necesario
+    try:
+        from app.core.config import settings
         
-        print(f"[logger.py] Configurando el logger para PID {os.getpid()}")
+        # Limpiar los handlers existentes
+        if logger.handlers:
+            logger.handlers.clear()
         
-        # Importar settings solo cuando sea necesario
-        try:
-            from app.core.config import settings
-            
-            # Limpiar los handlers existentes
-            if logger.handlers:
-                logger.handlers.clear()
-            
-            # Desactivar propagación para evitar duplicación
-            logger.propagate = False
-            
-            # Establecer el nivel de log
-            log_level = getattr(logging, settings.LOG_LEVEL, logging.INFO)
-            logger.setLevel(log_level)
-            
-            # Aplicar el filtro de request_id a todos los registros
-            logger.addFilter(RequestIdFilter())
-            
-            # Formato del log con request_id incluido
-            default_format = '%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] [%(filename)s:%(lineno)d] - %(message)s'
-            log_format = settings.LOG_FORMAT if hasattr(settings, 'LOG_FORMAT') else default_format
-            formatter = logging.Formatter(log_format)
-            
-            # Handler para consola
-            console_handler = logging.StreamHandler(sys.stdout)
-            console_handler.setFormatter(formatter)
-            logger.addHandler(console_handler)
-            
-            # Handler para archivo
-            log_dir = settings.LOG_DIR_PATH if hasattr(settings, 'LOG_DIR_PATH') else Path("logs")
-            log_dir.mkdir(parents=True, exist_ok=True)
-            
-            log_file = log_dir / "app.log"
-            
-            try:
-                file_handler = RotatingFileHandler(
-                    filename=log_file,
-                    maxBytes=10 * 1024 * 1024,  # 10 MB
-                    backupCount=5,
-                    encoding='utf-8'
-                )
-                file_handler.setFormatter(formatter)
-                logger.addHandler(file_handler)
-                print(f"[logger.py] Logging a archivo configurado: {log_file}")
-            except Exception as e:
-                print(f"[logger.py] Error al configurar el log a archivo: {e}", file=sys.stderr)
-                # Continuar con solo el handler de consola
-            
-            logger.info(f"Logger configurado para el proceso {os.getpid()} en nivel {settings.LOG_LEVEL}")
-            _logger_configured = True
-            
-        except ImportError as e:
-            # Configuración de emergencia si no podemos importar settings
-            print(f"[logger.py] No se pudo importar settings: {e}. Usando configuración de emergencia.", file=sys.stderr)
-            
-            # Configurar un handler de emergencia
-            if not logger.handlers:
-                handler = logging.StreamHandler(sys.stderr)
-                formatter = logging.Formatter('%(asctime)s - %(name)s - EMERGENCY - %(levelname)s - %(message)s')
-                handler.setFormatter(formatter)
-                logger.addHandler(handler)
-                logger.setLevel(logging.INFO)
-            
-            _logger_configured = True
+        # Desactivar propagación para evitar duplicación
+        logger.propagate = False
+        
+        # Establecer el nivel de log
+        log_level = getattr(logging, settings.LOG_LEVEL, logging.INFO)
+        logger.setLevel(log_level)
+        
+        # Formato del log con request_id incluido
+        default_format = '%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] [%(filename)s:%(lineno)d] - %(message)s'
+        log_format = settings.LOG_FORMAT if hasattr(settings, 'LOG_FORMAT') else default_format
+        formatter = logging.Formatter(log_format)
+        
+        # Handler para consola
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(formatter)
+        output_handlers = [console_handler]
         
+        # Handler para archivo
+        log_dir = settings.LOG_DIR_PATH if hasattr(settings, 'LOG_DIR_PATH') else Path("logs")
+        log_dir.mkdir(parents=True, exist_ok=True)
+        
+        log_file = log_dir / "app.log"
+        
+        try:
+            file_handler = CountingRotatingFileHandler(
+                filename=log_file,
+                maxBytes=10 * 1024 * 1024,  # 10 MB
+                backupCount=5,
+                encoding='utf-8'
+            )
+            file_handler.setFormatter(formatter)
+            # Cada registro no se convierte en un write(): se acumulan y se escriben por lotes
+            _file_buffer = BatchingMemoryHandler(
+                capacity=getattr(settings, 'LOG_BUFFER', 512),
+                flushLevel=logging.ERROR,
+                target=file_handler,
+                flushOnClose=True
+            )
+            atexit.register(_file_buffer.flush)
+            output_handlers.append(_file_buffer)
+            print(f"[logger.py] Logging a archivo configurado: {log_file}")
         except Exception as e:
-            print(f"[logger.py] Error al configurar el logger: {e}", file=sys.stderr)
-            
-            # Asegurar que haya al menos un handler básico
-            if not logger.handlers:
-                handler = logging.StreamHandler(sys.stderr)
-                formatter = logging.Formatter('%(asctime)s - EMERGENCY - %(message)s')
-                handler.setFormatter(formatter)
-                logger.addHandler(handler)
-                logger.setLevel(logging.ERROR)
-            
-            _logger_configured = True
+            print(f"[logger.py] Error al configurar el log a archivo: {e}", file=sys.stderr)
+            # Continuar con solo el handler de consola
+        
+        # Las llamadas a logger.* solo hacen queue.put; la E/S (stdout, archivo, rotación)
+        # ocurre en el hilo del QueueListener y no bloquea el event loop
+        log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+        queue_handler = QueueHandler(log_queue)
+        # El filtro de request_id va en el handler (no en el logger) para cubrir también los
+        # registros propagados desde loggers hijos; debe ser el QueueHandler porque el
+        # ContextVar solo es legible en el hilo que emite, no en el del QueueListener
+        queue_handler.addFilter(RequestIdFilter())
+        logger.addHandler(queue_handler)
+        _queue_listener = QueueListener(log_queue, *output_handlers, respect_handler_level=True)
+        _queue_listener.start()
+        atexit.register(_queue_listener.stop)
+        
+        logger.info(f"Logger configurado para el proceso {os.getpid()} en nivel {settings.LOG_LEVEL}")
+        
+    except ImportError as e:
+        # Configuración de emergencia si no podemos importar settings
+        print(f"[logger.py] No se pudo importar settings: {e}. Usando configuración de emergencia.", file=sys.stderr)
+        
+        # Configurar un handler de emergencia
+        if not logger.handlers:
+            handler = logging.StreamHandler(sys.stderr)
+            formatter = logging.Formatter('%(asctime)s - %(name)s - EMERGENCY - %(levelname)s - %(message)s')
+            handler.setFormatter(formatter)
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+    
+    except Exception as e:
+        print(f"[logger.py] Error al configurar el logger: {e}", file=sys.stderr)
+        
+        # Asegurar que haya al menos un handler básico
+        if not logger.handlers:
+            handler = logging.StreamHandler(sys.stderr)
+            formatter = logging.Formatter('%(asctime)s - EMERGENCY - %(message)s')
+            handler.setFormatter(formatter)
+            logger.addHandler(handler)
+            logger.setLevel(logging.ERROR)
+
+
+def setup_logging():
+    """
+    Configura el sistema de logging de forma auto-contenida.
+    Se llama automáticamente cuando este módulo es importado.
+    """
+    _do_setup()
+
 
 # Auto-configurar el logger cuando el módulo es importado
 setup_logging()
\ No newline at end of file
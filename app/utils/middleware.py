@@ -2,75 +2,88 @@
 Middleware utilities for enhancing observability and request tracing.
 Includes middleware for request ID tracking and other cross-cutting concerns.
 """
-from fastapi import Request, Response
-from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
-from typing import Callable, Optional
-import uuid
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
-from app.utils.logger import logger, set_request_id, get_request_id, clear_request_id
+from app.utils.logger import logger, request_id_var, set_request_id, flush_log_buffers
 
+# Rutas cuyo acceso correcto no se registra (ni siquiera se crea el LogRecord)
+_QUIET_PATHS = frozenset({"/health", "/metrics", "/favicon.ico"})
 
-class RequestIdMiddleware(BaseHTTPMiddleware):
+
+class RequestIdMiddleware:
     """
     Middleware que asigna automáticamente un identificador único a cada solicitud HTTP.
     
     Mejora la observabilidad y trazabilidad al mantener un ID consistente
     a lo largo de toda la ejecución de la solicitud, facilitando la correlación
     de logs y eventos distribuidos.
+    
+    Es un middleware ASGI puro: a diferencia de BaseHTTPMiddleware no envuelve la
+    aplicación en un task group ni pasa la respuesta por una cola, así que no añade
+    tareas ni saltos de corrutina por solicitud.
     """
     
-    def __init__(self, app):
-        super().__init__(app)
+    def __init__(self, app: ASGIApp):
+        self.app = app
     
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
         """
         Captura cada solicitud, asigna un request_id y lo propaga en los headers de respuesta.
         
         Args:
-            request: La solicitud HTTP entrante
-            call_next: La función para continuar la cadena de middleware
-            
-        Returns:
-            La respuesta HTTP con el request_id incluido
+            scope: Scope ASGI de la conexión
+            receive: Canal de recepción ASGI
+            send: Canal de envío ASGI, envuelto para añadir el header X-Request-ID
         """
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
         # Extraer request_id de los headers si existe, o generar uno nuevo
-        request_id = request.headers.get("X-Request-ID")
+        request_id = next((value.decode("latin-1") for key, value in scope["headers"] if key == b"x-request-id"), None)
         if request_id:
             # Usar el ID proporcionado por el cliente
-            set_request_id(request_id)
-            logger.debug(f"Usando request_id proporcionado por el cliente: {request_id}")
+            request_id, token = set_request_id(request_id)
+            logger.debug("Usando request_id proporcionado por el cliente: %s", request_id)
         else:
             # Generar ID único para esta solicitud
-            request_id = set_request_id()
-            logger.debug(f"Generado nuevo request_id: {request_id}")
+            request_id, token = set_request_id()
+            logger.debug("Generado nuevo request_id: %s", request_id)
         
+        status_code = 0
+        
+        async def send_with_request_id(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                # Agregar el request_id a los headers de respuesta para correlación
+                MutableHeaders(scope=message)["X-Request-ID"] = request_id
+            await send(message)
+        
+        method = scope["method"]
+        path = scope["path"]
         try:
             # Procesar la solicitud con el request_id establecido en el contexto
-            response = await call_next(request)
+            await self.app(scope, receive, send_with_request_id)
             
-            # Agregar el request_id a los headers de respuesta para correlación
-            response.headers["X-Request-ID"] = request_id
-            
-            # Registrar información sobre la solicitud completada
-            status_code = getattr(response, "status_code", 0)
-            path = request.url.path
-            method = request.method
+            # Campos estructurados para los shippers de logs en JSON
+            log_extra = {"http_method": method, "http_path": path, "http_status": status_code}
             
             # Registrar estadísticas básicas de la solicitud
             if 400 <= status_code < 500:
-                logger.warning(f"Cliente {method} {path} → {status_code}")
+                logger.warning("Cliente %s %s → %s", method, path, status_code, extra=log_extra)
             elif status_code >= 500:
-                logger.error(f"Error servidor {method} {path} → {status_code}")
+                logger.error("Error servidor %s %s → %s", method, path, status_code, extra=log_extra)
             else:
-                if path != "/health" and path != "/metrics":  # No registrar endpoints de healthcheck
-                    logger.info(f"Completado {method} {path} → {status_code}")
-            
-            return response
+                if path not in _QUIET_PATHS:  # No registrar endpoints de healthcheck
+                    logger.info("Completado %s %s → %s", method, path, status_code, extra=log_extra)
             
         except Exception as e:
             # Capturar y registrar cualquier excepción no manejada
-            logger.exception(f"Error no manejado procesando {request.method} {request.url.path}: {str(e)}")
+            logger.exception("Error no manejado procesando %s %s: %s", method, path, e)
+            flush_log_buffers()
             raise
         finally:
-            # Siempre limpiar el request_id del contexto al finalizar
-            clear_request_id()
+            # Restaurar el valor previo del contexto en lugar de sobrescribirlo con None
+            request_id_var.reset(token)
@@ -2,20 +2,107 @@
 Módulo de resiliencia para proteger la aplicación contra fallos en servicios externos.
 Implementa circuit breakers para evitar fallos en cascada.
 """
-import pybreaker
 import logging
 import functools
 import asyncio
-from typing import Any, Callable, Coroutine, TypeVar
+import time
+from typing import Any, AsyncIterator, Callable, Coroutine, Optional, Tuple, Type, TypeVar
 
 T = TypeVar('T')
 logger = logging.getLogger(__name__)
 
+
+class CircuitOpenError(Exception):
+    """Se lanza cuando el circuito está abierto y la llamada se rechaza sin ejecutarse."""
+
+
+class AsyncCircuitBreaker:
+    """
+    Circuit breaker nativo para corrutinas.
+    La corrutina protegida se ejecuta en el event loop del llamador: sin saltos a hilos
+    ni loops nuevos por llamada, de modo que conserva el pool de conexiones del cliente HTTP.
+    """
+
+    def __init__(self, fail_max: int, reset_timeout: float, exclude: Tuple[Type[BaseException], ...] = ()):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        # CancelledError no indica un fallo del servicio
+        self._exclude = tuple(exclude) + (asyncio.CancelledError,)
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._half_open_trial = False
+
+    @property
+    def current_state(self) -> str:
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def _admit(self) -> None:
+        if self._opened_at is not None:
+            # Pasado reset_timeout se deja pasar una única llamada de prueba (half-open)
+            if self._half_open_trial or time.monotonic() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"Circuito abierto tras {self._failures} fallos consecutivos")
+            self._half_open_trial = True
+
+    async def call(self, func: Callable[..., Coroutine[Any, Any, T]], *args, **kwargs) -> T:
+        self._admit()
+        try:
+            result = await func(*args, **kwargs)
+        except self._exclude:
+            self._half_open_trial = False
+            raise
+        except Exception:
+            self._on_failure()
+            raise
+        self._on_success()
+        return result
+
+    async def stream(self, func: Callable[..., AsyncIterator[T]], *args, **kwargs) -> AsyncIterator[T]:
+        """Como call, para generadores asíncronos: un fallo a mitad del stream también cuenta."""
+        self._admit()
+        agen = func(*args, **kwargs)
+        try:
+            async for item in agen:
+                yield item
+        except self._exclude:
+            self._half_open_trial = False
+            raise
+        except Exception:
+            self._on_failure()
+            raise
+        except BaseException:
+            # El consumidor cerró el generador antes de terminar (GeneratorExit): no es un fallo
+            self._half_open_trial = False
+            raise
+        else:
+            self._on_success()
+        finally:
+            await agen.aclose()
+
+    def _on_failure(self) -> None:
+        self._failures += 1
+        if self._half_open_trial or self._failures >= self.fail_max:
+            if self._opened_at is None or self._half_open_trial:
+                logger.warning("Circuit breaker abierto tras %d fallos consecutivos.", self._failures)
+            self._opened_at = time.monotonic()
+        self._half_open_trial = False
+
+    def _on_success(self) -> None:
+        if self._opened_at is not None:
+            logger.info("Circuit breaker cerrado: el servicio respondió correctamente.")
+        self._failures = 0
+        self._opened_at = None
+        self._half_open_trial = False
+
+
 # Circuit breaker para las llamadas a la API del LLM
-llm_breaker = pybreaker.CircuitBreaker(
+llm_breaker = AsyncCircuitBreaker(
     fail_max=3,           # Abre el circuito después de 3 fallos consecutivos
     reset_timeout=60,     # Intenta cerrar el circuito después de 60 segundos
-    exclude=[KeyboardInterrupt, SystemExit],  # Excepciones que no cuentan como fallos
+    exclude=(KeyboardInterrupt, SystemExit),  # Excepciones que no cuentan como fallos
 )
 
 def async_circuit(func: Callable[..., Coroutine[Any, Any, T]]):
@@ -27,18 +114,20 @@ def async_circuit(func: Callable[..., Coroutine[Any, Any, T]]):
     @functools.wraps(func)
     async def wrapper(*args, **kwargs):
         try:
-            # Adaptamos la función asíncrona a pybreaker que es síncrono
-            loop = asyncio.get_running_loop()
-            
-            # Crear una tarea que se ejecuta en un thread separado
-            def run_async_in_sync():
-                return llm_breaker.call(
-                    lambda: asyncio.run(func(*args, **kwargs))
-                )
-                
-            result = await loop.run_in_executor(None, run_async_in_sync)
-            return result
-        except pybreaker.CircuitBreakerError as e:
+            return await llm_breaker.call(func, *args, **kwargs)
+        except CircuitOpenError as e:
+            logger.error(f"Circuit breaker abierto - Servicio no disponible: {e}")
+            raise ValueError("Servicio temporalmente no disponible")
+    return wrapper
+
+def async_circuit_stream(func: Callable[..., AsyncIterator[T]]):
+    """Variante de async_circuit para generadores asíncronos (respuestas en streaming)."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        try:
+            async for item in llm_breaker.stream(func, *args, **kwargs):
+                yield item
+        except CircuitOpenError as e:
             logger.error(f"Circuit breaker abierto - Servicio no disponible: {e}")
             raise ValueError("Servicio temporalmente no disponible")
     return wrapper
@@ -4,6 +4,7 @@ Este módulo contiene funciones de procesamiento de texto que se utilizan en mú
 de la aplicación, para evitar acoplamientos circulares y promover la reutilización.
 """
 
+import functools
 import re
 from unidecode import unidecode
 from typing import Dict
@@ -11,6 +12,33 @@ from typing import Dict
 from app.utils.logger import logger
 from app.ai.rag_prompt_builder import BRAND_PROFILES, BRAND_NAME_MAPPING, normalize_brand_name_for_search
 
+# Patrones del fallback de normalize_brand_name, compilados una sola vez
+_PREFIX_RE = re.compile(r'^(empresa:|consultor:|marca:|cliente:)\s*', re.IGNORECASE)
+_NON_ALNUM_RE = re.compile(r'[^\w\s-]')
+_WS_RE = re.compile(r'\s+')
+_FINAL_STRIP_RE = re.compile(r'[^a-z0-9_-]')
+
+# Caracteres problemáticos que llegan en los nombres de marca. Traducirlos con str.translate
+# deja ASCII la inmensa mayoría de entradas y evita cargar las tablas de unidecode.
+# "‚" (U+201A) y "\x82" son la "é" de Ehécatl mal decodificada (cp850 leído como cp1252/latin-1).
+_TRANSLATE = str.maketrans({'ñ': 'n', 'Ñ': 'N', '‹': '', '›': '', '‚': 'e', '\x82': 'e'})
+
+_JAVIER_BAZAN = "CONSULTOR: Javier Bazán"
+_CORPORATIVO_EHECATL = "Corporativo Ehécatl SA de CV"
+_UDD = "Universidad para el Desarrollo Digital (UDD)"
+
+# Casos especiales evaluados en orden sobre el nombre en minúsculas: (fragmentos requeridos, nombre exacto, etiqueta de log).
+# "baz" cubre bazan/bazán, "eh" cubre ehe/ehecatl y "universidad_desarrollo_digital" queda cubierto por la entrada de tres palabras.
+_SPECIAL_BRAND_CASES = (
+    (("javier", "baz"), _JAVIER_BAZAN, "JAVIER"),
+    # Carácter U+201A en "Eh‚catl": es casi seguro que es Corporativo Ehécatl
+    (("‚",), _CORPORATIVO_EHECATL, "CARACTER U+201A"),
+    (("corporativo", "eh"), _CORPORATIVO_EHECATL, "CORPORATIVO"),
+    (("corporativo", "catl"), _CORPORATIVO_EHECATL, "CORPORATIVO"),
+    (("universidad", "desarrollo", "digital"), _UDD, "UDD"),
+    (("udd",), _UDD, "UDD"),
+)
+
 def normalize_brand_name(name: str) -> str:
     """Normaliza el nombre de una marca/consultor para uso en recuperación RAG.
     
@@ -22,36 +50,21 @@ def normalize_brand_name(name: str) -> str:
     """
     if not isinstance(name, str) or not name.strip():
         return "invalid_brand_name"
-    
+    return _normalize_brand_name_cached(name)
+
+@functools.lru_cache(maxsize=2048)
+def _normalize_brand_name_cached(name: str) -> str:
+    """Resolución de normalize_brand_name memoizada: las marcas son pocas y BRAND_PROFILES/
+    BRAND_NAME_MAPPING no cambian tras el import, así que cada nombre se resuelve una sola vez
+    (casos especiales, normalización y la búsqueda parcial O(N) sobre el mapeo)."""
     # PRIMERO: Revisar casos especiales directamente (sin normalizar)
     brand_name_lower = name.lower().strip()
     
-    # CASO ESPECIAL: Detectar específicamente "Javier Bazán"
-    if "javier" in brand_name_lower and any(x in brand_name_lower for x in ["baz", "bazan", "bazán"]):
-        exact_name = "CONSULTOR: Javier Bazán"
-        logger.info(f"CASO ESPECIAL JAVIER EN WEBHOOK: '{name}' → '{exact_name}'")
-        return exact_name
-    
-    # CASO ESPECIAL: Detectar específicamente "Corporativo Ehécatl"
-    # Primero tratar el carácter especial U+201A en "Eh‚catl"
-    if '‚' in brand_name_lower or '‚' in name:
-        # Si contiene este carácter especial, es casi seguro que es Corporativo Ehécatl
-        exact_name = "Corporativo Ehécatl SA de CV"
-        logger.info(f"CASO ESPECIAL CARACTER U+201A DETECTADO EN: '{name}' → '{exact_name}'")
-        return exact_name
-    
-    if "corporativo" in brand_name_lower and any(x in brand_name_lower for x in ["eh", "ehe", "ehecatl", "ehcatl", "catl"]):
-        exact_name = "Corporativo Ehécatl SA de CV"
-        logger.info(f"CASO ESPECIAL CORPORATIVO EN WEBHOOK: '{name}' → '{exact_name}'")
-        return exact_name
-        
-    # CASO ESPECIAL: Detectar específicamente "Universidad para el Desarrollo Digital"
-    if ("universidad" in brand_name_lower and "desarrollo" in brand_name_lower and "digital" in brand_name_lower) or \
-       ("udd" in brand_name_lower) or \
-       ("universidad_desarrollo_digital" in brand_name_lower):
-        exact_name = "Universidad para el Desarrollo Digital (UDD)"
-        logger.info(f"CASO ESPECIAL UDD EN WEBHOOK: '{name}' → '{exact_name}'")
-        return exact_name
+    # CASOS ESPECIALES: basta con que aparezcan todos los fragmentos de alguna entrada
+    for fragments, exact_name, label in _SPECIAL_BRAND_CASES:
+        if all(fragment in brand_name_lower for fragment in fragments):
+            logger.debug("CASO ESPECIAL %s EN WEBHOOK: '%s' → '%s'", label, name, exact_name)
+            return exact_name
     
     # 1. Verificar si el nombre exacto existe en BRAND_PROFILES
     if name in BRAND_PROFILES:
@@ -60,53 +73,65 @@ def normalize_brand_name(name: str) -> str:
     try:
         # 2. Normalizar el nombre para la búsqueda
         normalized_brand = normalize_brand_name_for_search(name)
-        logger.info(f"Nombre normalizado en webhook_handler: '{normalized_brand}'")
+        logger.debug("Nombre normalizado en webhook_handler: '%s'", normalized_brand)
         
         # 3. Buscar en el mapeo de nombres normalizados
         if normalized_brand in BRAND_NAME_MAPPING:
             exact_name = BRAND_NAME_MAPPING[normalized_brand]
-            logger.info(f"MARCA NORMALIZADA: '{name}' → '{exact_name}' (usando mapeo directo)")
+            logger.debug("MARCA NORMALIZADA: '%s' → '%s' (usando mapeo directo)", name, exact_name)
             return exact_name
         
         # 4. Intentar coincidencia parcial
         for norm_key, exact_key in BRAND_NAME_MAPPING.items():
             if norm_key in normalized_brand or normalized_brand in norm_key:
-                logger.info(f"MARCA NORMALIZADA: '{name}' → '{exact_key}' (usando coincidencia parcial)")
+                logger.debug("MARCA NORMALIZADA: '%s' → '%s' (usando coincidencia parcial)", name, exact_key)
                 return exact_key
     except Exception as e:
         logger.error(f"Error al normalizar nombre de marca en webhook: {e}")
     
     # 5. Si todo falla, aplicar normalización estándar como fallback
-    # Dar tratamiento especial a caracteres problemáticos
-    s = name.replace('ñ', 'n').replace('Ñ', 'N')
-    s = name.replace('‹', '').replace('›', '')
-    s = name.replace('', 'e').replace('', 'e')
+    # Dar tratamiento especial a caracteres problemáticos en una sola pasada
+    s = name.translate(_TRANSLATE)
     
-    # Luego aplicar unidecode para otros caracteres especiales
+    # Luego aplicar unidecode solo como último recurso, si tras la tabla quedan caracteres no ASCII
     try:
-        s = unidecode(s).lower()
+        s = s.lower()
+        if not s.isascii():
+            s = unidecode(s).lower()
     except Exception:
         s = ''.join(c.lower() for c in name if c.isalnum() or c.isspace())
     
     # Eliminar prefijos comunes
-    s = re.sub(r'^(empresa:|consultor:|marca:|cliente:)\s*', '', s, flags=re.IGNORECASE)
+    s = _PREFIX_RE.sub('', s)
     
     # Reemplazar caracteres no alfanuméricos con espacios
-    s = re.sub(r'[^\w\s-]', ' ', s)
+    s = _NON_ALNUM_RE.sub(' ', s)
     
     # Reemplazar múltiples espacios con uno solo y convertir a guión bajo
-    s = re.sub(r'\s+', '_', s.strip())
+    s = _WS_RE.sub('_', s.strip())
     
     logger.warning(f"MARCA NO RECONOCIDA EN WEBHOOK: '{name}' normalizada como '{s}' (sin coincidencia en el mapeo)")
     
     # Eliminar caracteres no deseados (excepto _ y -)
-    s = re.sub(r'[^a-z0-9_-]', '', s)
+    s = _FINAL_STRIP_RE.sub('', s)
     
     # Eliminar guiones bajos del principio y final
     s = s.strip('_')
     
     return s if s else "empty_brand_name"
 
+# Palabras (subcadenas) que indican intención de agendar; una sola pasada de regex en C
+# en lugar de un `in` por palabra. IGNORECASE sustituye al .lower() previo.
+_SCHEDULING_INTENT_KEYWORDS = (
+    'agend', 'cita', 'reunion', 'reunión', 'calendario',
+    'visita', 'agendar', 'programar', 'reservar', 'consulta',
+    'entrevista', 'hora', 'horario', 'disponible', 'disponibilidad',
+)
+_SCHEDULING_INTENT_RE = re.compile(
+    "|".join(map(re.escape, sorted(_SCHEDULING_INTENT_KEYWORDS, key=len, reverse=True))),
+    re.IGNORECASE
+)
+
 def detect_scheduling_intent(user_input: str) -> bool:
     """
     Detecta si el usuario tiene la intención de agendar una cita.
@@ -117,9 +142,4 @@ def detect_scheduling_intent(user_input: str) -> bool:
     Returns:
         True si se detecta intención de agendamiento, False en caso contrario.
     """
-    user_input_lower = user_input.lower()
-    scheduling_keywords = ['agend', 'cita', 'reunion', 'reunión', 'calendario', 
-                         'visita', 'agendar', 'programar', 'reservar', 'consulta',
-                         'entrevista', 'hora', 'horario', 'disponible', 'disponibilidad']
-    
-    return any(keyword in user_input_lower for keyword in scheduling_keywords)
+    return _SCHEDULING_INTENT_RE.search(user_input) is not None
@@ -7,6 +7,7 @@ Interfaz Chainlit para el Chatbot Multimarca Beta - Versión Simplificada.
 import os
 import sys
 import chainlit as cl
+from contextlib import asynccontextmanager
 from typing import Dict, List, Optional
 
 # Deshabilitar BD de Chainlit para evitar errores de conexión
@@ -26,16 +27,27 @@ from app.main.state_manager import (
     reset_user_to_brand_selection
 )
 from app.api.llm_client import create_llm_client
-import logging
+# Logger de la aplicación: nivel según settings.LOG_LEVEL y escritura por cola/búfer
+from app.utils.logger import logger
 
-# Configurar logger para depuración
-logging.basicConfig(level=logging.DEBUG)
-logger = logging.getLogger("chainlit_app")
+# get_db_session es un generador asíncrono (dependencia de FastAPI); envolverlo una vez como
+# context manager da una sesión por evento sin recorrer el generador con async for
+_db_session = asynccontextmanager(get_db_session)
 
 # Variables globales para manejar sesión sin datos
 user_id_global = "web_user_chainlit"
 platform_global = "web"
 
+# Cliente HTTP del LLM; se crea en el primer mensaje y se reutiliza en los siguientes
+_LLM_CLIENT = None
+
+def _get_llm():
+    """Devuelve el cliente LLM compartido, creándolo la primera vez."""
+    global _LLM_CLIENT
+    if _LLM_CLIENT is None:
+        _LLM_CLIENT = create_llm_client()
+    return _LLM_CLIENT
+
 @cl.on_chat_start
 async def start():
     """Inicializa el chat y muestra mensaje de bienvenida"""
@@ -53,7 +65,7 @@ async def start():
     ]
     
     # Mensaje de bienvenida con selección de marca
-    async for db in get_db_session():
+    async with _db_session() as db:
         try:
             user_state = await get_or_create_user_state(db, user_id_global, platform_global)
             welcome_message = await get_company_selection_message(db, user_state)
@@ -65,7 +77,7 @@ async def start():
 @cl.on_message
 async def on_message(message: cl.Message):
     """Procesa mensajes del usuario"""
-    async for db in get_db_session():
+    async with _db_session() as db:
         try:
             # Indicador de procesamiento
             processing_msg = await cl.Message(content="✨ Procesando...").send()
@@ -81,19 +93,19 @@ async def on_message(message: cl.Message):
                 # Selección de empresa
                 try:
                     # Mostrar información de depuración
-                    print(f"Intentando procesar selección: '{message.content}'")
+                    logger.debug("Intentando procesar selección: '%s'", message.content)
                     
                     # Si es un número, intentar convertirlo
                     selection = message.content.strip()
                     if selection.isdigit():
-                        print(f"Detectada selección numérica: {selection}")
+                        logger.debug("Detectada selección numérica: %s", selection)
                     
                     # Obtener ID de empresa
                     company_id = await get_company_id_by_selection(db, selection)
-                    print(f"Resultado de get_company_id_by_selection: {company_id}")
+                    logger.debug("Resultado de get_company_id_by_selection: %s", company_id)
                     
                     if company_id:
-                        print(f"Actualizando estado con company_id={company_id}")
+                        logger.debug("Actualizando estado con company_id=%s", company_id)
                         # Actualizar estado
                         await update_user_state_db(db, user_state, {
                             "selected_company_id": company_id,
@@ -110,14 +122,14 @@ async def on_message(message: cl.Message):
                 try:
                     # Verificar que existe una empresa seleccionada
                     if not user_state.selected_company_id:
-                        print("Error: No hay empresa seleccionada")
+                        logger.debug("Error: No hay empresa seleccionada")
                         response = "Por favor, selecciona una empresa primero."
                         # Reiniciar a selección de empresa
                         await reset_user_to_brand_selection(db, user_state)
                     else:  
-                        # Crear cliente LLM
-                        llm_client = create_llm_client()
-                        print(f"Empresa seleccionada ID: {user_state.selected_company_id}")
+                        # Cliente LLM compartido entre mensajes (reutiliza el pool de conexiones)
+                        llm_client = _get_llm()
+                        logger.debug("Empresa seleccionada ID: %s", user_state.selected_company_id)
                         # Respuesta simple para prueba
                         response = f"Recibí tu mensaje sobre la empresa ID {user_state.selected_company_id}:\n\n{message.content}\n\nEsta es una respuesta de prueba. La integración RAG completa está pendiente."
                 except Exception as e:
@@ -145,7 +157,7 @@ async def on_reset(action):
     """Reinicia la conversación"""
     await cl.Message(content="Reiniciando conversación...").send()
     
-    async for db in get_db_session():
+    async with _db_session() as db:
         try:
             # Reiniciar estado
             user_state = await get_or_create_user_state(db, user_id_global, platform_global)
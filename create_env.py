@@ -3,6 +3,8 @@
 Script para crear el archivo .env con las variables reales de Azure
 """
 import os
+import tempfile
+from pathlib import Path
 
 def create_env_file():
     """Crea el archivo .env con las variables reales"""
@@ -37,9 +39,20 @@ LLM_MAX_TOKENS=1000
 LLM_HTTP_TIMEOUT=45.0
 """
     
-    # Escribir archivo .env con codificación UTF-8
-    with open('.env', 'w', encoding='utf-8') as f:
-        f.write(env_content)
+    new_content = env_content.encode('utf-8')
+    env_path = Path('.env')
+    
+    # Si el .env ya tiene exactamente este contenido no se reescribe
+    if env_path.exists() and env_path.read_bytes() == new_content:
+        print("✅ Archivo .env ya actualizado; no se modifica")
+        return
+    
+    # Escribir en un temporal del mismo directorio y sustituir de forma atómica:
+    # si el proceso muere a mitad de escritura el .env anterior queda intacto
+    with tempfile.NamedTemporaryFile('wb', delete=False, dir=env_path.resolve().parent) as f:
+        f.write(new_content)
+        tmp_path = f.name
+    os.replace(tmp_path, env_path)
     
     print("✅ Archivo .env creado correctamente con codificación UTF-8")
     print("🚀 Ahora puedes ejecutar la aplicación")
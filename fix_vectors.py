@@ -25,21 +25,15 @@ async def fix_vector_dimensions():
         
         print("✅ Base de datos conectada")
         
-        # Limpiar todos los vectores existentes
-        async with engine.connect() as conn:
+        # Limpiar todos los vectores existentes en una sola transacción (commit al salir del bloque)
+        async with engine.begin() as conn:
             print("🗑️ Eliminando vectores existentes...")
             
-            # Eliminar embeddings
-            await conn.execute(text("DELETE FROM langchain_pg_embedding"))
-            print("✅ Embeddings eliminados")
-            
-            # Eliminar colecciones
-            await conn.execute(text("DELETE FROM langchain_pg_collection"))
-            print("✅ Colecciones eliminadas")
-            
-            # Commit los cambios
-            await conn.commit()
-            print("✅ Cambios confirmados")
+            # TRUNCATE vacía ambas tablas sin recorrer ni registrar en WAL cada fila, y libera el disco
+            await conn.execute(text(
+                "TRUNCATE TABLE langchain_pg_embedding, langchain_pg_collection RESTART IDENTITY CASCADE"
+            ))
+            print("✅ Embeddings y colecciones eliminados")
         
         print("🎉 Base de datos vectorial limpiada correctamente")
         print("📝 Ahora puedes volver a cargar documentos con el modelo de embeddings correcto")
@@ -3,7 +3,9 @@
 Script temporal para obtener secretos de Azure Key Vault y crear archivo .env local
 """
 import os
-from app.core.azure_key_vault import key_vault_manager
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from app.core.azure_key_vault import AzureKeyVaultManager
 from app.core.config_enhancer import ConfigEnhancer
 
 def main():
@@ -28,11 +30,15 @@ def main():
         "CALENDLY_GENERAL_SCHEDULING_LINK": "calendly-general-scheduling-link"
     }
     
-    # Obtener secretos
+    # Obtener secretos en paralelo: cada uno es una llamada HTTPS independiente al Key Vault,
+    # así que el tiempo total pasa a ser el de la más lenta en lugar de la suma
+    print(f"📥 Obteniendo {len(secret_mappings)} secretos en paralelo...")
+    manager = AzureKeyVaultManager(vault_url=key_vault_url)
+    with ThreadPoolExecutor(max_workers=len(secret_mappings)) as executor:
+        secret_values = list(executor.map(manager.get_secret, secret_mappings.values()))
+    
     secrets = {}
-    for env_var, secret_name in secret_mappings.items():
-        print(f"📥 Obteniendo {env_var} desde secreto '{secret_name}'...")
-        secret_value = key_vault_manager.get_secret(secret_name)
+    for env_var, secret_value in zip(secret_mappings, secret_values):
         if secret_value:
             secrets[env_var] = secret_value
             print(f"✅ {env_var} obtenido correctamente")
@@ -42,24 +48,27 @@ def main():
     # Crear archivo .env
     if secrets:
         print("\n📝 Creando archivo .env...")
-        with open(".env", "w", encoding="utf-8") as f:
-            f.write("# Variables de entorno obtenidas desde Azure Key Vault\n")
-            f.write(f"# Key Vault URL: {key_vault_url}\n\n")
-            
-            for env_var, value in secrets.items():
-                f.write(f"{env_var}={value}\n")
-            
+        content = "\n".join([
+            "# Variables de entorno obtenidas desde Azure Key Vault",
+            f"# Key Vault URL: {key_vault_url}",
+            "",
+            *[f"{env_var}={value}" for env_var, value in secrets.items()],
+            "",
             # Agregar variables por defecto para desarrollo
-            f.write("\n# Variables por defecto para desarrollo local\n")
-            f.write("ENVIRONMENT=development\n")
-            f.write("LOG_LEVEL=INFO\n")
-            f.write("DEBUG=True\n")
-            f.write("SERVER_PORT=8000\n")
-            f.write("REDIS_URL=redis://localhost:6379/0\n")
-            f.write("OPENROUTER_MODEL_CHAT=meta-llama/llama-3-8b-instruct\n")
-            f.write("LLM_TEMPERATURE=0.5\n")
-            f.write("LLM_MAX_TOKENS=1000\n")
-            f.write("LLM_HTTP_TIMEOUT=45.0\n")
+            "# Variables por defecto para desarrollo local",
+            "ENVIRONMENT=development",
+            "LOG_LEVEL=INFO",
+            "DEBUG=True",
+            "SERVER_PORT=8000",
+            "REDIS_URL=redis://localhost:6379/0",
+            "OPENROUTER_MODEL_CHAT=meta-llama/llama-3-8b-instruct",
+            "LLM_TEMPERATURE=0.5",
+            "LLM_MAX_TOKENS=1000",
+            "LLM_HTTP_TIMEOUT=45.0",
+            "",
+        ])
+        # Una sola escritura del contenido completo
+        Path(".env").write_text(content, encoding="utf-8")
         
         print(f"✅ Archivo .env creado con {len(secrets)} variables")
         print("🚀 Ahora puedes ejecutar la aplicación localmente")
@@ -1,19 +1,47 @@
 import os
-import multiprocessing
 
 # Configuración de Gunicorn
 
 # --- Optimización de Rendimiento y Memoria ---
-# Carga la aplicación antes de crear los workers.
-# Esencial para aplicaciones con modelos de ML pesados para evitar
-# cargar el modelo en memoria por cada worker.
+# Carga el código de la aplicación antes de crear los workers.
+# El modelo de embeddings NO se carga en el master: cada worker lo carga en su
+# lifespan (load_rag_components), así el consumo es predecible (workers × modelo)
+# y no depende de páginas copy-on-write que el refcount de CPython rompe enseguida.
 preload_app = True
 
+
+def on_starting(server):
+    """
+    Descarga el modelo de embeddings a la caché de disco de Hugging Face una sola vez,
+    en el master, para que los workers no lo descarguen a la vez al arrancar.
+    Solo toca el disco: no carga el modelo en memoria.
+    """
+    try:
+        from huggingface_hub import snapshot_download
+        from app.core.config import settings
+
+        snapshot_download(settings.EMBEDDING_MODEL_NAME)
+    except Exception as e:
+        server.log.warning(f"No se pudo precargar el modelo de embeddings en caché: {e}")
+
 # --- Configuración de Workers y Threads ---
 # Puedes controlar esto desde las variables de entorno o fijarlo aquí.
+# Por defecto 2: cada worker carga su propia copia del modelo de embeddings (~420 MB)
+# y abre su propio pool de BD, así que este valor MULTIPLICA las conexiones a Postgres
+# (WORKERS × (DATABASE_POOL_SIZE + DATABASE_MAX_OVERFLOW) debe quedar bajo max_connections).
+# Súbelo solo tras comprobar memoria disponible y el límite del servidor.
 workers = int(os.getenv("WORKERS", "2"))
 threads = int(os.getenv("THREADS", "4"))  # Buena práctica para workers uvicorn
 
+# Reciclar cada worker tras N peticiones (con jitter para que no reinicien a la vez)
+# y contener el crecimiento de RSS por fragmentación de los allocators de torch/langchain
+max_requests = int(os.getenv("MAX_REQUESTS", "1000"))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", "100"))
+
+# Archivo de heartbeat de los workers en memoria (tmpfs) en lugar de disco
+if os.path.isdir("/dev/shm"):
+    worker_tmp_dir = "/dev/shm"
+
 # --- Binding ---
 # El bind se manejará desde el startup.sh para mayor flexibilidad.
 bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
@@ -6,13 +6,9 @@ import sys
 import logging
 from pathlib import Path
 
-# Configuración básica de logging para errores iniciales
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler()]
-)
-logger = logging.getLogger("chatbot_app_loader")
+# Logger hijo del de la aplicación: usa sus handlers una vez importado el paquete 'app'.
+# El logging básico solo se configura si la carga falla (ver except)
+logger = logging.getLogger("ChatbotApp.loader")
 
 # Asegurarse de que el directorio raíz esté en el path
 PROJECT_ROOT = Path(__file__).resolve().parent
@@ -21,29 +17,33 @@ if str(PROJECT_ROOT) not in sys.path:
 
 # Importar la instancia app desde el paquete app
 try:
-    # Importar settings primero para asegurar que la configuración esté cargada
-    from app.core.config import settings
-    
-    # Luego importar la aplicación
+    # app/__init__.py carga la configuración antes de construir la aplicación
     from app import app
     
     if app is None:
         logger.critical("La instancia 'app' importada desde el paquete 'app' es None")
         sys.exit(1)
         
+    # Health check raíz para el monitoreo de Azure; se registra una sola vez
+    if not any(getattr(route, "path", None) == "/health" for route in app.router.routes):
+        @app.get("/health", tags=["Monitoring"])
+        def perform_health_check():
+            """Verifica que el servicio esté activo y responde con 200 OK."""
+            return {"status": "ok"}
+    
     logger.info(f"Aplicación FastAPI cargada correctamente desde el paquete 'app'")
     
     # Información de diagnóstico
-    logger.info(f"Directorio de trabajo: {os.getcwd()}")
-    logger.info(f"Archivos en el directorio actual: {os.listdir()}")
-    logger.info(f"Python path: {sys.path}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Directorio de trabajo: %s | Python path: %s", os.getcwd(), sys.path)
     
-except ImportError as e:
-    logger.critical(f"Error crítico al importar la aplicación: {e}", exc_info=True)
-    sys.exit(1)
-
 except Exception as e:
-    logger.critical(f"Error inesperado al iniciar la aplicación: {e}", exc_info=True)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler()]
+    )
+    logger.critical(f"Error crítico al cargar la aplicación: {e}", exc_info=True)
     sys.exit(1)
 
 # Punto de entrada para ejecución directa (usando uvicorn)
@@ -7,11 +7,24 @@ import time
 import logging
 import asyncio
 import asyncpg
+import functools
+import hashlib
+import json
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from dotenv import load_dotenv
 from typing import List, Dict, Any, Optional
 from datetime import datetime
 
+# Event loop de uvloop para las llamadas asyncio.run (asyncpg) si está instalado
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 # Cargar variables de entorno al inicio
 load_dotenv()
 
@@ -50,10 +63,14 @@ logger.addHandler(file_handler)
 # Importaciones de LangChain - importar después de configurar path
 try:
     from langchain.schema import Document
-    from langchain_community.document_loaders import DirectoryLoader, TextLoader
     from langchain_community.embeddings.huggingface import HuggingFaceEmbeddings
     from langchain.text_splitter import RecursiveCharacterTextSplitter
     from langchain_postgres import PGVector
+    from pgvector.asyncpg import register_vector
+    from pgvector.psycopg import register_vector as register_vector_psycopg
+    import psycopg
+    from psycopg.types.json import Jsonb
+    from psycopg_pool import ConnectionPool
     from app.utils.text_processing import normalize_brand_name
     LANGCHAIN_IMPORTS_OK = True
 except ImportError as e:
@@ -61,7 +78,68 @@ except ImportError as e:
     LANGCHAIN_IMPORTS_OK = False
 
 
-def process_brand_documents(brands_dir: Path, chunk_size: int, chunk_overlap: int, min_chunk_size: int, max_chunk_size: int) -> List[Document]:
+@functools.lru_cache(maxsize=8)
+def _get_splitter(chunk_size: int, chunk_overlap: int) -> "RecursiveCharacterTextSplitter":
+    """Splitter compartido por todos los archivos con la misma configuración de troceado."""
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=len,
+        is_separator_regex=False,
+        add_start_index=True,
+        strip_whitespace=True,
+        separators=["\n\n", "\n", ".", "!", "?", ";", ":", " ", ""]
+    )
+
+
+@functools.lru_cache(maxsize=8)
+def _get_semchunk_chunker(chunk_size: int):
+    """Chunker de semchunk (troceado recursivo acelerado) que mide en caracteres, como el splitter."""
+    import semchunk
+    return semchunk.chunkerify(len, chunk_size=chunk_size)
+
+
+def split_into_chunks(documents: List[Document], chunk_size: int, chunk_overlap: int) -> List[Document]:
+    """
+    Trocea los documentos con el chunker configurado en CHUNKER.
+    
+    "langchain" (por defecto) usa RecursiveCharacterTextSplitter; "semchunk" usa la
+    librería semchunk, bastante más rápida en documentos largos (requiere instalarla);
+    "fixed" corta ventanas de chunk_size caracteres con chunk_overlap de solapamiento,
+    sin buscar separadores (para archivos uniformes donde el corte exacto no importa).
+    Todas las rutas añaden start_index a los metadatos para poder comparar resultados.
+    """
+    chunker_name = os.getenv("CHUNKER", "langchain").lower()
+    split_docs: List[Document] = []
+    
+    if chunker_name == "fixed":
+        step = max(1, chunk_size - chunk_overlap)
+        for document in documents:
+            text = document.page_content
+            split_docs.extend(
+                Document(page_content=text[start:start + chunk_size], metadata={**document.metadata, "start_index": start})
+                for start in range(0, len(text), step)
+            )
+        return split_docs
+    
+    if chunker_name != "semchunk":
+        return _get_splitter(chunk_size, chunk_overlap).split_documents(documents)
+    
+    chunker = _get_semchunk_chunker(chunk_size)
+    for document in documents:
+        chunks, offsets = chunker(document.page_content, offsets=True, overlap=chunk_overlap)
+        for chunk, (start, _end) in zip(chunks, offsets):
+            split_docs.append(Document(page_content=chunk, metadata={**document.metadata, "start_index": start}))
+    return split_docs
+
+
+def _read_text(path: Path) -> str:
+    """Lee un archivo de texto completo en una sola llamada y lo decodifica como UTF-8."""
+    return path.read_bytes().decode("utf-8", "replace")
+
+
+def process_brand_documents(brands_dir: Path, chunk_size: int, chunk_overlap: int, min_chunk_size: int, max_chunk_size: int,
+                            processed_at: Optional[str] = None) -> List[Document]:
     """
     Carga y procesa documentos de marcas desde el directorio especificado.
     
@@ -71,6 +149,7 @@ def process_brand_documents(brands_dir: Path, chunk_size: int, chunk_overlap: in
         chunk_overlap: Superposición entre fragmentos
         min_chunk_size: Tamaño mínimo de fragmento
         max_chunk_size: Tamaño máximo de fragmento
+        processed_at: Marca de tiempo ISO de la ejecución (por defecto, la hora actual)
         
     Returns:
         Lista de documentos procesados con metadatos de marca
@@ -82,13 +161,11 @@ def process_brand_documents(brands_dir: Path, chunk_size: int, chunk_overlap: in
     try:
         # Cargar documentos desde el directorio
         logger.info(f"Cargando documentos de marcas desde {brands_dir}")
-        loader = DirectoryLoader(
-            str(brands_dir),
-            glob="**/*.txt",
-            loader_cls=TextLoader,
-            loader_kwargs={"encoding": "utf-8"}
-        )
-        documents = loader.load()
+        # Lectura directa: un read() y un decode por archivo, sin la maquinaria de loaders
+        documents = [
+            Document(page_content=_read_text(path), metadata={"source": path.name})
+            for path in sorted(brands_dir.rglob("*.txt"))
+        ]
         logger.info(f"Cargados {len(documents)} documentos de marcas")
         
         if not documents:
@@ -96,6 +173,7 @@ def process_brand_documents(brands_dir: Path, chunk_size: int, chunk_overlap: in
             return []
         
         # Añadir metadatos de marca a los documentos
+        processed_at = processed_at or datetime.now().isoformat()
         for doc in documents:
             file_path = doc.metadata.get("source", "")
             if not file_path:
@@ -110,18 +188,10 @@ def process_brand_documents(brands_dir: Path, chunk_size: int, chunk_overlap: in
             # Añadir metadatos
             doc.metadata["brand"] = normalized_brand
             doc.metadata["file_name"] = file_name
-            doc.metadata["processed_at"] = datetime.now().isoformat()
+            doc.metadata["processed_at"] = processed_at
             
         # Dividir documentos en fragmentos más pequeños
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            length_function=len,
-            is_separator_regex=False,
-            min_chunk_size=min_chunk_size,
-            max_chunk_size=max_chunk_size
-        )
-        split_documents = splitter.split_documents(documents)
+        split_documents = split_into_chunks(documents, chunk_size, chunk_overlap)
         logger.info(f"Documentos divididos en {len(split_documents)} fragmentos")
         
         return split_documents
@@ -131,55 +201,134 @@ def process_brand_documents(brands_dir: Path, chunk_size: int, chunk_overlap: in
         return []
 
 
-def delete_documents_by_source(connection_string: str, collection_name: str, source_file: str) -> bool:
+async def delete_many_sources(connection_string: str, sources: List[str]) -> bool:
     """
-    Borra documentos específicos de la base de datos basándose en el archivo fuente.
+    Borra de la base de datos los documentos de todos los archivos fuente indicados.
+    
+    Usa una sola conexión y una sola transacción con DELETE ... = ANY($1) en lugar
+    de una conexión (TCP + TLS + autenticación) y un DELETE por archivo.
     
     Args:
         connection_string: String de conexión a PostgreSQL
-        collection_name: Nombre de la colección en PGVector  
-        source_file: Nombre del archivo fuente a borrar
+        sources: Nombres de los archivos fuente a borrar
         
     Returns:
         True si el borrado fue exitoso, False en caso contrario
     """
     try:
-        async def _delete_by_source():
-            conn = await asyncpg.connect(connection_string)
-            try:
-                # Borrar documentos que coincidan con el archivo fuente
+        conn = await asyncpg.connect(connection_string)
+        try:
+            async with conn.transaction():
+                # Borrar documentos que coincidan con cualquiera de los archivos fuente
                 deleted_count = await conn.execute(
-                    "DELETE FROM langchain_pg_embedding WHERE cmetadata->>'source' = $1",
-                    source_file
+                    "DELETE FROM langchain_pg_embedding WHERE cmetadata->>'source' = ANY($1::text[])",
+                    sources
                 )
+                logger.info(f"Borrados {deleted_count.split()[-1]} documentos vectoriales de {len(sources)} fuentes")
                 
-                # También borrar de la tabla documents si existe
+                # También borrar de la tabla documents si existe; el savepoint evita que
+                # su fallo aborte la transacción principal
                 try:
-                    deleted_docs = await conn.execute(
-                        "DELETE FROM documents WHERE source = $1",
-                        source_file
-                    )
-                    logger.info(f"Borrados {deleted_docs.split()[-1]} documentos de la tabla 'documents' para fuente: {source_file}")
+                    async with conn.transaction():
+                        deleted_docs = await conn.execute(
+                            "DELETE FROM documents WHERE source = ANY($1::text[])",
+                            sources
+                        )
+                    logger.info(f"Borrados {deleted_docs.split()[-1]} documentos de la tabla 'documents'")
                 except Exception as e:
                     logger.debug(f"No se pudo borrar de tabla 'documents' (posiblemente no existe): {e}")
-                
-                logger.info(f"Borrados documentos vectoriales para fuente: {source_file}")
-                return True
-                
-            finally:
-                await conn.close()
-        
-        # Ejecutar operación asíncrona
-        asyncio.run(_delete_by_source())
-        return True
+            return True
+        finally:
+            await conn.close()
         
     except Exception as e:
-        logger.error(f"Error borrando documentos por fuente '{source_file}': {e}", exc_info=True)
+        logger.error(f"Error borrando documentos de {len(sources)} fuentes: {e}", exc_info=True)
         return False
 
 
+async def sources_with_rows(connection_string: str, collection_name: str, sources: List[str]) -> set:
+    """Devuelve cuáles de los archivos fuente indicados tienen fragmentos en la colección."""
+    conn = await asyncpg.connect(connection_string)
+    try:
+        rows = await conn.fetch(
+            "SELECT DISTINCT e.cmetadata->>'source' AS source "
+            "FROM langchain_pg_embedding e JOIN langchain_pg_collection c ON c.uuid = e.collection_id "
+            "WHERE c.name = $1 AND e.cmetadata->>'source' = ANY($2::text[])",
+            collection_name, sources
+        )
+        return {row["source"] for row in rows}
+    finally:
+        await conn.close()
+
+
+def delete_documents_by_source(connection_string: str, collection_name: str, source_file: str) -> bool:
+    """
+    Borra documentos específicos de la base de datos basándose en el archivo fuente.
+    
+    Args:
+        connection_string: String de conexión a PostgreSQL
+        collection_name: Nombre de la colección en PGVector  
+        source_file: Nombre del archivo fuente a borrar
+        
+    Returns:
+        True si el borrado fue exitoso, False en caso contrario
+    """
+    return asyncio.run(delete_many_sources(connection_string, [source_file]))
+
+
+def chunk_fingerprint(content: str, metadata: Dict[str, Any]) -> str:
+    """Huella SHA-256 de un fragmento: su texto y sus metadatos salvo processed_at (cambia en cada ejecución)."""
+    stable_metadata = {key: value for key, value in metadata.items() if key != "processed_at"}
+    payload = content + "\0" + json.dumps(stable_metadata, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def create_connection_pool(connection_string: str, max_size: int) -> "ConnectionPool":
+    """
+    Crea un pool psycopg compartido por todos los archivos de una ejecución.
+    
+    Evita abrir una conexión (TCP + TLS + autenticación) por archivo y por operación. El
+    pool es seguro entre hilos; las conexiones van en autocommit y con el tipo vector registrado.
+    """
+    return ConnectionPool(
+        connection_string,
+        min_size=1,
+        max_size=max(1, max_size),
+        kwargs={"autocommit": True},
+        configure=register_vector_psycopg,
+        open=False  # se abre y se cierra con "with create_connection_pool(...) as pool"
+    )
+
+
+def fetch_source_fingerprints(conn: "psycopg.Connection", collection_name: str,
+                              source_file: str) -> Dict[str, List[str]]:
+    """
+    Devuelve las huellas de los fragmentos ya guardados de un archivo fuente.
+    
+    Returns:
+        Diccionario huella -> IDs de las filas con esa huella
+    """
+    rows = conn.execute(
+        "SELECT e.id, e.document, e.cmetadata FROM langchain_pg_embedding e "
+        "JOIN langchain_pg_collection c ON c.uuid = e.collection_id "
+        "WHERE c.name = %s AND e.cmetadata->>'source' = %s",
+        (collection_name, source_file)
+    ).fetchall()
+    
+    fingerprints: Dict[str, List[str]] = {}
+    for doc_id, document, metadata in rows:
+        fingerprints.setdefault(chunk_fingerprint(document, metadata), []).append(doc_id)
+    return fingerprints
+
+
+def delete_embeddings_by_id(conn: "psycopg.Connection", ids: List[str]) -> int:
+    """Borra las filas de langchain_pg_embedding con los IDs indicados y devuelve cuántas se borraron."""
+    return conn.execute("DELETE FROM langchain_pg_embedding WHERE id = ANY(%s)", (ids,)).rowcount
+
+
 def process_single_brand_file(file_path: Path, chunk_size: int, chunk_overlap: int, 
-                             min_chunk_size: int, max_chunk_size: int) -> List[Document]:
+                             min_chunk_size: int, max_chunk_size: int,
+                             processed_at: Optional[str] = None) -> List[Document]:
     """
     Procesa un archivo individual de marca y retorna sus documentos.
     
@@ -189,6 +338,7 @@ def process_single_brand_file(file_path: Path, chunk_size: int, chunk_overlap: i
         chunk_overlap: Superposición entre fragmentos
         min_chunk_size: Tamaño mínimo de fragmento
         max_chunk_size: Tamaño máximo de fragmento
+        processed_at: Marca de tiempo ISO de la ejecución (por defecto, la hora actual)
         
     Returns:
         Lista de documentos procesados con metadatos
@@ -217,28 +367,12 @@ def process_single_brand_file(file_path: Path, chunk_size: int, chunk_overlap: i
                 "source": file_path.name,
                 "brand": brand_name,
                 "file_type": "txt",
-                "processed_at": datetime.now().isoformat()
+                "processed_at": processed_at or datetime.now().isoformat()
             }
         )
         
-        # Dividir en fragmentos usando RecursiveCharacterTextSplitter
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            length_function=len,
-            is_separator_regex=False,
-            add_start_index=True,
-            strip_whitespace=True,
-            separators=["\n\n", "\n", ".", "!", "?", ";", ":", " ", ""]
-        )
-        
-        # Configurar límites de tamaño si están disponibles
-        if hasattr(splitter, '_min_chunk_size'):
-            splitter._min_chunk_size = min_chunk_size
-        if hasattr(splitter, '_max_chunk_size'):  
-            splitter._max_chunk_size = max_chunk_size
-        
-        split_documents = splitter.split_documents([document])
+        # Dividir en fragmentos con el chunker configurado (CHUNKER)
+        split_documents = split_into_chunks([document], chunk_size, chunk_overlap)
         
         # Filtrar fragmentos por tamaño si el splitter no lo hace automáticamente
         filtered_docs = []
@@ -262,8 +396,158 @@ def process_single_brand_file(file_path: Path, chunk_size: int, chunk_overlap: i
         return []
 
 
+# Modelos de embeddings ya cargados, por nombre: se instancian una sola vez por proceso
+_EMBEDDING_FUNCTIONS: Dict[str, "HuggingFaceEmbeddings"] = {}
+# Evita que varios hilos (ingest_single_file --all) carguen el mismo modelo a la vez
+_EMBEDDING_FUNCTIONS_LOCK = threading.Lock()
+
+
+def get_embedding_function(model_name: str) -> "HuggingFaceEmbeddings":
+    """
+    Devuelve el modelo de embeddings para model_name, cargándolo solo la primera vez.
+    
+    Los textos se codifican en lotes de EMBED_BATCH (64 por defecto) para amortizar el
+    coste del tokenizador y aprovechar las multiplicaciones de matrices por lote.
+    
+    Con EMBEDDING_BACKEND=onnx se usa el backend ONNX Runtime de sentence-transformers con
+    el modelo cuantizado a int8 (EMBEDDING_ONNX_FILE), 2-4x más rápido en CPU con
+    instrucciones VNNI. Requiere instalar optimum[onnxruntime].
+    """
+    embedding_function = _EMBEDDING_FUNCTIONS.get(model_name)
+    if embedding_function is not None:
+        return embedding_function
+    with _EMBEDDING_FUNCTIONS_LOCK:
+        embedding_function = _EMBEDDING_FUNCTIONS.get(model_name)
+        if embedding_function is not None:
+            return embedding_function
+        model_kwargs: Dict[str, Any] = {"device": "cpu"}
+        backend = os.getenv("EMBEDDING_BACKEND", "torch").lower()
+        if backend == "onnx":
+            model_kwargs["backend"] = "onnx"
+            model_kwargs["model_kwargs"] = {
+                "file_name": os.getenv("EMBEDDING_ONNX_FILE", "onnx/model_qint8_avx512_vnni.onnx"),
+                "provider": "CPUExecutionProvider"
+            }
+        logger.info(f"Inicializando modelo de embeddings: {model_name} (backend: {backend})")
+        embedding_function = HuggingFaceEmbeddings(
+            model_name=model_name,
+            cache_folder=os.path.join(os.getcwd(), "models_cache"),
+            model_kwargs=model_kwargs,
+            encode_kwargs={
+                "batch_size": int(os.getenv("EMBED_BATCH", "64")),
+                "normalize_embeddings": True
+            }
+        )
+        _EMBEDDING_FUNCTIONS[model_name] = embedding_function
+    return embedding_function
+
+
+# Índice HNSW de similitud coseno sobre los embeddings (mismo nombre que en la migración 5b1e9d0c7a3f)
+_VECTOR_INDEX_NAME = "ix_langchain_pg_embedding_hnsw_cosine"
+
+
+async def execute_statement(connection_string: str, statement: str) -> None:
+    """Ejecuta una sentencia fuera de transacción (requisito de CREATE INDEX CONCURRENTLY)."""
+    conn = await asyncpg.connect(connection_string)
+    try:
+        await conn.execute(statement)
+    finally:
+        await conn.close()
+
+
+def embed_unique_texts(embedding_function: "HuggingFaceEmbeddings", texts: List[str]) -> List[List[float]]:
+    """
+    Vectoriza solo los textos distintos y reparte cada vector a todas sus repeticiones.
+    
+    Los archivos de marca repiten bloques (direcciones, avisos legales): los fragmentos
+    idénticos se agrupan por hash SHA-256 y se codifican una sola vez.
+    """
+    unique_index: Dict[bytes, int] = {}
+    unique_texts: List[str] = []
+    mapping: List[int] = []
+    for text in texts:
+        digest = hashlib.sha256(text.encode("utf-8")).digest()
+        position = unique_index.get(digest)
+        if position is None:
+            position = unique_index[digest] = len(unique_texts)
+            unique_texts.append(text)
+        mapping.append(position)
+    
+    if len(unique_texts) < len(texts):
+        logger.info(f"Fragmentos duplicados omitidos en la vectorización: {len(texts) - len(unique_texts)}")
+    unique_embeddings = embedding_function.embed_documents(unique_texts)
+    return [unique_embeddings[position] for position in mapping]
+
+
+async def bulk_insert_embeddings(documents: List[Document], embeddings: List[List[float]],
+                                 connection_string: str, collection_name: str) -> Optional[int]:
+    """
+    Inserta los fragmentos ya vectorizados en langchain_pg_embedding con COPY.
+    
+    COPY transmite las filas en binario en un solo flujo, sin el análisis de parámetros
+    por fila de los INSERT que genera PGVector.
+    
+    Args:
+        documents: Fragmentos a insertar
+        embeddings: Vector de cada fragmento, en el mismo orden
+        connection_string: String de conexión a PostgreSQL
+        collection_name: Nombre de la colección en PGVector
+        
+    Returns:
+        Número de filas insertadas, o None si la colección aún no existe
+    """
+    conn = await asyncpg.connect(connection_string)
+    try:
+        await register_vector(conn)
+        collection_id = await conn.fetchval(
+            "SELECT uuid FROM langchain_pg_collection WHERE name = $1", collection_name
+        )
+        if collection_id is None:
+            return None
+        
+        records = [
+            (str(uuid.uuid4()), collection_id, embedding, doc.page_content, json.dumps(doc.metadata))
+            for doc, embedding in zip(documents, embeddings)
+        ]
+        await conn.copy_records_to_table(
+            "langchain_pg_embedding",
+            records=records,
+            columns=["id", "collection_id", "embedding", "document", "cmetadata"]
+        )
+        return len(records)
+    finally:
+        await conn.close()
+
+
+def copy_embeddings(conn: "psycopg.Connection", documents: List[Document], embeddings: List[List[float]],
+                    collection_name: str) -> Optional[int]:
+    """
+    Equivalente a bulk_insert_embeddings sobre una conexión psycopg del pool.
+    
+    Returns:
+        Número de filas insertadas, o None si la colección aún no existe
+    """
+    row = conn.execute(
+        "SELECT uuid FROM langchain_pg_collection WHERE name = %s", (collection_name,)
+    ).fetchone()
+    if row is None:
+        return None
+    collection_id = row[0]
+    
+    with conn.transaction(), conn.cursor() as cur:
+        with cur.copy(
+            "COPY langchain_pg_embedding (id, collection_id, embedding, document, cmetadata) "
+            "FROM STDIN WITH (FORMAT BINARY)"
+        ) as copy:
+            copy.set_types(["varchar", "uuid", "vector", "varchar", "jsonb"])
+            for doc, embedding in zip(documents, embeddings):
+                copy.write_row((str(uuid.uuid4()), collection_id, embedding, doc.page_content, Jsonb(doc.metadata)))
+    return len(documents)
+
+
 def ingest_to_pgvector(documents: List[Document], connection_string: str, 
-                      collection_name: str, recreate: bool = False) -> bool:
+                      collection_name: str, recreate: bool = False,
+                      pool: Optional["ConnectionPool"] = None) -> bool:
     """
     Ingesta documentos de marcas en PostgreSQL con pgvector.
     
@@ -272,29 +556,53 @@ def ingest_to_pgvector(documents: List[Document], connection_string: str,
         connection_string: String de conexión a PostgreSQL
         collection_name: Nombre de la colección en PGVector
         recreate: Si es True, elimina y recrea la colección
+        pool: Pool psycopg (create_connection_pool) para la carga con COPY; sin él se abre
+            una conexión asyncpg propia
         
     Returns:
         True si la ingesta fue exitosa, False en caso contrario
+    
+    Con RECREATE_INDEX=true el índice HNSW se elimina antes de la carga y se reconstruye
+    CONCURRENTLY al final: construirlo una vez con todos los vectores es mucho más rápido
+    (y da un grafo mejor) que mantenerlo fila a fila durante la inserción.
     """
     if not documents:
         logger.warning("No hay documentos para ingestar")
         return False
     
+    recreate_index = os.getenv("RECREATE_INDEX", "false").lower() == "true"
+    index_dropped = False
+    
     try:
         # Inicializar modelo de embeddings usando variable de entorno
-        embedding_model_name = os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/all-MiniLM-L6-v2")
-        logger.info(f"Inicializando modelo de embeddings: {embedding_model_name}")
-        embedding_function = HuggingFaceEmbeddings(
-            model_name=embedding_model_name,
-            cache_folder=os.path.join(os.getcwd(), "models_cache"),
-            model_kwargs={"device": "cpu"},
-            encode_kwargs={"normalize_embeddings": True}
-        )
+        # Mismo modelo por defecto que settings.EMBEDDING_MODEL_NAME: la columna está fijada a vector(768)
+        embedding_model_name = os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/all-mpnet-base-v2")
+        embedding_function = get_embedding_function(embedding_model_name)
+        
+        if not recreate:
+            # Carga masiva: vectorizar todo en lotes y enviar las filas con COPY
+            embeddings = embed_unique_texts(embedding_function, [doc.page_content for doc in documents])
+            if recreate_index:
+                asyncio.run(execute_statement(connection_string, f"DROP INDEX IF EXISTS {_VECTOR_INDEX_NAME}"))
+                index_dropped = True
+            if pool is not None:
+                with pool.connection() as conn:
+                    inserted = copy_embeddings(conn, documents, embeddings, collection_name)
+            else:
+                inserted = asyncio.run(bulk_insert_embeddings(documents, embeddings, connection_string, collection_name))
+            if inserted is not None:
+                logger.info(f"Ingesta de {inserted} documentos completada mediante COPY")
+                logger.info("¡Ingesta completada exitosamente!")
+                return True
+            logger.info(f"La colección {collection_name} no existe; se creará con PGVector.from_documents")
         
         # Configurar PGVector
         logger.info(f"Conectando a PostgreSQL, colección: {collection_name}")
         # PGVector.from_documents ya realiza la ingesta de los documentos proporcionados
         # No es necesario llamar a add_documents después
+        if recreate_index and not index_dropped:
+            asyncio.run(execute_statement(connection_string, f"DROP INDEX IF EXISTS {_VECTOR_INDEX_NAME}"))
+            index_dropped = True
         vectorstore = PGVector.from_documents(
             documents=documents,
             embedding=embedding_function,
@@ -310,6 +618,50 @@ def ingest_to_pgvector(documents: List[Document], connection_string: str,
     except Exception as e:
         logger.error(f"Error durante la ingesta a pgvector: {e}", exc_info=True)
         return False
+    finally:
+        # Reconstruir el índice aunque la carga haya fallado, sin bloquear las escrituras
+        if index_dropped:
+            try:
+                logger.info(f"Reconstruyendo índice {_VECTOR_INDEX_NAME}...")
+                asyncio.run(execute_statement(
+                    connection_string,
+                    f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {_VECTOR_INDEX_NAME} ON langchain_pg_embedding "
+                    "USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64)"
+                ))
+            except Exception as e:
+                logger.error(f"Error reconstruyendo el índice {_VECTOR_INDEX_NAME}: {e}", exc_info=True)
+
+
+# Firma (mtime_ns, tamaño) de cada archivo ya ingestado, para omitirlo si no cambió.
+# Agrupada por destino (base de datos + colección): ingestar en otro destino no omite nada.
+INGESTION_STATE_FILE = log_dir / "ingestion_state.json"
+
+
+def _ingestion_scope(connection_string: str, collection_name: str) -> str:
+    """Clave del destino de la ingesta; hash para no guardar la URL (con contraseña) en disco."""
+    return hashlib.sha256(f"{connection_string}|{collection_name}".encode("utf-8")).hexdigest()[:16]
+
+
+def _file_signature(file_path: Path) -> List[int]:
+    """Devuelve [mtime_ns, tamaño] del archivo: un stat, sin leer el contenido."""
+    st = file_path.stat()
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _load_ingestion_state() -> Dict[str, Dict[str, List[int]]]:
+    try:
+        state = json.loads(INGESTION_STATE_FILE.read_text(encoding="utf-8") or "{}")
+    except (OSError, ValueError):
+        return {}
+    # Descartar entradas del formato anterior (archivo -> firma, sin destino)
+    return {scope: files for scope, files in state.items() if isinstance(files, dict)}
+
+
+def _save_ingestion_state(state: Dict[str, Dict[str, List[int]]]) -> None:
+    try:
+        INGESTION_STATE_FILE.write_text(json.dumps(state, indent=2), encoding="utf-8")
+    except OSError as e:
+        logger.warning(f"No se pudo guardar el estado de ingesta en {INGESTION_STATE_FILE}: {e}")
 
 
 def main():
@@ -363,11 +715,13 @@ def main():
     logger.info(f"Archivos encontrados: {len(txt_files)}")
     
     start_time = time.time()
+    # Una sola marca de tiempo para todos los fragmentos de esta ejecución
+    run_timestamp = datetime.now().isoformat()
     
     if recreate_entire_collection:
         # Modo tradicional: procesar todos los archivos de una vez
         logger.info("=== Modo: Recreación completa de colección ===")
-        documents = process_brand_documents(brands_dir, chunk_size, chunk_overlap, min_chunk_size, max_chunk_size)
+        documents = process_brand_documents(brands_dir, chunk_size, chunk_overlap, min_chunk_size, max_chunk_size, run_timestamp)
         
         if not documents:
             logger.warning("No se encontraron documentos para procesar. Finalizando.")
@@ -383,44 +737,74 @@ def main():
         successful_files = 0
         failed_files = 0
         total_processed_documents = 0
+        # Fragmentos de todos los archivos: se vectorizan e insertan en un único lote
+        all_documents: List[Document] = []
+        prepared_files: List[Path] = []
         
-        for txt_file in txt_files:
-            logger.info(f"\n--- Procesando archivo: {txt_file.name} ---")
-            
+        # Paso 0: Omitir los archivos sin cambios desde la última ingesta en este mismo destino
+        # (mtime y tamaño) cuyos fragmentos siguen en la colección; --force reprocesa todos
+        ingestion_state = {} if "--force" in sys.argv[1:] else _load_ingestion_state()
+        scope_state = ingestion_state.setdefault(_ingestion_scope(db_url, collection_name), {})
+        unchanged_files = [f for f in txt_files if scope_state.get(f.name) == _file_signature(f)]
+        if unchanged_files:
+            # Las tablas pueden haberse vaciado desde entonces (p.ej. fix_vectors.py)
             try:
-                # Paso 1: Borrar documentos existentes de este archivo
-                logger.info(f"1. Borrando documentos existentes de: {txt_file.name}")
-                delete_success = delete_documents_by_source(db_url, collection_name, txt_file.name)
-                
-                if not delete_success:
-                    logger.warning(f"No se pudieron borrar documentos existentes de {txt_file.name}, continuando...")
-                
-                # Paso 2: Procesar el archivo
-                logger.info(f"2. Procesando y troceando: {txt_file.name}")
-                file_documents = process_single_brand_file(
-                    txt_file, chunk_size, chunk_overlap, min_chunk_size, max_chunk_size
-                )
-                
+                present = asyncio.run(sources_with_rows(db_url, collection_name, [f.name for f in unchanged_files]))
+            except Exception as e:
+                logger.warning(f"No se pudo verificar los fragmentos existentes, se reprocesarán todos: {e}")
+                present = set()
+            missing = [f for f in unchanged_files if f.name not in present]
+            if missing:
+                logger.info(f"0. {len(missing)} archivos sin cambios ya no tienen fragmentos en la colección; se reprocesarán")
+            unchanged_files = [f for f in unchanged_files if f.name in present]
+        if unchanged_files:
+            logger.info(f"0. Omitiendo {len(unchanged_files)} archivos sin cambios desde la última ingesta")
+            unchanged_names = {f.name for f in unchanged_files}
+            txt_files = [f for f in txt_files if f.name not in unchanged_names]
+        if not txt_files:
+            logger.info("No hay archivos modificados que ingestar.")
+        
+        # Paso 1: Borrar los documentos existentes de todos los archivos en un solo viaje a la BD
+        logger.info(f"1. Borrando documentos existentes de {len(txt_files)} archivos")
+        if txt_files and not asyncio.run(delete_many_sources(db_url, [txt_file.name for txt_file in txt_files])):
+            logger.warning("No se pudieron borrar documentos existentes, continuando...")
+        
+        # Paso 2: Leer y trocear los archivos en paralelo; el splitter es Python puro y
+        # limitado por CPU, así que cada proceso lo ejecuta con su propio intérprete (sin GIL)
+        logger.info(f"2. Procesando y troceando {len(txt_files)} archivos en paralelo")
+        split_file = functools.partial(
+            process_single_brand_file,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            min_chunk_size=min_chunk_size,
+            max_chunk_size=max_chunk_size,
+            processed_at=run_timestamp
+        )
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for txt_file, file_documents in zip(txt_files, executor.map(split_file, txt_files)):
                 if not file_documents:
                     logger.warning(f"No se generaron documentos válidos de {txt_file.name}")
                     failed_files += 1
                     continue
                 
-                # Paso 3: Ingestar nuevos documentos
-                logger.info(f"3. Ingresando {len(file_documents)} fragmentos de: {txt_file.name}")
-                ingest_success = ingest_to_pgvector(file_documents, db_url, collection_name, False)
-                
-                if ingest_success:
-                    successful_files += 1
-                    total_processed_documents += len(file_documents)
-                    logger.info(f"✅ Archivo {txt_file.name} procesado exitosamente ({len(file_documents)} fragmentos)")
-                else:
-                    failed_files += 1
-                    logger.error(f"❌ Error procesando archivo: {txt_file.name}")
-                    
-            except Exception as e:
-                failed_files += 1
-                logger.error(f"❌ Error procesando archivo {txt_file.name}: {e}", exc_info=True)
+                all_documents.extend(file_documents)
+                prepared_files.append(txt_file)
+                successful_files += 1
+                logger.info(f"Archivo {txt_file.name} preparado ({len(file_documents)} fragmentos)")
+        
+        # Paso 3: Ingestar los fragmentos de todos los archivos con un solo modelo y un solo lote
+        if all_documents:
+            logger.info(f"3. Ingresando {len(all_documents)} fragmentos de {successful_files} archivos")
+            if ingest_to_pgvector(all_documents, db_url, collection_name, False):
+                total_processed_documents = len(all_documents)
+                logger.info(f"✅ {successful_files} archivos ingresados exitosamente ({total_processed_documents} fragmentos)")
+                for txt_file in prepared_files:
+                    scope_state[txt_file.name] = _file_signature(txt_file)
+                _save_ingestion_state(ingestion_state)
+            else:
+                failed_files += successful_files
+                successful_files = 0
+                logger.error("❌ Error en la ingesta de los fragmentos")
         
         # Resumen del procesamiento archivo por archivo
         logger.info(f"\n=== Resumen del procesamiento ===")
@@ -428,7 +812,7 @@ def main():
         logger.info(f"Archivos con errores: {failed_files}")
         logger.info(f"Total de fragmentos procesados: {total_processed_documents}")
         
-        success = successful_files > 0
+        success = successful_files > 0 or not txt_files
     
     # Mostrar resultado final
     end_time = time.time()
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 """
-Script para ingestar un archivo específico con estrategia Borrar y Recrear.
-Útil para actualizar archivos individuales sin afectar toda la colección.
+Script para ingestar un archivo específico sin afectar al resto de la colección.
+
+Solo se vectorizan los fragmentos nuevos o modificados: los que ya están guardados con el
+mismo texto y metadatos se conservan, y los que ya no existen en el archivo se borran.
 
 Uso:
     python scripts/ingest_single_file.py consultor_javier_bazan.txt
@@ -11,6 +13,8 @@ Uso:
 import sys
 import os
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -24,10 +28,15 @@ sys.path.insert(0, str(root_dir))
 
 # Importar funciones del script principal
 from scripts.ingest_pgvector import (
+    chunk_fingerprint,
+    create_connection_pool,
     delete_documents_by_source,
+    delete_embeddings_by_id,
+    fetch_source_fingerprints,
     process_single_brand_file,
     ingest_to_pgvector
 )
+from psycopg_pool import ConnectionPool
 
 # Configurar logging
 import logging
@@ -42,12 +51,15 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def ingest_single_file(filename: str) -> bool:
+def ingest_single_file(filename: str, pool: Optional[ConnectionPool] = None) -> bool:
     """
-    Ingesta un archivo específico usando estrategia Borrar y Recrear.
+    Ingesta un archivo específico vectorizando solo los fragmentos que cambiaron.
+    
+    Si no se pueden leer los fragmentos guardados se recurre a Borrar y Recrear.
     
     Args:
         filename: Nombre del archivo .txt a procesar
+        pool: Pool de conexiones compartido entre archivos; si no se indica se crea uno propio
         
     Returns:
         True si fue exitoso, False en caso contrario
@@ -67,6 +79,10 @@ def ingest_single_file(filename: str) -> bool:
         logger.error("Error: AZURE_POSTGRES_URL no encontrada en variables de entorno")
         return False
     
+    if pool is None:
+        with create_connection_pool(db_url, max_size=1) as own_pool:
+            return ingest_single_file(filename, own_pool)
+    
     # Verificar que el archivo existe
     file_path = brands_dir / filename
     if not file_path.exists():
@@ -79,15 +95,8 @@ def ingest_single_file(filename: str) -> bool:
     logger.info(f"Chunking: {chunk_size} chars, overlap {chunk_overlap}")
     
     try:
-        # Paso 1: Borrar documentos existentes
-        logger.info(f"1. Borrando documentos existentes de: {filename}")
-        delete_success = delete_documents_by_source(db_url, collection_name, filename)
-        
-        if not delete_success:
-            logger.warning(f"No se pudieron borrar documentos existentes, continuando...")
-        
-        # Paso 2: Procesar archivo
-        logger.info(f"2. Procesando y troceando archivo: {filename}")
+        # Paso 1: Procesar archivo
+        logger.info(f"1. Procesando y troceando archivo: {filename}")
         documents = process_single_brand_file(
             file_path, chunk_size, chunk_overlap, min_chunk_size, max_chunk_size
         )
@@ -96,9 +105,40 @@ def ingest_single_file(filename: str) -> bool:
             logger.error(f"Error: No se generaron documentos válidos de {filename}")
             return False
         
+        # Paso 2: Comparar con los fragmentos ya guardados y borrar los obsoletos
+        logger.info(f"2. Comparando con los fragmentos existentes de: {filename}")
+        try:
+            with pool.connection() as conn:
+                existing = fetch_source_fingerprints(conn, collection_name, filename)
+        except Exception as e:
+            logger.warning(f"No se pudieron leer los fragmentos existentes ({e}); se borrará y recreará el archivo")
+            if not delete_documents_by_source(db_url, collection_name, filename):
+                logger.warning(f"No se pudieron borrar documentos existentes, continuando...")
+        else:
+            changed_documents = []
+            for doc in documents:
+                stored_ids = existing.get(chunk_fingerprint(doc.page_content, doc.metadata))
+                if stored_ids:
+                    stored_ids.pop()
+                else:
+                    changed_documents.append(doc)
+            stale_ids = [doc_id for ids in existing.values() for doc_id in ids]
+            if stale_ids:
+                with pool.connection() as conn:
+                    delete_embeddings_by_id(conn, stale_ids)
+            logger.info(
+                f"Fragmentos sin cambios: {len(documents) - len(changed_documents)}, "
+                f"nuevos: {len(changed_documents)}, borrados: {len(stale_ids)}"
+            )
+            documents = changed_documents
+        
+        if not documents:
+            logger.info(f"✅ Archivo {filename} sin cambios")
+            return True
+        
         # Paso 3: Ingestar nuevos documentos
         logger.info(f"3. Ingresando {len(documents)} fragmentos a la base de datos")
-        ingest_success = ingest_to_pgvector(documents, db_url, collection_name, False)
+        ingest_success = ingest_to_pgvector(documents, db_url, collection_name, False, pool=pool)
         
         if ingest_success:
             logger.info(f"✅ Archivo {filename} procesado exitosamente ({len(documents)} fragmentos)")
@@ -141,15 +181,22 @@ def main():
             logger.error("No se encontraron archivos .txt para procesar")
             sys.exit(1)
         
-        logger.info(f"Procesando {len(txt_files)} archivos individualmente...")
-        successful = 0
-        failed = 0
+        db_url = os.getenv("AZURE_POSTGRES_URL")
+        if not db_url:
+            logger.error("Error: AZURE_POSTGRES_URL no encontrada en variables de entorno")
+            sys.exit(1)
         
-        for txt_file in txt_files:
-            if ingest_single_file(txt_file.name):
-                successful += 1
-            else:
-                failed += 1
+        # Lectura, borrado e inserción son I/O y el modelo libera el GIL al codificar: varios
+        # archivos avanzan a la vez con un solo modelo en memoria y un pool de conexiones común
+        max_workers = int(os.getenv("INGEST_WORKERS", "4"))
+        logger.info(f"Procesando {len(txt_files)} archivos individualmente ({max_workers} hilos)...")
+        with create_connection_pool(db_url, max_size=max_workers) as pool, \
+                ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(
+                lambda txt_file: ingest_single_file(txt_file.name, pool), txt_files
+            ))
+        successful = sum(results)
+        failed = len(results) - successful
         
         logger.info(f"Resumen: {successful} exitosos, {failed} fallidos")
         if failed > 0:
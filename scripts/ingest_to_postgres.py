@@ -1,7 +1,13 @@
 import logging
+import os
+import re
 from pathlib import Path
 import sys
 import hashlib
+import functools
+import mmap
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 # --- Configuración de Rutas y Logging ---
@@ -16,16 +22,260 @@ logger = logging.getLogger("ingestion_script")
 # --- Importaciones de Langchain y App ---
 try:
     from langchain_postgres import PGVector
-    from langchain_community.document_loaders import DirectoryLoader
     from langchain_huggingface import HuggingFaceEmbeddings
     from langchain.text_splitter import RecursiveCharacterTextSplitter
     from langchain.schema import Document
+    import numpy as np
+    import torch
+    import psycopg
+    from psycopg.types.json import Jsonb
+    from pgvector.psycopg import register_vector
     # Importamos la función que ya tenías para normalizar nombres de marcas
     from app.main.webhook_handler import normalize_brand_name
 except ImportError as e:
     logger.error(f"Error importando librerías. Asegúrate de tener todo instalado. Error: {e}")
     sys.exit(1)
 
+# Upsert por lotes: los IDs son el hash del contenido, así que re-ejecutar actualiza en lugar de duplicar.
+# El ID es único en toda la tabla: si el chunk pertenece a otra colección se deja intacto
+# (el WHERE evita moverlo a esta colección y quitárselo a la otra).
+UPSERT_EMBEDDINGS_SQL = """
+    INSERT INTO langchain_pg_embedding (id, collection_id, embedding, document, cmetadata)
+    VALUES (%s, %s, %s, %s, %s)
+    ON CONFLICT (id) DO UPDATE SET
+        embedding = EXCLUDED.embedding,
+        document = EXCLUDED.document,
+        cmetadata = EXCLUDED.cmetadata
+    WHERE langchain_pg_embedding.collection_id = EXCLUDED.collection_id
+"""
+
+# Carga inicial en formato binario (solo sobre una colección vacía)
+COPY_EMBEDDINGS_SQL = (
+    "COPY langchain_pg_embedding (id, collection_id, embedding, document, cmetadata) "
+    "FROM STDIN WITH (FORMAT BINARY)"
+)
+
+
+def _to_conninfo(db_url: str) -> str:
+    """Convierte la URL de SQLAlchemy (postgresql+asyncpg://...?ssl=require) en una URL libpq para psycopg."""
+    conninfo = re.sub(r"^postgresql\+\w+://", "postgresql://", db_url)
+    return re.sub(r"([?&])ssl=", r"\1sslmode=", conninfo)
+
+
+# Índice HNSW de similitud coseno (mismo nombre que en la migración 5b1e9d0c7a3f)
+VECTOR_INDEX_NAME = "ix_langchain_pg_embedding_hnsw_cosine"
+
+
+# Ajustes de sesión para la carga: sin espera de fsync por commit (una caída solo perdería
+# los últimos lotes, que se vuelven a ingerir) y más memoria/workers para construir índices.
+# Son SET de sesión sobre conexiones propias del script: se descartan al cerrarlas.
+# Se construyen al usarse (no al importar) para respetar el .env que carga ingest_data().
+def _ingest_session_settings() -> tuple:
+    return (
+        "SET synchronous_commit = off",
+        f"SET maintenance_work_mem = '{os.getenv('INDEX_MAINTENANCE_WORK_MEM', '1GB')}'",
+        f"SET max_parallel_maintenance_workers = {int(os.getenv('INDEX_PARALLEL_WORKERS', '4'))}",
+    )
+
+
+def _execute_autocommit(db_url: str, *statements: str) -> None:
+    """Ejecuta las sentencias fuera de transacción (requisito de CREATE INDEX CONCURRENTLY)."""
+    with psycopg.connect(_to_conninfo(db_url), autocommit=True) as conn:
+        for statement in statements:
+            conn.execute(statement)
+
+
+def _collection_is_empty(conn, collection_id) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM langchain_pg_embedding WHERE collection_id = %s LIMIT 1", (collection_id,)
+    ).fetchone() is None
+
+
+def _prepare_writer(conn, collection_name: str, upsert: bool) -> tuple:
+    """
+    Devuelve (collection_id, use_copy) para la colección destino.
+    
+    En la carga inicial (colección vacía) se usa COPY FROM STDIN en formato binario: sin
+    análisis ni planificación por fila. Si la colección ya tiene filas, o si se pide upsert,
+    se inserta o actualiza con executemany (psycopg 3 lo envía en pipeline). Si COPY choca con
+    un ID de otra colección, embed_and_write pasa a upsert para el resto de la carga.
+    """
+    register_vector(conn)
+    for statement in _ingest_session_settings():
+        conn.execute(statement)
+    row = conn.execute(
+        "SELECT uuid FROM langchain_pg_collection WHERE name = %s", (collection_name,)
+    ).fetchone()
+    if row is None:
+        raise RuntimeError(f"La colección '{collection_name}' no existe en langchain_pg_collection.")
+    collection_id = row[0]
+    return collection_id, not upsert and _collection_is_empty(conn, collection_id)
+
+
+def _write_batch(conn, rows: list, use_copy: bool) -> int:
+    """Escribe un lote de filas en su propia transacción."""
+    with conn.transaction(), conn.cursor() as cur:
+        if use_copy:
+            with cur.copy(COPY_EMBEDDINGS_SQL) as copy:
+                copy.set_types(["varchar", "uuid", "vector", "varchar", "jsonb"])
+                for row in rows:
+                    copy.write_row(row)
+        else:
+            cur.executemany(UPSERT_EMBEDDINGS_SQL, rows)
+    return len(rows)
+
+
+async def embed_and_write(embedding_model, db_url: str, collection_name: str, documents: list,
+                          doc_ids: list, batch_size: int, upsert: bool = False) -> int:
+    """
+    Vectoriza y escribe los fragmentos en un pipeline de dos etapas unidas por una cola acotada.
+    
+    Mientras el modelo calcula los embeddings del lote N+1, el lote N se escribe en
+    PostgreSQL: el tiempo total pasa a ser el de la etapa más lenta y no la suma de ambas.
+    Las dos etapas corren en hilos (asyncio.to_thread), así que el modelo y psycopg liberan el GIL.
+    
+    Returns:
+        Número de filas escritas
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=2)
+    
+    async def embed_stage() -> None:
+        for start in range(0, len(documents), batch_size):
+            batch_docs = documents[start:start + batch_size]
+            embeddings = await asyncio.to_thread(
+                embedding_model.embed_documents, [doc.page_content for doc in batch_docs]
+            )
+            await queue.put((batch_docs, doc_ids[start:start + batch_size], embeddings))
+        await queue.put(None)
+    
+    async def write_stage() -> int:
+        conn = await asyncio.to_thread(psycopg.connect, _to_conninfo(db_url), autocommit=True)
+        try:
+            collection_id, use_copy = await asyncio.to_thread(_prepare_writer, conn, collection_name, upsert)
+            if use_copy:
+                logger.info("Colección vacía: cargando los chunks con COPY.")
+            written = 0
+            while (item := await queue.get()) is not None:
+                batch_docs, batch_ids, embeddings = item
+                rows = [
+                    (doc_id, collection_id, np.asarray(embedding, dtype=np.float32), doc.page_content, Jsonb(doc.metadata))
+                    for doc, doc_id, embedding in zip(batch_docs, batch_ids, embeddings)
+                ]
+                try:
+                    written += await asyncio.to_thread(_write_batch, conn, rows, use_copy)
+                except psycopg.errors.UniqueViolation:
+                    if not use_copy:
+                        raise
+                    # Los IDs (MD5 del contenido) son únicos en toda la tabla: algún chunk ya existe
+                    # en otra colección. El lote fallido se revirtió solo; seguir con upsert, que
+                    # no toca las filas de otras colecciones.
+                    logger.warning("COPY encontró IDs ya existentes en otra colección; se continúa con upsert.")
+                    use_copy = False
+                    written += await asyncio.to_thread(_write_batch, conn, rows, use_copy)
+                logger.info(f"{written}/{len(documents)} chunks escritos.")
+            return written
+        finally:
+            await asyncio.to_thread(conn.close)
+    
+    _, written = await asyncio.gather(embed_stage(), write_stage())
+    return written
+
+
+# Separadores de RecursiveCharacterTextSplitter en una sola expresión (párrafo, línea, frase, cláusula, palabra)
+_SEPARATOR_RE = re.compile(r"\n\n|\n|\. |, | ")
+
+
+def fast_chunk(text: str, max_size: int, overlap: int) -> list:
+    """
+    Trocea text en fragmentos de hasta max_size caracteres con una sola pasada de regex.
+    
+    Las piezas (texto hasta cada separador, incluido) se empaquetan de forma voraz; cada
+    fragmento nuevo arranca con las últimas piezas del anterior que caben en overlap.
+    """
+    pieces = []
+    last_end = 0
+    for match in _SEPARATOR_RE.finditer(text):
+        pieces.append(text[last_end:match.end()])
+        last_end = match.end()
+    pieces.append(text[last_end:])
+    
+    chunks = []
+    current, current_len = [], 0
+    for long_piece in pieces:
+        # Una pieza sin separadores más larga que max_size se corta en bloques fijos
+        for start in range(0, len(long_piece), max_size):
+            piece = long_piece[start:start + max_size]
+            if current and current_len + len(piece) > max_size:
+                chunks.append("".join(current).strip())
+                tail, tail_len = [], 0
+                for previous in reversed(current):
+                    if tail_len + len(previous) > overlap:
+                        break
+                    tail.insert(0, previous)
+                    tail_len += len(previous)
+                current, current_len = tail, tail_len
+                while current and current_len + len(piece) > max_size:
+                    current_len -= len(current.pop(0))
+            current.append(piece)
+            current_len += len(piece)
+    if current:
+        chunks.append("".join(current).strip())
+    return [chunk for chunk in chunks if chunk]
+
+
+# A partir de este tamaño los archivos se leen con mmap
+MMAP_THRESHOLD_BYTES = 1 << 20
+
+
+def _load_txt_file(file_path: Path) -> Document:
+    if file_path.stat().st_size > MMAP_THRESHOLD_BYTES:
+        # Se decodifica directamente desde las páginas mapeadas, sin copiar antes el archivo a un bytes
+        with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            text = str(mapped, "utf-8")
+        # Mismos saltos de línea que el modo texto de read_text (universal newlines)
+        if "\r" in text:
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+    else:
+        text = file_path.read_text(encoding="utf-8")
+    return Document(page_content=text, metadata={"source": str(file_path)})
+
+
+def load_dir_parallel(dir_path: str) -> list:
+    """
+    Carga todos los .txt de dir_path (recursivo) leyendo los archivos en paralelo.
+    
+    La lectura es I/O y libera el GIL, así que un pool de hilos solapa las esperas de disco.
+    """
+    txt_files = sorted(Path(dir_path).rglob("*.txt"))
+    if not txt_files:
+        return []
+    max_workers = min(32, (os.cpu_count() or 1) * 4, len(txt_files))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_load_txt_file, txt_files))
+
+
+@functools.lru_cache(maxsize=1)
+def _get_embedder(model_name: str, device: str) -> HuggingFaceEmbeddings:
+    """Carga el modelo de embeddings una sola vez por proceso."""
+    # En GPU los lotes grandes amortizan el lanzamiento de kernels; sentence-transformers ya
+    # ordena cada llamada por longitud para minimizar el padding dentro de cada lote.
+    model_kwargs = {'device': device}
+    if device == 'cuda':
+        # Pesos en media precisión: la mitad de tráfico de memoria y tensor cores (float32 para desactivarlo)
+        dtype_name = os.getenv("EMBEDDING_DTYPE", "float16").lower()
+        model_kwargs['model_kwargs'] = {'torch_dtype': getattr(torch, dtype_name)}
+    embedder = HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs=model_kwargs,
+        encode_kwargs={
+            'batch_size': int(os.getenv("EMBED_BATCH", "128")),
+            'normalize_embeddings': True
+        }
+    )
+    logger.info(f"Embeddings en dispositivo: {device} ({model_kwargs.get('model_kwargs', {}).get('torch_dtype', 'float32')})")
+    return embedder
+
+
 def ingest_data():
     """
     Lee archivos .txt de directorios específicos, los vectoriza y los guarda en PostgreSQL.
@@ -49,8 +299,7 @@ def ingest_data():
     # --- 1. Procesar directorio de Marcas (BRANDS_DIR) ---
     if brands_dir_path and Path(brands_dir_path).is_dir():
         logger.info(f"Procesando directorio de marcas: {brands_dir_path}")
-        brands_loader = DirectoryLoader(brands_dir_path, glob="**/*.txt", show_progress=True)
-        brand_docs = brands_loader.load()
+        brand_docs = load_dir_parallel(brands_dir_path)
         for doc in brand_docs:
             # Extraer el nombre de la marca del nombre del archivo
             file_path = Path(doc.metadata.get("source"))
@@ -68,8 +317,7 @@ def ingest_data():
     # --- 2. Procesar directorio de Conocimiento General (KNOWLEDGE_BASE_DIR) ---
     if kb_dir_path and Path(kb_dir_path).is_dir():
         logger.info(f"Procesando directorio de conocimiento general: {kb_dir_path}")
-        kb_loader = DirectoryLoader(kb_dir_path, glob="**/*.txt", show_progress=True)
-        kb_docs = kb_loader.load()
+        kb_docs = load_dir_parallel(kb_dir_path)
         for doc in kb_docs:
             doc.metadata["doc_type"] = "kb" # Conocimiento General
         all_documents.extend(kb_docs)
@@ -82,26 +330,62 @@ def ingest_data():
         return
 
     # --- 3. Dividir documentos en chunks ---
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=150)
-    chunked_documents = text_splitter.split_documents(all_documents)
+    # CHUNKER=regex usa fast_chunk (una pasada de regex en C); cambia los cortes y, con ellos, los IDs
+    if os.getenv("CHUNKER", "langchain").lower() == "regex":
+        chunked_documents = [
+            Document(page_content=chunk, metadata=dict(doc.metadata))
+            for doc in all_documents
+            for chunk in fast_chunk(doc.page_content, 1000, 150)
+        ]
+    else:
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=150)
+        chunked_documents = text_splitter.split_documents(all_documents)
     logger.info(f"Total de documentos divididos en {len(chunked_documents)} chunks.")
 
     # --- 4. Inicializar Embeddings y Conectar a PGVector ---
     logger.info(f"Inicializando modelo de embeddings: {model_name}")
-    embedding_model = HuggingFaceEmbeddings(model_name=model_name, model_kwargs={'device': 'cpu'})
+    embedding_model = _get_embedder(model_name, 'cuda' if torch.cuda.is_available() else 'cpu')
     
     logger.info("Conectando a la base de datos PostgreSQL...")
-    vector_store = PGVector(
+    # Instanciar PGVector crea las tablas y la colección si aún no existen
+    PGVector(
         collection_name=collection_name,
         connection=db_url,
-        embedding_function=embedding_model,
+        embeddings=embedding_model,
     )
 
     # --- 5. Ingestar en la Base de Datos ---
     logger.info(f"Ingestando {len(chunked_documents)} chunks en la colección '{collection_name}'...")
     # Generar IDs para evitar duplicados si se re-ejecuta
-    doc_ids = [hashlib.md5(doc.page_content.encode()).hexdigest() for doc in chunked_documents]
-    vector_store.add_documents(documents=chunked_documents, ids=doc_ids)
+    # Los fragmentos repetidos comparten ID: se descartan antes de vectorizar (y no violan la clave primaria en COPY)
+    unique_chunks = {}
+    for doc in chunked_documents:
+        unique_chunks.setdefault(hashlib.md5(doc.page_content.encode()).hexdigest(), doc)
+    # Ordenados por longitud, cada lote del pipeline agrupa fragmentos de tamaño parecido y
+    # el padding hasta el más largo del lote casi desaparece (el orden no importa al escribir)
+    ordered_chunks = sorted(unique_chunks.items(), key=lambda item: len(item[1].page_content))
+    doc_ids = [doc_id for doc_id, _ in ordered_chunks]
+    batch_size = int(os.getenv("BATCH_SIZE", "500"))
+    force_upsert = os.getenv("INGEST_UPSERT", "false").lower() == "true"
+    # En recargas completas, construir el índice HNSW una vez al final es mucho más barato
+    # (y da un grafo mejor) que mantenerlo fila a fila durante la carga
+    recreate_index = os.getenv("RECREATE_INDEX", "false").lower() == "true"
+    if recreate_index:
+        logger.info(f"Eliminando índice {VECTOR_INDEX_NAME} antes de la carga...")
+        _execute_autocommit(db_url, f"DROP INDEX CONCURRENTLY IF EXISTS {VECTOR_INDEX_NAME}")
+    try:
+        asyncio.run(embed_and_write(
+            embedding_model, db_url, collection_name, [doc for _, doc in ordered_chunks], doc_ids, batch_size, upsert=force_upsert
+        ))
+    finally:
+        if recreate_index:
+            logger.info(f"Reconstruyendo índice {VECTOR_INDEX_NAME}...")
+            _execute_autocommit(
+                db_url,
+                *_ingest_session_settings(),
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {VECTOR_INDEX_NAME} ON langchain_pg_embedding "
+                "USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64)"
+            )
 
     logger.info("="*30 + " Proceso de Ingestión Finalizado Exitosamente " + "="*30)
 
@@ -6,7 +6,7 @@ import asyncio
 import aiohttp
 import json
 
-async def test_chat_endpoint():
+async def test_chat_endpoint(session: aiohttp.ClientSession):
     """Prueba el endpoint de chat"""
     
     # URL del endpoint
@@ -24,26 +24,25 @@ async def test_chat_endpoint():
     print(f"Datos: {json.dumps(test_data, indent=2)}")
     
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=test_data) as response:
-                print(f"Status: {response.status}")
+        async with session.post(url, json=test_data) as response:
+            print(f"Status: {response.status}")
+            
+            if response.status == 200:
+                result = await response.json()
+                print("✅ Respuesta exitosa:")
+                print(json.dumps(result, indent=2, ensure_ascii=False))
+                return True
+            else:
+                error_text = await response.text()
+                print(f"❌ Error {response.status}:")
+                print(error_text)
+                return False
                 
-                if response.status == 200:
-                    result = await response.json()
-                    print("✅ Respuesta exitosa:")
-                    print(json.dumps(result, indent=2, ensure_ascii=False))
-                    return True
-                else:
-                    error_text = await response.text()
-                    print(f"❌ Error {response.status}:")
-                    print(error_text)
-                    return False
-                    
     except Exception as e:
         print(f"❌ Error de conexión: {e}")
         return False
 
-async def test_rag_endpoint():
+async def test_rag_endpoint(session: aiohttp.ClientSession):
     """Prueba el endpoint de RAG"""
     
     url = "http://localhost:8000/rag/ask"
@@ -59,26 +58,25 @@ async def test_rag_endpoint():
     print(f"Datos: {json.dumps(test_data, indent=2)}")
     
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=test_data) as response:
-                print(f"Status: {response.status}")
+        async with session.post(url, json=test_data) as response:
+            print(f"Status: {response.status}")
+            
+            if response.status == 200:
+                result = await response.json()
+                print("✅ Respuesta RAG exitosa:")
+                print(json.dumps(result, indent=2, ensure_ascii=False))
+                return True
+            else:
+                error_text = await response.text()
+                print(f"❌ Error RAG {response.status}:")
+                print(error_text)
+                return False
                 
-                if response.status == 200:
-                    result = await response.json()
-                    print("✅ Respuesta RAG exitosa:")
-                    print(json.dumps(result, indent=2, ensure_ascii=False))
-                    return True
-                else:
-                    error_text = await response.text()
-                    print(f"❌ Error RAG {response.status}:")
-                    print(error_text)
-                    return False
-                    
     except Exception as e:
         print(f"❌ Error de conexión RAG: {e}")
         return False
 
-async def test_rag_status():
+async def test_rag_status(session: aiohttp.ClientSession):
     """Prueba el endpoint de estado RAG"""
     
     url = "http://localhost:8000/rag/status"
@@ -87,21 +85,20 @@ async def test_rag_status():
     print(f"URL: {url}")
     
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                print(f"Status: {response.status}")
+        async with session.get(url) as response:
+            print(f"Status: {response.status}")
+            
+            if response.status == 200:
+                result = await response.json()
+                print("✅ Estado RAG:")
+                print(json.dumps(result, indent=2, ensure_ascii=False))
+                return True
+            else:
+                error_text = await response.text()
+                print(f"❌ Error estado RAG {response.status}:")
+                print(error_text)
+                return False
                 
-                if response.status == 200:
-                    result = await response.json()
-                    print("✅ Estado RAG:")
-                    print(json.dumps(result, indent=2, ensure_ascii=False))
-                    return True
-                else:
-                    error_text = await response.text()
-                    print(f"❌ Error estado RAG {response.status}:")
-                    print(error_text)
-                    return False
-                    
     except Exception as e:
         print(f"❌ Error de conexión estado RAG: {e}")
         return False
@@ -111,18 +108,14 @@ async def main():
     print("🚀 Iniciando pruebas de endpoints...")
     print("=" * 50)
     
-    # Probar chat
-    chat_ok = await test_chat_endpoint()
-    
-    print("\n" + "=" * 50)
-    
-    # Probar estado RAG
-    rag_status_ok = await test_rag_status()
-    
-    print("\n" + "=" * 50)
-    
-    # Probar RAG
-    rag_ok = await test_rag_endpoint()
+    # Las tres pruebas son independientes: se lanzan a la vez sobre una sola sesión
+    # (conexiones keep-alive reutilizadas) y el tiempo total es el de la más lenta
+    async with aiohttp.ClientSession() as session:
+        chat_ok, rag_status_ok, rag_ok = await asyncio.gather(
+            test_chat_endpoint(session),
+            test_rag_status(session),
+            test_rag_endpoint(session)
+        )
     
     print("\n" + "=" * 50)
     
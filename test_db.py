@@ -4,6 +4,7 @@ Script para probar la conexión a la base de datos
 """
 import asyncio
 import os
+import time
 from pathlib import Path
 
 # Cargar variables de entorno
@@ -34,10 +35,12 @@ async def test_database_connection():
                 
                 # Probar una consulta simple
                 from sqlalchemy.sql import text
+                started = time.perf_counter()
                 async with engine.connect() as conn:
                     result = await conn.execute(text("SELECT 1 as test"))
                     row = result.fetchone()
-                    print(f"✅ Consulta de prueba exitosa: {row}")
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                print(f"✅ Consulta de prueba exitosa: {row} ({elapsed_ms:.1f} ms vía SQLAlchemy)")
                     
                 return True
             else:
@@ -53,6 +56,28 @@ async def test_database_connection():
         traceback.print_exc()
         return False
 
+async def test_raw_asyncpg_connection():
+    """Mide conexión + SELECT 1 con asyncpg directo, como referencia frente al engine de SQLAlchemy"""
+    try:
+        import asyncpg
+        from app.core.config import settings
+        
+        # asyncpg no entiende el sufijo "+asyncpg" ni los parámetros de SQLAlchemy; SSL igual que el engine
+        dsn = str(settings.DATABASE_URL).replace("+asyncpg", "").split("?", 1)[0]
+        started = time.perf_counter()
+        conn = await asyncpg.connect(dsn, ssl=True)
+        try:
+            value = await conn.fetchval("SELECT 1")
+        finally:
+            await conn.close()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        print(f"✅ asyncpg directo: SELECT 1 = {value} ({elapsed_ms:.1f} ms incluyendo conexión)")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Error con asyncpg directo: {e}")
+        return False
+
 async def test_config():
     """Prueba la configuración"""
     try:
@@ -78,20 +103,21 @@ async def main():
     print("🚀 Iniciando pruebas del sistema...")
     print("=" * 50)
     
-    # Probar configuración
-    config_ok = await test_config()
-    if not config_ok:
-        print("❌ Fallo en la configuración")
-        return
+    # Configuración y base de datos son independientes: se validan a la vez
+    config_ok, db_ok = await asyncio.gather(test_config(), test_database_connection())
     
     print("\n" + "=" * 50)
     
-    # Probar base de datos
-    db_ok = await test_database_connection()
+    if not config_ok:
+        print("❌ Fallo en la configuración")
+        return
     if not db_ok:
         print("❌ Fallo en la base de datos")
         return
     
+    # Línea base sin pool ni ORM (informativa: no detiene las pruebas)
+    await test_raw_asyncpg_connection()
+    
     print("\n" + "=" * 50)
     print("✅ Todas las pruebas pasaron correctamente!")
     print("🚀 El sistema está listo para funcionar")
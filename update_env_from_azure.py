@@ -5,21 +5,56 @@ Script para actualizar el archivo .env local con variables reales de Azure
 import subprocess
 import json
 import os
+import time
+from pathlib import Path
+
+APP_NAME = 'chat-app-4313'
+RESOURCE_GROUP = 'beta-bot'
+
+# Caché local opcional de la salida de `az` (arrancar la CLI y refrescar el token tarda varios segundos).
+# Desactivada por defecto: guarda todos los secretos de producción en disco. Activar con AZENV_CACHE_TTL=<segundos>.
+CACHE_DIR = Path.home() / '.cache' / 'azenv'
+CACHE_TTL_SECONDS = int(os.getenv('AZENV_CACHE_TTL', '0'))
 
 def get_azure_app_settings():
-    """Obtiene las variables de entorno desde Azure App Service"""
+    """Obtiene las variables de entorno desde Azure App Service (o desde la caché si es reciente)"""
+    cache_file = CACHE_DIR / f"{RESOURCE_GROUP}__{APP_NAME}.json"
+    if CACHE_TTL_SECONDS > 0:
+        try:
+            if time.time() - cache_file.stat().st_mtime < CACHE_TTL_SECONDS:
+                print(f"♻️  Usando configuraciones en caché ({cache_file})")
+                return json.loads(cache_file.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            pass
+    else:
+        # Caché desactivada: no dejar secretos de una ejecución anterior en disco
+        try:
+            cache_file.unlink(missing_ok=True)
+        except OSError:
+            pass
+    
     try:
         result = subprocess.run([
             'az', 'webapp', 'config', 'appsettings', 'list',
-            '--name', 'chat-app-4313',
-            '--resource-group', 'beta-bot',
+            '--name', APP_NAME,
+            '--resource-group', RESOURCE_GROUP,
             '--output', 'json'
         ], capture_output=True, text=True, check=True)
-        
-        return json.loads(result.stdout)
     except subprocess.CalledProcessError as e:
         print(f"❌ Error al obtener configuraciones de Azure: {e}")
         return None
+    
+    settings = json.loads(result.stdout)
+    if CACHE_TTL_SECONDS > 0:
+        try:
+            # Contiene secretos: directorio y archivo solo accesibles por el usuario
+            CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+            CACHE_DIR.chmod(0o700)
+            cache_file.touch(mode=0o600, exist_ok=True)
+            cache_file.write_text(result.stdout, encoding='utf-8')
+        except OSError as e:
+            print(f"⚠️  No se pudo guardar la caché de configuraciones: {e}")
+    return settings
 
 def update_env_file(settings):
     """Actualiza el archivo .env con las variables de Azure"""
@@ -39,32 +74,40 @@ def update_env_file(settings):
         'KEY_VAULT_NAME': 'KEY_VAULT_NAME'
     }
     
+    # Indexar las configuraciones por nombre una sola vez
+    values_by_name = {setting['name']: setting['value'] for setting in settings}
+    
     # Crear contenido del archivo .env
-    env_content = "# Variables de entorno obtenidas desde Azure App Service\n"
-    env_content += "# IMPORTANTE: Estas son las variables reales de producción\n\n"
+    lines = [
+        "# Variables de entorno obtenidas desde Azure App Service",
+        "# IMPORTANTE: Estas son las variables reales de producción",
+        "",
+    ]
     
     # Agregar variables importantes
-    for azure_name, env_name in important_vars.items():
-        for setting in settings:
-            if setting['name'] == azure_name:
-                env_content += f"{env_name}={setting['value']}\n"
-                break
+    lines.extend(
+        f"{env_name}={values_by_name[azure_name]}"
+        for azure_name, env_name in important_vars.items()
+        if azure_name in values_by_name
+    )
     
     # Agregar variables por defecto para desarrollo local
-    env_content += "\n# Variables por defecto para desarrollo local\n"
-    env_content += "ENVIRONMENT=development\n"
-    env_content += "LOG_LEVEL=INFO\n"
-    env_content += "DEBUG=True\n"
-    env_content += "SERVER_PORT=8000\n"
-    env_content += "REDIS_URL=redis://localhost:6379/0\n"
-    env_content += "OPENROUTER_MODEL_CHAT=meta-llama/llama-3-8b-instruct\n"
-    env_content += "LLM_TEMPERATURE=0.5\n"
-    env_content += "LLM_MAX_TOKENS=1000\n"
-    env_content += "LLM_HTTP_TIMEOUT=45.0\n"
+    lines.extend([
+        "",
+        "# Variables por defecto para desarrollo local",
+        "ENVIRONMENT=development",
+        "LOG_LEVEL=INFO",
+        "DEBUG=True",
+        "SERVER_PORT=8000",
+        "REDIS_URL=redis://localhost:6379/0",
+        "OPENROUTER_MODEL_CHAT=meta-llama/llama-3-8b-instruct",
+        "LLM_TEMPERATURE=0.5",
+        "LLM_MAX_TOKENS=1000",
+        "LLM_HTTP_TIMEOUT=45.0",
+    ])
     
     # Escribir archivo .env
-    with open('.env', 'w', encoding='utf-8') as f:
-        f.write(env_content)
+    Path('.env').write_text("\n".join(lines) + "\n", encoding='utf-8')
     
     print("✅ Archivo .env actualizado con variables reales de Azure")
     print("🚀 Ahora puedes ejecutar la aplicación localmente")